@@ -0,0 +1,53 @@
+from typing import Any, Callable, Dict, Iterable, Optional
+
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+
+Row = Dict[str, Any]
+
+
+class Accumulator:
+    # one aggregate folded over the values as they are read; like SQL, null values are skipped, count without a
+    # field counts the rows, and the other aggregates of no values are None
+    def __init__(self, function: str):
+        if function not in AGGREGATES:
+            raise ValueError
+        self.function = function
+        self.count = 0
+        self.value = None
+
+    def add(self, value: Any) -> None:
+        if value is None:
+            return
+        self.count += 1
+        if self.function in ('sum', 'avg'):
+            self.value = value if self.count == 1 else self.value + value
+        elif self.function == 'min' and (self.count == 1 or value < self.value):
+            self.value = value
+        elif self.function == 'max' and (self.count == 1 or value > self.value):
+            self.value = value
+
+    def result(self) -> Any:
+        if self.function == 'count':
+            return self.count
+        if self.function == 'avg':
+            return self.value / self.count if self.count else None
+        return self.value
+
+
+def aggregate_rows(rows: Iterable[Row], function: str, field: Optional[str] = None, group_by: Optional[str] = None,
+                   group_key: Optional[Callable[[Any], Any]] = None) -> Any:
+    # a single result, or {group: result} in the order the groups were first seen; rows are never kept
+    if group_by is None:
+        accumulator = Accumulator(function)
+        for row in rows:
+            accumulator.add(True if field is None else row[field])
+        return accumulator.result()
+
+    groups = {}
+    for row in rows:
+        group = row[group_by] if group_key is None or row[group_by] is None else group_key(row[group_by])
+        accumulator = groups.get(group)
+        if accumulator is None:
+            accumulator = groups[group] = Accumulator(function)
+        accumulator.add(True if field is None else row[field])
+    return {group: accumulator.result() for group, accumulator in groups.items()}
@@ -0,0 +1,226 @@
+import asyncio
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from db import DEFAULT_BATCH_SIZE, DataBase, DBField, DBTable, SelectionCriteria, encode_key
+
+DEFAULT_WORKERS = 4  # threads doing the storage work of all the tables
+CHUNK_ROWS = 100  # rows an async query iteration reads under one read lock
+CHUNKS_AHEAD = 4  # chunks read before the caller consumes them
+
+
+class AsyncDataBase:
+    # the DataBase API for asyncio: every call runs on a bounded thread pool, so the event loop never waits for the
+    # files. Transactions are per thread and cannot span awaits, use the DataBase in a worker for them
+    def __init__(self, database: Optional[DataBase] = None, max_workers: int = DEFAULT_WORKERS):
+        if max_workers < 1:
+            raise ValueError
+        self.database = database if database else DataBase()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='db')
+        self.tables = {}  # table name -> AsyncDBTable, one per DBTable so concurrent calls are coalesced
+
+    async def run(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                functools.partial(function, *args, **kwargs))
+
+    def wrap(self, table: DBTable) -> 'AsyncDBTable':
+        if table.name not in self.tables or self.tables[table.name].table is not table:
+            self.tables[table.name] = AsyncDBTable(self, table)
+        return self.tables[table.name]
+
+    async def create_table(self, table_name: str, fields: List[DBField], key_field_name: str,
+                           storage: str = 'row') -> 'AsyncDBTable':
+        return self.wrap(await self.run(self.database.create_table, table_name, fields, key_field_name, storage))
+
+    async def num_tables(self) -> int:
+        return await self.run(self.database.num_tables)
+
+    async def get_table(self, table_name: str) -> 'AsyncDBTable':
+        return self.wrap(await self.run(self.database.get_table, table_name))
+
+    async def delete_table(self, table_name: str) -> None:
+        if table_name in self.tables:
+            await self.tables.pop(table_name).drain()
+        await self.run(self.database.delete_table, table_name)
+
+    async def get_tables_names(self) -> List[Any]:
+        return await self.run(self.database.get_tables_names)
+
+    async def query_multiple_tables(self, tables: List[str], fields_and_values_list: List[List[SelectionCriteria]],
+                                    fields_to_join_by: List[str]) -> List[Dict[str, Any]]:
+        return await self.run(self.database.query_multiple_tables, tables, fields_and_values_list, fields_to_join_by)
+
+    async def flush(self) -> None:
+        await self.run(self.database.flush)
+
+    async def close(self) -> None:
+        # the inserts already made are written first
+        for table in list(self.tables.values()):
+            await table.drain()
+        await self.run(self.database.close)
+        self.executor.shutdown()
+
+    async def __aenter__(self) -> 'AsyncDataBase':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+
+class AsyncDBTable:
+    # concurrent get_record calls for one key share a single read, and concurrent insert_record calls are written
+    # together as one insert_records batch (one commit), the next batch collecting while the previous one is written
+    def __init__(self, database: AsyncDataBase, table: DBTable):
+        self.database = database
+        self.table = table
+        self.lookups = {}  # encoded key -> the read in progress
+        self.inserts = []  # (values, future) not written yet
+        self.inserting = None  # the task writing the inserts
+
+    @property
+    def name(self) -> str:
+        return self.table.name
+
+    async def write(self, function: Callable[..., Any], *args: Any) -> Any:
+        try:
+            return await self.database.run(function, *args)
+        finally:  # a read that started before the write finished may return the old row, it is not shared anymore
+            self.lookups.clear()
+
+    async def count(self, criteria: Optional[List[SelectionCriteria]] = None) -> int:
+        return await self.database.run(self.table.count, criteria)
+
+    async def get_record(self, key: Any) -> Dict[str, Any]:
+        encoded_key = encode_key(key)
+        lookup = self.lookups.get(encoded_key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self.database.run(self.table.get_record, key))
+            self.lookups[encoded_key] = lookup
+            lookup.add_done_callback(lambda done: self.lookups.pop(encoded_key, None)
+                                     if self.lookups.get(encoded_key) is done else None)
+        row = await asyncio.shield(lookup)  # a caller that is cancelled does not cancel the read of the others
+        return dict(row)  # every caller gets its own copy
+
+    async def insert_record(self, values: Dict[str, Any]) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.inserts.append((values, future))
+        if self.inserting is None or self.inserting.done():
+            self.inserting = asyncio.ensure_future(self.write_inserts())
+        await future
+
+    async def write_inserts(self) -> None:
+        # the task starts once the callers that are ready have run, so their inserts are already in the list
+        while self.inserts:
+            batch, self.inserts = self.inserts[:DEFAULT_BATCH_SIZE], self.inserts[DEFAULT_BATCH_SIZE:]
+            results = await self.insert_batch(batch)
+            for (_, future), error in zip(batch, results):
+                if future.done():  # the caller was cancelled
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    async def insert_batch(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> List[Optional[Exception]]:
+        # an invalid record fails the whole batch before anything is written, the records are then inserted one by
+        # one so only the callers of the invalid ones get the error
+        try:
+            await self.write(self.table.insert_records, [values for values, _ in batch])
+            return [None for _ in batch]
+        except ValueError as error:
+            if len(batch) == 1:
+                return [error]
+        except Exception as error:
+            return [error for _ in batch]
+        results = []
+        for values, _ in batch:
+            try:
+                await self.write(self.table.insert_record, values)
+                results.append(None)
+            except Exception as error:
+                results.append(error)
+        return results
+
+    async def drain(self) -> None:
+        if self.inserting is not None:
+            await self.inserting
+
+    async def insert_records(self, records: List[Dict[str, Any]], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        return await self.write(self.table.insert_records, list(records), batch_size)
+
+    async def delete_record(self, key: Any) -> None:
+        await self.write(self.table.delete_record, key)
+
+    async def delete_records(self, criteria: List[SelectionCriteria]) -> int:
+        return await self.write(self.table.delete_records, criteria)
+
+    async def update_record(self, key: Any, values: Dict[str, Any]) -> None:
+        await self.write(self.table.update_record, key, values)
+
+    async def update_records(self, criteria: List[SelectionCriteria], values: Dict[str, Any]) -> int:
+        return await self.write(self.table.update_records, criteria, values)
+
+    async def query_table(self, criteria: List[SelectionCriteria]) -> List[Dict[str, Any]]:
+        return await self.database.run(self.table.query_table, criteria)
+
+    async def create_index(self, field_to_index: Any, index_type: str = 'hash',
+                           include: Optional[List[str]] = None) -> None:
+        await self.write(self.table.create_index, field_to_index, index_type, include)
+
+    def iter_query(self, criteria: List[SelectionCriteria], fields: Optional[List[str]] = None,
+                   limit: Optional[int] = None, order_by: Optional[str] = None) -> 'AsyncQueryRows':
+        return AsyncQueryRows(self.database, self.table, criteria, fields, limit, order_by)
+
+
+class AsyncQueryRows:
+    # DBTable.iter_query holds the read lock until its rows are consumed, and a writer waiting for that lock would
+    # stop every other read of the event loop. So the keys of the matching rows are read first, in one read, and the
+    # rows are then read by key CHUNK_ROWS at a time, each chunk under its own read lock, at most CHUNKS_AHEAD chunks
+    # ahead of the caller. A chunk read after a write sees it: a row that no longer matches is skipped
+    def __init__(self, database: AsyncDataBase, table: DBTable, criteria: List[SelectionCriteria],
+                 fields: Optional[List[str]], limit: Optional[int], order_by: Optional[str]):
+        self.database = database
+        self.table = table
+        self.criteria = criteria
+        self.fields = fields
+        self.limit = limit
+        self.order_by = order_by
+        self.keys = None  # the keys of the matching rows, in the order of the iteration
+        self.position = 0  # keys already sent to a chunk read
+        self.chunks = collections.deque()  # the chunk reads in progress, in order
+        self.rows = iter(())
+
+    def read_keys(self) -> List[Any]:
+        key = self.table.key_field_name
+        return [row[key] for row in self.table.iter_query(self.criteria, [key], self.limit, self.order_by)]
+
+    def read_chunk(self, keys: List[Any]) -> List[Dict[str, Any]]:
+        # the rows come out in the order of keys, a key criterion plans a read of each key
+        criteria = [SelectionCriteria(self.table.key_field_name, 'in', keys)] + self.criteria
+        return list(self.table.iter_query(criteria, self.fields))
+
+    def __aiter__(self) -> 'AsyncQueryRows':
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        while True:
+            row = next(self.rows, None)
+            if row is not None:
+                return row
+            if self.keys is None:
+                self.keys = await self.database.run(self.read_keys)
+            while len(self.chunks) < CHUNKS_AHEAD and self.position < len(self.keys):
+                keys = self.keys[self.position:self.position + CHUNK_ROWS]
+                self.chunks.append(asyncio.ensure_future(self.database.run(self.read_chunk, keys)))
+                self.position += len(keys)
+            if not self.chunks:
+                raise StopAsyncIteration
+            self.rows = iter(await self.chunks.popleft())
+
+    async def aclose(self) -> None:
+        for chunk in self.chunks:
+            chunk.cancel()
+        self.chunks.clear()
+        self.keys, self.position, self.rows = [], 0, iter(())
@@ -0,0 +1,206 @@
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+try:
+    import resource
+except ImportError:  # no getrusage on Windows, the peak memory is then not reported
+    resource = None
+
+from db import DB_ROOT, DataBase, DBField, SelectionCriteria
+from parallel_scan import PARALLEL_SCAN_ROWS
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)  # add 1_000_000 with --sizes, it takes a while with dbm.dumb
+DEFAULT_SAMPLES = 200  # timed calls of every single-row operation
+SCANS = 5  # timed full scans and joins, they read the whole table
+BULK_BATCH = 1000
+ROWS_PER_GROUP = 100
+TABLE = 'BenchRows'
+GROUPS_TABLE = 'BenchGroups'
+PARALLEL_WORKERS = max(2, os.cpu_count() or 1)  # query_scan_parallel, measured at the sizes over PARALLEL_SCAN_ROWS
+DEFAULT_TOLERANCE = 0.25  # a p50 latency this much slower than the baseline is a regression
+
+BENCH_FIELDS = [DBField('ID', int), DBField('Group', str), DBField('Score', int), DBField('Name', str),
+                DBField('Created', dt.datetime)]
+GROUP_FIELDS = [DBField('Group', str), DBField('Region', str)]
+
+
+def make_row(i: int, groups: int) -> Dict[str, Any]:
+    return dict(ID=i, Group=f'group{i % groups}', Score=(i * 7919) % 100_000, Name=f'name{i}',
+                Created=dt.datetime(2020, 1, 1) + dt.timedelta(seconds=i))
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies: List[float], rows: Optional[int] = None) -> Dict[str, Any]:
+    # throughput is in rows per second for the operations that move many rows, calls per second otherwise
+    seconds = sum(latencies)
+    return dict(calls=len(latencies), seconds=seconds,
+                throughput=(rows if rows is not None else len(latencies)) / seconds if seconds else None,
+                p50_ms=percentile(latencies, 0.5) * 1000, p99_ms=percentile(latencies, 0.99) * 1000)
+
+
+def timed(calls: Iterable[Callable[[], Any]]) -> List[float]:
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_bytes() -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(DB_ROOT) if entry.name.startswith('Bench'))
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS, kilobytes on Linux
+
+
+def drop_bench_tables(db: DataBase) -> None:
+    for table_name in (TABLE, GROUPS_TABLE):
+        if table_name in db.get_tables_names():
+            db.delete_table(table_name)
+
+
+def run_size(db: DataBase, rows: int, samples: int, seed: int = 0) -> Dict[str, Any]:
+    # every operation on a fresh table of rows rows; the bench tables are dropped again at the end
+    drop_bench_tables(db)
+    rng = random.Random(seed)
+    groups = max(1, rows // ROWS_PER_GROUP)
+    table = db.create_table(TABLE, BENCH_FIELDS, 'ID')
+    results = {}
+
+    batches = [[make_row(i, groups) for i in range(start, min(rows, start + BULK_BATCH))]
+               for start in range(0, rows, BULK_BATCH)]
+    results['bulk_insert'] = summarize(timed(lambda batch=batch: table.insert_records(batch) for batch in batches),
+                                       rows)
+    results['insert'] = summarize(timed(lambda i=i: table.insert_record(make_row(i, groups))
+                                        for i in range(rows, rows + samples)))
+    keys = [rng.randrange(rows) for _ in range(samples)]
+    results['get_record'] = summarize(timed(lambda key=key: table.get_record(key) for key in keys))
+    results['update_record'] = summarize(timed(lambda key=key: table.update_record(key, dict(Name='updated'))
+                                               for key in keys))
+
+    results['create_index'] = summarize(timed([lambda: table.create_index('Group'),
+                                               lambda: table.create_index('Score', 'ordered')]))
+    results['query_key'] = summarize(timed(lambda key=key: table.query_table([SelectionCriteria('ID', '=', key)])
+                                           for key in keys))
+    results['query_hash'] = summarize(timed(
+        lambda key=key: table.query_table([SelectionCriteria('Group', '=', f'group{key % groups}')]) for key in keys))
+    results['query_range'] = summarize(timed(
+        lambda score=score: table.query_table([SelectionCriteria('Score', 'between', (score, score + 100))])
+        for score in (rng.randrange(100_000) for _ in range(samples))))
+    results['query_scan'] = summarize(timed(
+        lambda: table.query_table([SelectionCriteria('Name', 'startswith', 'updated')]) for _ in range(SCANS)),
+        rows * SCANS)
+    if rows > PARALLEL_SCAN_ROWS:  # the same scan where the workers take it over
+        db.scanner.configure(PARALLEL_WORKERS, PARALLEL_SCAN_ROWS)
+        try:
+            results['query_scan_parallel'] = summarize(timed(
+                lambda: table.query_table([SelectionCriteria('Name', 'startswith', 'updated')])
+                for _ in range(SCANS)), rows * SCANS)
+        finally:
+            db.scanner.configure(workers=0)
+
+    groups_table = db.create_table(GROUPS_TABLE, GROUP_FIELDS, 'Group')
+    groups_table.insert_records(dict(Group=f'group{i}', Region=f'region{i % 10}') for i in range(groups))
+    results['join'] = summarize(timed(
+        lambda: db.query_multiple_tables([TABLE, GROUPS_TABLE],
+                                         [[SelectionCriteria('Score', '<', 1000)], []], ['Group'])
+        for _ in range(SCANS)))
+
+    deleted = [rows - 1 - i for i in range(samples)]  # the samples read and updated above stay in the table
+    results['delete_records'] = summarize(timed(
+        lambda key=key: table.delete_records([SelectionCriteria('ID', '=', key)]) for key in deleted))
+
+    db.flush()
+    results['bytes_on_disk'] = bench_bytes()
+    results['peak_rss_kb'] = peak_rss_kb()
+    drop_bench_tables(db)
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: Iterable[int] = DEFAULT_SIZES, samples: int = DEFAULT_SAMPLES) -> Dict[str, Any]:
+    DB_ROOT.mkdir(parents=True, exist_ok=True)
+    db = DataBase()
+    results = dict(commit=git_commit(), python=platform.python_version(), platform=platform.platform(),
+                   started=dt.datetime.now().isoformat(timespec='seconds'), samples=samples, sizes={})
+    for rows in sizes:
+        results['sizes'][str(rows)] = run_size(db, rows, samples)
+    return results
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    # the operations whose median latency grew by more than tolerance, at the sizes both runs measured
+    regressions = []
+    for size, operations in current['sizes'].items():
+        for operation, result in operations.items():
+            old = baseline['sizes'].get(size, {}).get(operation)
+            if not isinstance(result, dict) or not isinstance(old, dict) or not old['p50_ms']:
+                continue
+            ratio = result['p50_ms'] / old['p50_ms']
+            if ratio > 1 + tolerance:
+                regressions.append(f'{operation} at {size} rows: p50 {old["p50_ms"]:.3f} ms -> '
+                                   f'{result["p50_ms"]:.3f} ms ({ratio:.2f}x)')
+    return regressions
+
+
+def report(results: Dict[str, Any]) -> str:
+    lines = []
+    for size, operations in results['sizes'].items():
+        lines.append(f'{size} rows: {operations["bytes_on_disk"]} bytes on disk, '
+                     f'peak RSS {operations["peak_rss_kb"]} KB')
+        for operation, result in operations.items():
+            if isinstance(result, dict):
+                lines.append(f'  {operation:<15} {result["throughput"] or 0:>12.1f}/s  p50 {result["p50_ms"]:9.3f} ms'
+                             f'  p99 {result["p99_ms"]:9.3f} ms')
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Scaling benchmark of the DBTable operations')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='table sizes in rows')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES, help='timed calls per single-row operation')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run, exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.samples)
+    print(report(results))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        for regression in regressions:
+            print('regression:', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import csv
+import datetime as dt
+import io
+import json
+import os
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+FORMATS = ('csv', 'ndjson')
+SUFFIXES = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+WRITE_BUFFER_BYTES = 1 << 20
+TRUE_TEXTS = ('true', '1', 'yes')
+FALSE_TEXTS = ('false', '0', 'no')
+
+Row = Dict[str, Any]
+Progress = Callable[[int, int], None]  # rows and bytes done so far
+
+
+def format_of(path: str, file_format: Optional[str]) -> str:
+    file_format = file_format if file_format else SUFFIXES.get(os.path.splitext(path)[1].lower())
+    if file_format not in FORMATS:
+        raise ValueError
+    return file_format
+
+
+def parse_value(value: Any, field_type: type) -> Any:
+    # the text of a CSV cell, or a JSON value, as field_type; an empty cell of a field that is not a string is None
+    if value is None or type(value) is field_type:
+        return value
+    if value == '':
+        return None
+    try:
+        if field_type is bool:
+            if str(value).lower() not in TRUE_TEXTS + FALSE_TEXTS:
+                raise ValueError
+            return str(value).lower() in TRUE_TEXTS
+        if field_type in (dt.datetime, dt.date, dt.time):
+            return field_type.fromisoformat(value)
+        return field_type(value)
+    except TypeError as error:  # a JSON value of another kind, a number for a date
+        raise ValueError from error
+
+
+def format_value(value: Any) -> Any:
+    # a value as JSON has it, dates and times as ISO 8601 text
+    if isinstance(value, (dt.date, dt.time)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def counted_lines(file: BinaryIO) -> Iterator[Tuple[bytes, int]]:
+    # the lines of the file with the bytes read up to the end of each
+    position = 0
+    for line in file:
+        position += len(line)
+        yield line, position
+
+
+def read_rows(file: BinaryIO, file_format: str, fields: Dict[str, type]) -> Iterator[Tuple[Row, int]]:
+    # rows parsed one line at a time, with the bytes read so far; a column or key that is not a field is an error
+    lines = counted_lines(file)
+    if file_format == 'ndjson':
+        for line, position in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict) or any(name not in fields for name in record):
+                raise ValueError
+            yield {name: parse_value(value, fields[name]) for name, value in record.items()}, position
+        return
+
+    position = 0
+
+    def decoded():
+        nonlocal position
+        for line, position in lines:
+            yield line.decode('utf-8-sig' if position == len(line) else 'utf-8')
+
+    reader = csv.reader(decoded())
+    header = next(reader, None)
+    if header is None:
+        return
+    if any(name not in fields for name in header) or len(set(header)) != len(header):
+        raise ValueError
+    types = [fields[name] for name in header]
+    for cells in reader:
+        if not cells:
+            continue
+        if len(cells) != len(header):
+            raise ValueError
+        yield {name: parse_value(cell, field_type) for name, cell, field_type in zip(header, cells, types)}, position
+
+
+def write_rows(file: BinaryIO, file_format: str, fields: List[str], rows: Iterable[Row],
+               progress: Optional[Progress] = None, progress_rows: int = 0) -> int:
+    # returns the rows written; progress is called every progress_rows rows and at the end
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='', write_through=False)
+    written = 0
+    try:
+        writer = csv.writer(text) if file_format == 'csv' else None
+        if writer is not None:
+            writer.writerow(fields)
+        for row in rows:
+            if writer is not None:
+                writer.writerow(['' if row[name] is None else format_value(row[name]) for name in fields])
+            else:
+                text.write(json.dumps({name: format_value(row[name]) for name in fields}) + '\n')
+            written += 1
+            if progress is not None and progress_rows and written % progress_rows == 0:
+                text.flush()
+                progress(written, file.tell())
+        text.flush()
+        if progress is not None:
+            progress(written, file.tell())
+    finally:
+        text.detach()
+    return written
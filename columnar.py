@@ -0,0 +1,293 @@
+import datetime as dt
+import mmap
+import os
+import pickle
+import shelve
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+SEGMENT_ROWS = 1024  # rows sealed together into one segment of every column
+TAIL_PAGE_ROWS = 4  # rows of the unsealed tail kept in one shelve entry
+DECODED_COLUMNS = 64  # decoded column segments kept in memory per table
+META_KEY = 'meta'
+TAIL = -1  # segment number of the rows that are not sealed yet
+EPOCH = dt.datetime(1970, 1, 1)
+MICROSECOND = dt.timedelta(microseconds=1)
+INT64_RANGE = range(-2 ** 63, 2 ** 63)
+
+Row = Dict[str, Any]
+Position = Tuple[int, int]  # (segment, slot), or (TAIL, position in the tail)
+
+
+def column_kind(field_type: type, values: List[Any]) -> str:
+    # the field type decides the encoding, a segment holding anything else is pickled as a list
+    if field_type is int and all(value is None or (type(value) is int and value in INT64_RANGE) for value in values):
+        return 'int'
+    if field_type is float and all(value is None or type(value) is float for value in values):
+        return 'float'
+    if field_type is dt.datetime and all(value is None or (type(value) is dt.datetime and value.tzinfo is None)
+                                         for value in values):
+        return 'datetime'
+    if field_type is str and all(value is None or type(value) is str for value in values):
+        return 'str'
+    return 'pickle'
+
+
+def encode_column(field_type: type, values: List[Any]) -> Tuple[str, bytes, int]:
+    # (kind, data, extra): numbers are a typed array followed by one null flag per row (extra = length of the flags,
+    # 0 without nulls); strings are int32 codes (-1 for null) followed by the pickled dictionary (extra = its length)
+    kind = column_kind(field_type, values)
+    if kind in ('int', 'float', 'datetime'):
+        if kind == 'datetime':
+            values = [None if value is None else (value - EPOCH) // MICROSECOND for value in values]
+        numbers = array('d' if kind == 'float' else 'q', [0 if value is None else value for value in values])
+        nulls = bytes(value is None for value in values) if None in values else b''
+        return kind, numbers.tobytes() + nulls, len(nulls)
+    if kind == 'str':
+        dictionary = {}
+        codes = array('i', [-1 if value is None else dictionary.setdefault(value, len(dictionary))
+                            for value in values])
+        words = pickle.dumps(list(dictionary), pickle.HIGHEST_PROTOCOL)
+        return kind, codes.tobytes() + words, len(words)
+    return kind, pickle.dumps(values, pickle.HIGHEST_PROTOCOL), 0
+
+
+def decode_column(kind: str, data: bytes, extra: int, rows: int) -> List[Any]:
+    if kind in ('int', 'float', 'datetime'):
+        numbers = array('d' if kind == 'float' else 'q')
+        numbers.frombytes(data[:len(data) - extra])
+        values = numbers.tolist()
+        if kind == 'datetime':
+            values = [EPOCH + dt.timedelta(microseconds=value) for value in values]
+        if extra:
+            nulls = data[len(data) - extra:]
+            values = [None if nulls[i] else value for i, value in enumerate(values)]
+        return values
+    if kind == 'str':
+        codes = array('i')
+        codes.frombytes(data[:rows * codes.itemsize])
+        words = pickle.loads(data[rows * codes.itemsize:])
+        return [None if code < 0 else words[code] for code in codes]
+    return pickle.loads(data)
+
+
+class ColumnState:
+    # what a columnar table keeps in memory between calls; reset whenever the files may have changed under it
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.meta = None
+        self.positions = None  # encoded key -> Position, in scan order
+        self.tail_rows = 0
+        self.maps = {}  # column file path -> mmap
+        self.decoded = OrderedDict()  # (field, segment) -> values, least recently used first
+
+    def reset(self) -> None:
+        with self.lock:
+            for column_map in self.maps.values():
+                column_map.close()
+            self.maps = {}
+            self.meta = None
+            self.positions = None
+            self.tail_rows = 0
+            self.decoded.clear()
+
+    def read(self, path: str, offset: int, length: int) -> bytes:
+        # sealed segments are only appended to the column file, so a map that is too short is simply made again
+        with self.lock:
+            column_map = self.maps.get(path)
+            if column_map is None or offset + length > len(column_map):
+                if column_map is not None:
+                    column_map.close()
+                with open(path, 'rb') as file:
+                    column_map = self.maps[path] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return column_map[offset:offset + length]
+
+
+class ColumnStore:
+    # a columnar table with the interface of a shelf of rows keyed by encoded key. Sealed rows are kept per field in
+    # segments of a column file (typed arrays, dictionary encoded strings) that are only ever appended to and read
+    # through mmap; the newest rows are kept in small pages of value tuples in the shelve store, with the metadata
+    # and the deleted slots of every segment, so every change to the table goes through the write-ahead log. A
+    # segment is written and fsynced before the commit that adds it to the metadata, a crash leaves unused bytes.
+    def __init__(self, store: Callable[[], shelve.Shelf], fields: List[Any], key_field_name: str, state: ColumnState,
+                 encode_key: Callable[[Any], str], column_path: Callable[[str], str]):
+        self.store = store
+        self.fields = fields
+        self.names = [field.name for field in fields]
+        self.key_index = self.names.index(key_field_name)
+        self.state = state
+        self.encode_key = encode_key
+        self.column_path = column_path
+
+    def load_meta(self) -> Dict[str, Any]:
+        if self.state.meta is None:
+            self.state.meta = self.store().get(META_KEY, dict(seals=0, segments=[]))
+        return self.state.meta
+
+    def save_meta(self) -> None:
+        self.store()[META_KEY] = self.state.meta
+
+    def dead_slots(self, segment: int) -> Set[int]:
+        return self.store().get(f'dead:{segment}', set())
+
+    def dead_rows(self) -> Tuple[int, int]:
+        # the deleted and all the rows of the sealed segments, deleted rows stay in the column files until a vacuum
+        segments = self.load_meta()['segments']
+        return sum(len(self.dead_slots(segment)) for segment in range(len(segments))), \
+            sum(info['rows'] for info in segments)
+
+    def load_positions(self) -> Dict[str, Position]:
+        if self.state.positions is not None:
+            return self.state.positions
+        meta, positions = self.load_meta(), {}
+        for segment in range(len(meta['segments'])):
+            dead = self.dead_slots(segment)
+            for slot, key in enumerate(self.read_column(segment, self.names[self.key_index])):
+                if slot not in dead:
+                    positions[self.encode_key(key)] = (segment, slot)
+        tail_rows = 0
+        for page in range(SEGMENT_ROWS // TAIL_PAGE_ROWS + 1):
+            rows = self.tail_page(page)
+            for i, row in enumerate(rows):
+                if row is not None:
+                    positions[self.encode_key(row[self.key_index])] = (TAIL, page * TAIL_PAGE_ROWS + i)
+            tail_rows += len(rows)
+            if len(rows) < TAIL_PAGE_ROWS:
+                break
+        self.state.positions, self.state.tail_rows = positions, tail_rows
+        return positions
+
+    def tail_page(self, page: int) -> List[Optional[Tuple[Any, ...]]]:
+        # pages are reused after every seal, a page written before the last seal is empty
+        entry = self.store().get(f'tail:{page}')
+        if entry is None or entry[0] != self.load_meta()['seals']:
+            return []
+        return entry[1]
+
+    def write_tail_page(self, page: int, rows: List[Optional[Tuple[Any, ...]]]) -> None:
+        self.store()[f'tail:{page}'] = (self.load_meta()['seals'], rows)
+
+    def read_column(self, segment: int, field: str) -> List[Any]:
+        with self.state.lock:
+            values = self.state.decoded.get((field, segment))
+            if values is not None:
+                self.state.decoded.move_to_end((field, segment))
+                return values
+        info = self.load_meta()['segments'][segment]
+        kind, offset, length, extra = info['columns'][field]
+        values = decode_column(kind, self.state.read(self.column_path(field), offset, length), extra, info['rows'])
+        with self.state.lock:
+            self.state.decoded[(field, segment)] = values
+            while len(self.state.decoded) > DECODED_COLUMNS:
+                self.state.decoded.popitem(last=False)
+        return values
+
+    def make_row(self, values: Tuple[Any, ...]) -> Row:
+        return dict(zip(self.names, values))
+
+    def __len__(self) -> int:
+        return len(self.load_positions())
+
+    def __contains__(self, encoded_key: str) -> bool:
+        return encoded_key in self.load_positions()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.load_positions()))
+
+    def __getitem__(self, encoded_key: str) -> Row:
+        segment, slot = self.load_positions()[encoded_key]
+        if segment == TAIL:
+            page, i = divmod(slot, TAIL_PAGE_ROWS)
+            return self.make_row(self.tail_page(page)[i])
+        return {field: self.read_column(segment, field)[slot] for field in self.names}
+
+    def get(self, encoded_key: str, default: Any = None) -> Any:
+        try:
+            return self[encoded_key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, encoded_key: str, row: Row) -> None:
+        values = tuple(row.get(field) for field in self.names)
+        positions = self.load_positions()
+        position = positions.get(encoded_key)
+        if position is not None and position[0] == TAIL:  # changed in place
+            page, i = divmod(position[1], TAIL_PAGE_ROWS)
+            rows = list(self.tail_page(page))
+            rows[i] = values
+            self.write_tail_page(page, rows)
+            return
+        if position is not None:  # a sealed row is marked deleted and written again to the tail
+            self.delete_sealed(*position)
+        page, i = divmod(self.state.tail_rows, TAIL_PAGE_ROWS)
+        rows = list(self.tail_page(page)) if i else []
+        rows.append(values)
+        self.write_tail_page(page, rows)
+        positions[encoded_key] = (TAIL, self.state.tail_rows)
+        self.state.tail_rows += 1
+        if self.state.tail_rows >= SEGMENT_ROWS:
+            self.seal()
+
+    def __delitem__(self, encoded_key: str) -> None:
+        segment, slot = self.load_positions().pop(encoded_key)
+        if segment != TAIL:
+            self.delete_sealed(segment, slot)
+            return
+        page, i = divmod(slot, TAIL_PAGE_ROWS)
+        rows = list(self.tail_page(page))
+        rows[i] = None
+        self.write_tail_page(page, rows)
+
+    def delete_sealed(self, segment: int, slot: int) -> None:
+        dead = self.dead_slots(segment)
+        dead.add(slot)
+        self.store()[f'dead:{segment}'] = dead
+
+    def seal(self) -> None:
+        # the live tail rows become a new segment of every column, the tail pages are then free again
+        positions = self.load_positions()
+        rows = [row for page in range(-(-self.state.tail_rows // TAIL_PAGE_ROWS))
+                for row in self.tail_page(page) if row is not None]
+        meta = self.load_meta()
+        if rows:
+            columns = {}
+            for i, field in enumerate(self.fields):
+                kind, data, extra = encode_column(field.type, [row[i] for row in rows])
+                columns[field.name] = (kind, self.append_column(field.name, data), len(data), extra)
+            meta['segments'].append(dict(rows=len(rows), columns=columns))
+        meta['seals'] += 1
+        self.save_meta()
+        for slot, row in enumerate(rows):
+            positions[self.encode_key(row[self.key_index])] = (len(meta['segments']) - 1, slot)
+        self.state.tail_rows = 0
+
+    def append_column(self, field: str, data: bytes) -> int:
+        with open(self.column_path(field), 'ab') as file:
+            offset = file.tell()
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())  # on disk before the commit that points at it
+        return offset
+
+    def scan(self, matches: Callable[[Row], bool], criteria_fields: List[str],
+             fields: Optional[List[str]] = None) -> Iterator[Row]:
+        # only the columns of the criteria are read for every row, the other columns only for the rows that match
+        fields = self.names if fields is None else fields
+        meta = self.load_meta()
+        for segment, info in enumerate(meta['segments']):
+            dead = self.dead_slots(segment)
+            tested = {field: self.read_column(segment, field) for field in criteria_fields}
+            for slot in range(info['rows']):
+                if slot in dead:
+                    continue
+                if matches({field: values[slot] for field, values in tested.items()}):
+                    yield {field: self.read_column(segment, field)[slot] for field in fields}
+        self.load_positions()  # counts the tail rows
+        for page in range(-(-self.state.tail_rows // TAIL_PAGE_ROWS)):
+            for values in self.tail_page(page):
+                if values is not None:
+                    row = self.make_row(values)
+                    if matches(row):
+                        yield {field: row[field] for field in fields}
@@ -0,0 +1,91 @@
+import itertools
+import shelve
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Row = Dict[str, Any]
+Posting = Tuple[Any, Tuple[Any, ...]]  # the primary key and the included values of one row
+
+
+def composite_index_name(fields: List[str]) -> str:
+    return '+'.join(fields)
+
+
+class CompositeIndex:
+    # a hash index on several fields together: an entry is keyed by the repr of the tuple of their values and holds
+    # a (primary key, included values) posting per row, so the indexed fields, the key and the included columns of
+    # the rows are all read from the index alone. Rows with a None in an indexed field are not indexed
+    def __init__(self, fields: List[str], include: List[str], key_field_name: str,
+                 store: Callable[[], shelve.Shelf]):
+        self.fields = list(fields)
+        self.include = list(include)
+        self.key_field_name = key_field_name
+        self.store = store  # the handle may be closed by the pool between calls, so it is fetched every time
+
+    @property
+    def name(self) -> str:
+        return composite_index_name(self.fields)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(fields=self.fields, include=self.include)
+
+    def values_of(self, row: Row) -> Optional[Tuple[Any, ...]]:
+        values = tuple(row[field] for field in self.fields)
+        return None if any(value is None for value in values) else values
+
+    def posting(self, row: Row) -> Posting:
+        return row[self.key_field_name], tuple(row[field] for field in self.include)
+
+    def covers(self, fields: Iterable[str]) -> bool:
+        return set(fields) <= set(self.fields) | set(self.include) | {self.key_field_name}
+
+    def build(self, rows: Iterable[Row]) -> Dict[str, int]:
+        # the store must be empty; returns the entries and distinct counts of the index statistics
+        entries = {}
+        for row in rows:
+            values = self.values_of(row)
+            if values is not None:
+                entries.setdefault(repr(values), []).append(self.posting(row))
+        s = self.store()
+        for encoded_values, postings in entries.items():
+            s[encoded_values] = postings
+        return dict(entries=sum(len(postings) for postings in entries.values()), distinct=len(entries))
+
+    def update(self, changes: List[Tuple[Optional[Row], Optional[Row]]],
+               count: Callable[[List[Posting], List[Posting]], None]) -> None:
+        # changes are (old row, new row) pairs like DBTable.update_hash_indexes takes, every entry that changes is
+        # read and written once; count gets the old and new postings of each entry
+        removed, added = {}, {}
+        for old_row, new_row in changes:
+            old_values = self.values_of(old_row) if old_row is not None else None
+            new_values = self.values_of(new_row) if new_row is not None else None
+            if old_values == new_values and (old_values is None or self.posting(old_row) == self.posting(new_row)):
+                continue
+            if old_values is not None:
+                removed.setdefault(repr(old_values), set()).add(old_row[self.key_field_name])
+            if new_values is not None:
+                added.setdefault(repr(new_values), []).append(self.posting(new_row))
+        s = self.store()
+        for encoded_values in dict.fromkeys(itertools.chain(removed, added)):
+            old_postings = s.get(encoded_values, [])
+            gone = removed.get(encoded_values, ())
+            postings = [posting for posting in old_postings if posting[0] not in gone] + added.get(encoded_values, [])
+            count(old_postings, postings)
+            if postings:
+                s[encoded_values] = postings
+            elif old_postings:
+                del s[encoded_values]
+
+    def lookup(self, values: Dict[str, List[Any]]) -> Iterator[Tuple[Tuple[Any, ...], Posting]]:
+        # the postings of every combination of the given values of the indexed fields, with the combination
+        s = self.store()
+        for combination in itertools.product(*(dict.fromkeys(values[field]) for field in self.fields)):
+            for posting in s.get(repr(combination), []):
+                yield combination, posting
+
+    def rows(self, values: Dict[str, List[Any]]) -> Iterator[Row]:
+        # partial rows of the indexed fields, the key and the included columns
+        for combination, (key, included) in self.lookup(values):
+            row = dict(zip(self.fields, combination))
+            row.update(zip(self.include, included))
+            row[self.key_field_name] = key
+            yield row
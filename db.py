@@ -1,15 +1,89 @@
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Type
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type, Union
 from dataclasses_json import dataclass_json
 import db_api
+import postings
+from aggregates import AGGREGATES, aggregate_rows
+from bulk_io import WRITE_BUFFER_BYTES, Progress, format_of, read_rows, write_rows
+from columnar import ColumnState, ColumnStore
+from composite_index import CompositeIndex, composite_index_name
+from instrumentation import Instrumentation, measured
+from ordered_index import OrderedIndex
+from locks import DatabaseLock
+from join_engine import external_sort, join_tables, merge_joined, sort_key
+from parallel_scan import ParallelScanner
+from predicates import check_criterion, compile_criteria, default_selectivity
+from query_planner import IndexAccess, QueryPlan, choose_plan, key_plan
+from record_cache import RecordCache
+from shelf_pool import ShelfPool, fsync_file, remove_store, rename_store, store_files, stored_places, stored_values
+from snapshots import SnapshotStore, restore_snapshot, take_snapshot
+from table_stats import TableStats
+from transactions import Transaction, TransactionManager, WriteAheadLog
+from vacuum import DEFAULT_MIN_WASTE, DEFAULT_VACUUM_INTERVAL, DEFAULT_VACUUM_PAUSE, VACUUM_SUFFIX, BackgroundVacuum, \
+    Keep, Step, compact_store, dead_share, files_size, run_steps, stray_stores
 import shelve
+import atexit
+import copy
+import heapq
+import itertools
 import os
+import pickle
+import threading
 
 flag = False
 
 
 DB_ROOT = Path('db_files')
+STORAGE_VERSION = 3  # 1 - one pickled dict per table, 2 - one shelve entry per record, 3 - compact posting lists
+DEFAULT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 10_000  # dbm.dumb rewrites the whole key directory on every commit, fewer commits load faster
+INDEX_TYPES = ('hash', 'ordered')
+TABLE_STORAGES = ('row', 'columnar')  # one pickled dict per record, or typed column segments (columnar.py)
+RANGE_OPERATORS = ('=', '<', '<=', '>', '>=', 'between', 'startswith')
+
+
+def encode_key(key: Any) -> str:
+    # shelve keys must be strings, repr keeps keys of different types apart (1 != '1')
+    return repr(key)
+
+
+def table_path(table_name: str) -> str:
+    return os.path.join(DB_ROOT, table_name + '.db')
+
+
+def hash_index_path(table_name: str, field_name: str) -> str:
+    return os.path.join(DB_ROOT, table_name + '_' + field_name + '_hash_index.db')
+
+
+def ordered_index_path(table_name: str, field_name: str) -> str:
+    return os.path.join(DB_ROOT, table_name + '_' + field_name + '_ordered_index.db')
+
+
+def composite_index_path(table_name: str, index_name: str) -> str:
+    return os.path.join(DB_ROOT, table_name + '_' + index_name + '_composite_index.db')
+
+
+def catalog_path() -> str:
+    return os.path.join(DB_ROOT, 'DataBase.db')
+
+
+def wal_path() -> str:
+    return os.path.join(DB_ROOT, 'DataBase.wal')
+
+
+def column_path(table_name: str, field_name: str) -> str:
+    return os.path.join(DB_ROOT, table_name + '_' + field_name + '.col')
+
+
+def lock_path() -> str:
+    return os.path.join(DB_ROOT, 'DataBase.lock')
+
+
+def statistics_path() -> str:
+    return os.path.join(DB_ROOT, 'DataBase_stats.db')
+
 
 @dataclass_json
 @dataclass
@@ -24,338 +98,1357 @@ class SelectionCriteria(db_api.SelectionCriteria):
 @dataclass_json
 @dataclass
 class DBTable(db_api.DBTable):
-    def __init__(self, name: str, fields: List[DBField], key_field_name:  str, hash_index=None):
+    def __init__(self, name: str, fields: List[DBField], key_field_name:  str, hash_index=None, transactions=None,
+                 ordered_index=None, index_stats=None, scanner=None, storage='row'):
         self.name = name
         self.fields = fields
         self.key_field_name = key_field_name
         self.hash_index = hash_index if hash_index else [False for i in range(len(fields))]
+        self.ordered_index = ordered_index if ordered_index else [False for i in range(len(fields))]
+        self.transactions = transactions if transactions else DataBase.transactions
+        self.scanner = scanner if scanner else DataBase.scanner
+        self.instrumentation = self.transactions.instrumentation
+        self.storage = storage
+        self.columns = ColumnState()  # the columnar storage state kept between calls
+        self.ordered_indexes = {}  # field name -> OrderedIndex
+        self.composite_indexes = {}  # composite index name -> CompositeIndex
+        self.index_stats = index_stats if index_stats else {}  # hashed field or composite -> {'entries', 'distinct'}
+        self.table_stats = None  # TableStats, read from the catalog or counted on first use
+        self.statistics_changed = False
+        self.rollback_statistics = None  # the statistics when the transaction started, restored by a rollback
 
-    def __is_condition_hold(self, s: Dict[Any, Any], criterion: SelectionCriteria):
-        if None is s[criterion.field_name]:
-            return False
-        if criterion.operator == "=":
-            return s[criterion.field_name] == criterion.value
-        if criterion.operator == "!=":
-            return s[criterion.field_name] != criterion.value
-        if criterion.operator == "<":
-            return s[criterion.field_name] < criterion.value
-        if criterion.operator == ">":
-            return s[criterion.field_name] > criterion.value
-        if criterion.operator == "<=":
-            return s[criterion.field_name] <= criterion.value
-        if criterion.operator == ">=":
-            return s[criterion.field_name] >= criterion.value
-        return eval(f'{s[criterion.field_name]}{criterion.operator}{criterion.value}')
-
-    def count(self) -> int:
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        try:
-            count_rows = len(s[self.name].keys())
-        finally:
-            s.close()
-        return count_rows
+    def table_file(self) -> shelve.Shelf:
+        path = table_path(self.name)
+        if self.storage == 'columnar':
+            return ColumnStore(lambda: self.transactions.store(path), self.fields, self.key_field_name, self.columns,
+                               encode_key, lambda field: column_path(self.name, field))
+        return self.transactions.store(path)
+
+    def index_file(self, field: str) -> shelve.Shelf:
+        return self.transactions.store(hash_index_path(self.name, field))
+
+    def read_row(self, encoded_key: str) -> Optional[Dict[str, Any]]:
+        # reads by key go through the record cache, except inside a transaction that may have changed the row
+        if self.transactions.active() is not None or self.transactions.cache is None or self.storage != 'row':
+            return self.table_file().get(encoded_key)
+        path = table_path(self.name)
+        row = self.transactions.cache.get(path, encoded_key)
+        if row is not None:
+            return row
+        shelf = self.transactions.pool.get(path)
+        data = shelf.dict.get(encoded_key.encode(shelf.keyencoding))
+        if data is None:
+            return None
+        self.instrumentation.count(bytes_read=len(data))
+        row = pickle.loads(data)
+        self.transactions.cache.put(path, encoded_key, row, len(data))
+        return row
+
+    def ordered_index_of(self, field: str) -> OrderedIndex:
+        if field not in self.ordered_indexes:
+            path = ordered_index_path(self.name, field)
+            self.ordered_indexes[field] = OrderedIndex(lambda: self.transactions.store(path))
+        return self.ordered_indexes[field]
+
+    def composite_index_of(self, fields: List[str], include: List[str]) -> CompositeIndex:
+        path = composite_index_path(self.name, composite_index_name(fields))
+        return CompositeIndex(fields, include, self.key_field_name, lambda: self.transactions.store(path))
+
+    def catalog_file(self) -> shelve.Shelf:
+        return self.transactions.store(catalog_path())
+
+    @contextmanager
+    def write_transaction(self) -> Iterator[Transaction]:
+        # the table, all its indexes and its statistics change together or not at all
+        with self.transactions.transaction() as transaction:
+            if self.reset_cached_state not in transaction.rollback_hooks:  # the first write of the transaction
+                self.load_statistics()  # counted, if need be, before the transaction changes the files
+                self.rollback_statistics = self.table_stats.to_dict(), copy.deepcopy(self.index_stats)
+            transaction.on_rollback(self.reset_cached_state)
+            transaction.before_commit(self.commit_statistics)
+            yield transaction
+
+    def reset_cached_state(self) -> None:
+        # after a rollback the cached ordered index directories and statistics may be ahead of the files
+        # the statistics counted while reading since the last commit are only in memory, not in the statistics store
+        self.ordered_indexes = {}
+        table_stats, self.index_stats = self.rollback_statistics
+        self.table_stats = TableStats.from_dict(self.fields_names(), table_stats)
+        self.columns.reset()
+
+    def fields_names(self) -> List[str]:
+        return [field.name for field in self.fields]
+
+    @measured('count')
+    def count(self, criteria: Optional[List[SelectionCriteria]] = None) -> int:
+        with self.transactions.lock.read():
+            if not criteria:
+                return self.statistics_of().rows
+            self.check_criteria(criteria)
+            counted = self.count_from_index(criteria)
+            if counted is not None:
+                return counted
+            return sum(1 for _ in self.filtered_rows(criteria, fields=[]))
+
+    def count_from_index(self, criteria: List[SelectionCriteria]) -> Optional[int]:
+        # criteria that an index answers exactly are counted from its keys without reading a single row
+        field = criteria[0].field_name
+        if any(criterion.field_name != field for criterion in criteria):
+            return None
+        index = self.fields_names().index(field)
+        if len(criteria) == 1 and criteria[0].operator in ('=', 'in'):
+            values = criteria[0].value if criteria[0].operator == 'in' else [criteria[0].value]
+            if field == self.key_field_name:
+                s = self.table_file()
+                return sum(1 for value in dict.fromkeys(values) if encode_key(value) in s)
+            if self.hash_index[index]:
+                indexes_file = self.index_file(field)
+                return sum(postings.count(indexes_file.get(encode_key(value), []))
+                           for value in dict.fromkeys(values))
+        if self.ordered_index[index] and len(self.ordered_criteria(field, criteria)) == len(criteria):
+            return sum(1 for _ in self.ordered_index_of(field).range(**self.range_bounds(criteria)))
+        return None
+
+    @measured('aggregate')
+    def aggregate(self, function: str, field: Optional[str] = None,
+                  criteria: Optional[List[SelectionCriteria]] = None, group_by: Optional[str] = None,
+                  group_key: Optional[Callable[[Any], Any]] = None) -> Any:
+        # count, sum, min, max or avg of field over the rows matching criteria, folded while the rows are read;
+        # with group_by, {value: result} per value of that field, or per group_key(value) (e.g. a year of a date)
+        fields_names = self.fields_names()
+        if function not in AGGREGATES or (field is None and function != 'count'):
+            raise ValueError
+        if any(name is not None and name not in fields_names for name in (field, group_by)):
+            raise ValueError
+        criteria = criteria if criteria else []
+        with self.transactions.lock.read():
+            if group_by is None and field is None:
+                return self.count(criteria)
+            if group_by is None and not criteria and function in ('min', 'max') \
+                    and self.ordered_index[fields_names.index(field)]:  # the ends of the index
+                bounds = self.ordered_index_of(field).bounds()
+                return None if bounds is None else bounds[function == 'max']
+            read_fields = [name for name in fields_names if name in (field, group_by)]
+            return aggregate_rows(self.filtered_rows(criteria, read_fields), function, field, group_by, group_key)
+
+    def sum(self, field: str, criteria: Optional[List[SelectionCriteria]] = None) -> Any:
+        return self.aggregate('sum', field, criteria)
+
+    def min(self, field: str, criteria: Optional[List[SelectionCriteria]] = None) -> Any:
+        return self.aggregate('min', field, criteria)
+
+    def max(self, field: str, criteria: Optional[List[SelectionCriteria]] = None) -> Any:
+        return self.aggregate('max', field, criteria)
+
+    def avg(self, field: str, criteria: Optional[List[SelectionCriteria]] = None) -> Any:
+        return self.aggregate('avg', field, criteria)
+
+    def statistics_of(self) -> TableStats:
+        if self.table_stats is None:
+            self.table_stats = self.saved_table_stats(self.saved_statistics(self.catalog_file().get(self.name, {})))
+            if self.table_stats is None:  # a table from before the statistics were kept, counted once
+                s = self.table_file()
+                self.table_stats = TableStats.from_rows(self.fields_names(), (s[encoded_key] for encoded_key in s))
+                self.statistics_changed = True
+        return self.table_stats
+
+    def saved_statistics(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        # the statistics of the last commit that changed them; a table not written since they are kept in the
+        # statistics store still has them in its catalog entry
+        saved = self.transactions.store(statistics_path()).get(self.name)
+        return saved if saved is not None else entry
+
+    def saved_table_stats(self, saved: Dict[str, Any]) -> Optional[TableStats]:
+        if not saved.get("table_stats"):
+            return None
+        return TableStats.from_dict(self.fields_names(), saved["table_stats"])
+
+    def load_statistics(self) -> None:
+        self.statistics_of()
+        for field, indexed in zip(self.fields_names(), self.hash_index):
+            if indexed:
+                self.hash_index_stats(field)
+        for name in self.composite_indexes:
+            self.hash_index_stats(name)
+
+    def commit_statistics(self) -> None:
+        # the statistics commit with the writes that changed them, in the same WAL frame, so another process
+        # reloading the table reads the row count and the estimates of every commit
+        self.save_statistics()
+
+    def statistics(self) -> Dict[str, Any]:
+        # rows, and per field the nulls, an estimate of the distinct values and the min and max
+        with self.transactions.lock.read():
+            return self.statistics_of().summary()
+
+    @measured('analyze')
+    def analyze(self) -> Dict[str, Any]:
+        # counts the statistics again, the distinct estimates and the bounds then forget the deleted values
+        with self.write_transaction():
+            s = self.table_file()
+            self.table_stats = TableStats.from_rows(self.fields_names(), (s[encoded_key] for encoded_key in s))
+            self.statistics_changed = True
+            return self.table_stats.summary()
+
+    def hash_index_stats(self, field: str) -> Dict[str, int]:
+        if field not in self.index_stats:  # not saved in the catalog yet, count it once
+            indexes_file = self.composite_indexes[field].store() if field in self.composite_indexes \
+                else self.index_file(field)
+            counts = [postings.count(indexes_file[value]) for value in indexes_file]
+            self.index_stats[field] = dict(entries=sum(counts), distinct=sum(1 for keys in counts if keys))
+            self.statistics_changed = True
+        return self.index_stats[field]
+
+    def count_in_hash_index(self, field, old_count, new_count):
+        stats = self.hash_index_stats(field)
+        stats['entries'] += new_count - old_count
+        stats['distinct'] += bool(new_count) - bool(old_count)
+        self.statistics_changed = True
+
+    def change_hash_index(self, field, value, removed, added):
+        indexes_file = self.index_file(field)
+        old_entry = indexes_file.get(value, [])
+        entry = postings.update(old_entry, removed, added)
+        old_count, new_count = postings.count(old_entry), postings.count(entry)
+        if old_count == new_count and not added:  # the keys were not in the entry
+            return
+        self.count_in_hash_index(field, old_count, new_count)
+        if new_count:
+            indexes_file[value] = entry
+        elif old_count:
+            del indexes_file[value]
+
+    def add_to_hash_index(self, field, value, key):
+        self.change_hash_index(field, encode_key(value), (), [key])
+
+    def remove_from_hash_index(self, field, value, key):
+        self.change_hash_index(field, encode_key(value), {key}, [])
 
     def insert_into_hash_index(self, values):
         for i in range(len(self.hash_index)):  # update hash index
-            if self.hash_index[i]:
-                indexes_file = shelve.open(
-                    os.path.join('db_files', self.name + '_' + self.fields[i].name + '_hash_index.db'), writeback=True)
-                if values.get(self.fields[i].name):
-                    indexes_file[values[self.fields[i].name]].append(values[self.key_field_name])
-                indexes_file.close()
+            if self.hash_index[i] and values.get(self.fields[i].name) is not None:
+                self.add_to_hash_index(self.fields[i].name, values[self.fields[i].name], values[self.key_field_name])
 
-    def insert_record(self, values: Dict[str, Any]) -> None:
-        has_primary_key = True if values.get(self.key_field_name) else False
-        if not has_primary_key:
+    def insert_into_ordered_index(self, row):
+        for i in range(len(self.ordered_index)):
+            if self.ordered_index[i] and row[self.fields[i].name] is not None:
+                self.ordered_index_of(self.fields[i].name).insert(row[self.fields[i].name], row[self.key_field_name])
+
+    def delete_from_ordered_index(self, row):
+        for i in range(len(self.ordered_index)):
+            if self.ordered_index[i] and row[self.fields[i].name] is not None:
+                self.ordered_index_of(self.fields[i].name).remove(row[self.fields[i].name], row[self.key_field_name])
+
+    def make_row(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.get(self.key_field_name) is None:
+            raise ValueError
+        fields_names = self.fields_names()
+        if any(field not in fields_names for field in values):  # insert unnecessary field
             raise ValueError
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        indexes_file = shelve.open(os.path.join('db_files', self.name + '_index.db'), writeback=True)
+        return {field: values.get(field) for field in fields_names}
 
-        try:
-            is_record_exists = True if s[self.name].get(values[self.key_field_name]) else False
-            if is_record_exists:
+    @measured('insert_record')
+    def insert_record(self, values: Dict[str, Any]) -> None:
+        row = self.make_row(values)
+        with self.write_transaction():
+            s = self.table_file()
+            if encode_key(row[self.key_field_name]) in s:
                 raise ValueError
+            s[encode_key(row[self.key_field_name])] = row
+            self.statistics_of().add(row)
+            self.statistics_changed = True
+            self.insert_into_hash_index(row)
+            self.update_composite_indexes([(None, row)])
+            self.insert_into_ordered_index(row)
+
+    @measured('insert_records')
+    def insert_records(self, records: Iterable[Dict[str, Any]], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        if batch_size < 1:
+            raise ValueError
+        records = iter(records)  # read batch_size records at a time, so a generator is never materialized
+        inserted = 0
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return inserted
+            self.insert_batch(batch)
+            inserted += len(batch)
 
-            s[self.name][values[self.key_field_name]] = {}
+    def insert_batch(self, batch: List[Dict[str, Any]]) -> None:
+        with self.write_transaction():  # the whole batch is one commit
+            rows = {}
+            s = self.table_file()
+            for values in batch:  # validate the whole batch before writing any of it
+                row = self.make_row(values)
+                encoded_key = encode_key(row[self.key_field_name])
+                if encoded_key in rows or encoded_key in s:
+                    raise ValueError
+                rows[encoded_key] = row
 
-            for dbfield in self.fields:
-                field = dbfield.name
-                if field == self.key_field_name:
+            stats = self.statistics_of()
+            for encoded_key, row in rows.items():
+                s[encoded_key] = row
+                stats.add(row)
+            self.statistics_changed = True
+
+            self.update_hash_indexes([(None, row) for row in rows.values()])
+            self.update_composite_indexes([(None, row) for row in rows.values()])
+            self.update_ordered_indexes([(None, row) for row in rows.values()])
+
+    def update_hash_indexes(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) -> None:
+        # changes are (old row, new row) pairs, None for an insert or a delete; each posting list that changes is
+        # read and written once, however many rows change it
+        for i in range(len(self.hash_index)):
+            if not self.hash_index[i]:
+                continue
+            field = self.fields[i].name
+            removed, added = {}, {}
+            for old_row, new_row in changes:
+                if old_row is not None and new_row is not None and old_row[field] == new_row[field]:
                     continue
-                s[self.name][values[self.key_field_name]][field] = values[field] if values.get(field) else None
-                values.pop(field)
-            if 1 < len(values): # insert unnecessary field
-                self.delete_record(values[self.key_field_name])
-                raise ValueError
+                if old_row is not None and old_row[field] is not None:
+                    removed.setdefault(encode_key(old_row[field]), set()).add(old_row[self.key_field_name])
+                if new_row is not None and new_row[field] is not None:
+                    added.setdefault(encode_key(new_row[field]), []).append(new_row[self.key_field_name])
+            for value in dict.fromkeys(itertools.chain(removed, added)):
+                self.change_hash_index(field, value, removed.get(value, ()), added.get(value, []))
 
-            self.insert_into_hash_index(values)
-        finally:
-            s.close()
-            indexes_file.close()
+    def update_composite_indexes(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) \
+            -> None:
+        for index in self.composite_indexes.values():
+            index.update(changes, lambda old_postings, new_postings, name=index.name:
+                         self.count_in_hash_index(name, len(old_postings), len(new_postings)))
 
-    def delete_from_hash_index(self, s, key):
+    def update_ordered_indexes(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) \
+            -> None:
+        # changes as for update_hash_indexes; each page that changes is read and written once
+        for i in range(len(self.ordered_index)):
+            if not self.ordered_index[i]:
+                continue
+            field = self.fields[i].name
+            removed, added = [], []
+            for old_row, new_row in changes:
+                if old_row is not None and new_row is not None and old_row[field] == new_row[field]:
+                    continue
+                if old_row is not None and old_row[field] is not None:
+                    removed.append((old_row[field], old_row[self.key_field_name]))
+                if new_row is not None and new_row[field] is not None:
+                    added.append((new_row[field], new_row[self.key_field_name]))
+            if removed or added:
+                self.ordered_index_of(field).update(removed, added)
+
+    def delete_from_hash_index(self, row):
         for i in range(len(self.hash_index)):
-            if self.hash_index[i]:
-                if s[self.name][key][self.fields[i].name]:
-                    indexes_file = shelve.open(
-                        os.path.join('db_files', self.name + '_' + self.fields[i].name + '_hash_index.db'),
-                        writeback=True)
-                    indexes_file[s[self.name][key][self.fields[i].name]].remove(key)
-                    indexes_file.close()
+            if self.hash_index[i] and row.get(self.fields[i].name) is not None:
+                self.remove_from_hash_index(self.fields[i].name, row[self.fields[i].name], row[self.key_field_name])
 
+    @measured('delete_record')
     def delete_record(self, key: Any) -> None:
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        try:
-            is_key_exist = True if s[self.name].get(key) else False
-            if not is_key_exist:
+        with self.write_transaction():
+            s = self.table_file()
+            row = s.get(encode_key(key))
+            if row is None:
                 raise ValueError
+            del s[encode_key(key)]
+            self.statistics_of().remove(row)
+            self.statistics_changed = True
+            self.delete_from_hash_index(row)
+            self.update_composite_indexes([(row, None)])
+            self.delete_from_ordered_index(row)
 
-            self.delete_from_hash_index(s, key)
-            s[self.name].pop(key)
-        finally:
-            s.close()
-
-    def delete_records(self, criteria: List[SelectionCriteria]) -> None:
-        list_to_delete = self.query_table(criteria)
-        for row in list_to_delete:
-            key = row[self.key_field_name]
-            self.delete_record(key)
+    @measured('delete_records')
+    def delete_records(self, criteria: List[SelectionCriteria]) -> int:
+        # one pass over the table, then every index is changed once for all the rows; returns the rows deleted
+        with self.write_transaction():
+            rows = list(self.filtered_rows(criteria))
+            s = self.table_file()
+            stats = self.statistics_of()
+            for row in rows:
+                del s[encode_key(row[self.key_field_name])]
+                stats.remove(row)
+            self.statistics_changed = True
+            self.update_hash_indexes([(row, None) for row in rows])
+            self.update_composite_indexes([(row, None) for row in rows])
+            self.update_ordered_indexes([(row, None) for row in rows])
+            return len(rows)
 
+    @measured('get_record', returned=lambda row: 1)
     def get_record(self, key: Any) -> Dict[str, Any]:
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        try:
-            is_key_exist = True if s[self.name].get(key) else False
-            if not is_key_exist:
-                raise ValueError
-
-            row = s[self.name][key]
-        finally:
-            s.close()
-        row[self.key_field_name] = key
+        with self.transactions.lock.read():
+            row = self.read_row(encode_key(key))
+        if row is None:
+            raise ValueError
         return row
 
-    def update_hash_index(self, s, values, key, field):
-        indexes_file = shelve.open(os.path.join('db_files', self.name + '_' + field + '_hash_index.db'), writeback=True)
-        indexes_file[s[self.name][key][field]].remove(key)
-        if values[field]:
-            if None is indexes_file.get(values[field]):
-                indexes_file[values[field]] = list()
-            indexes_file[values[field]].append(key)
-        indexes_file.close()
+    def update_hash_index(self, old_row, new_row, field):
+        if old_row[field] == new_row[field]:
+            return
+        key = old_row[self.key_field_name]
+        if old_row[field] is not None:
+            self.remove_from_hash_index(field, old_row[field], key)
+        if new_row[field] is not None:
+            self.add_to_hash_index(field, new_row[field], key)
 
+    def check_update(self, values: Dict[str, Any]) -> None:
+        if self.key_field_name in values:  # cannot update the primary key
+            raise ValueError
+        fields_names = self.fields_names()
+        if any(field not in fields_names for field in values):  # insert unnecessary field
+            raise ValueError
+
+    @measured('update_record')
     def update_record(self, key: Any, values: Dict[str, Any]) -> None:
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        try:
-            is_key_exist = True if s[self.name].get(key) else False
-            if not is_key_exist:
-                raise ValueError
-            if values.get(self.key_field_name): # cannot update the primary key
+        self.check_update(values)
+        with self.write_transaction():
+            s = self.table_file()
+            old_row = s.get(encode_key(key))
+            if old_row is None:
                 raise ValueError
-            updated_row = {}
-            for dbfield in self.fields:
-                field = dbfield.name
-                if field == self.key_field_name:
-                    continue
+            updated_row = dict(old_row)
+            updated_row.update(values)
+            s[encode_key(key)] = updated_row
+            self.statistics_of().remove(old_row)
+            self.statistics_of().add(updated_row)
+            self.statistics_changed = True
+
+            for i in range(len(self.hash_index)):
+                if self.hash_index[i]:
+                    self.update_hash_index(old_row, updated_row, self.fields[i].name)
+            self.update_composite_indexes([(old_row, updated_row)])
+            self.update_ordered_indexes([(old_row, updated_row)])
+
+    @measured('update_records')
+    def update_records(self, criteria: List[SelectionCriteria], values: Dict[str, Any]) -> int:
+        # like delete_records, one pass and every index changed once; returns the rows that matched
+        self.check_update(values)
+        with self.write_transaction():
+            changes = [(row, dict(row, **values)) for row in self.filtered_rows(criteria)]
+            s = self.table_file()
+            stats = self.statistics_of()
+            for old_row, new_row in changes:
+                s[encode_key(old_row[self.key_field_name])] = new_row
+                stats.remove(old_row)
+                stats.add(new_row)
+            self.statistics_changed = True
+            self.update_hash_indexes(changes)
+            self.update_composite_indexes(changes)
+            self.update_ordered_indexes(changes)
+            return len(changes)
 
-                if values.get(field):
-                    index = self.fields.index(dbfield)
-                    if self.hash_index[index]:
-                        self.update_hash_index(s, values, key, field)
-                    updated_row[field] = values[field]
-                    values.pop(field)
+    def query_on_key(self, criterion):
+        values = criterion.value if criterion.operator == 'in' else [criterion.value]
+        rows = (self.read_row(encode_key(value)) for value in dict.fromkeys(values))
+        return [row for row in rows if row is not None]
 
-                else:
-                    updated_row[field] = s[self.name][key][field]
+    def key_criterion(self, criteria: List[SelectionCriteria]) -> Optional[SelectionCriteria]:
+        for criterion in criteria:
+            if criterion.field_name == self.key_field_name and criterion.operator in ('=', 'in'):
+                return criterion
+        return None
 
-            if values: # insert unnecessary field
+    def check_criteria(self, criteria: List[SelectionCriteria]) -> None:
+        fields_names = self.fields_names()
+        for criterion in criteria:
+            if criterion.field_name not in fields_names:  # if this field isn't exist
                 raise ValueError
-            s[self.name][key] = updated_row
-        finally:
-            s.close()
+            check_criterion(criterion)
+
+    def selectivity(self, criterion: SelectionCriteria) -> float:
+        index = self.fields_names().index(criterion.field_name)
+        if criterion.operator in ('=', 'in') and self.hash_index[index]:
+            stats = self.hash_index_stats(criterion.field_name)
+            table_rows = self.count()
+            if stats['distinct'] and table_rows:
+                values = len(criterion.value) if criterion.operator == 'in' else 1
+                return min(1.0, values * stats['entries'] / stats['distinct'] / table_rows)
+        estimated = self.statistics_of().selectivity(criterion)
+        return default_selectivity(criterion) if estimated is None else estimated
+
+    def compile(self, criteria: List[SelectionCriteria]) -> Callable[[Dict[str, Any]], bool]:
+        return compile_criteria(criteria, self.selectivity)
 
-    def query_on_key(self, s, criterion):
-        if s[self.name].get(criterion.value):
-            result = s[self.name][criterion.value]
-            result[self.key_field_name] = criterion.value
-            return [result]
-        return []
+    def ordered_criteria(self, field: str, criteria: List[SelectionCriteria]) -> List[SelectionCriteria]:
+        # the criteria on field its ordered index answers; only str values are ordered by their prefixes
+        is_str = self.fields[self.fields_names().index(field)].type is str
+        return [criterion for criterion in criteria if criterion.field_name == field
+                and criterion.operator in RANGE_OPERATORS
+                and (criterion.operator != 'startswith' or is_str and isinstance(criterion.value, str))]
 
-    def query_on_index(self, s, criteria):
-        indexes = []
-        for i in range(len(self.hash_index)):  # if the criterion is on a field that has an index
+    @staticmethod
+    def range_bounds(criteria: List[SelectionCriteria]) -> Dict[str, Any]:
+        # the narrowest range covering all the criteria, the rows are still checked against every criterion
+        low, low_inclusive, high, high_inclusive, prefix = None, True, None, True, None
+        for criterion in criteria:
+            if criterion.operator in ('=', '>=', '>'):
+                inclusive = criterion.operator != '>'
+                if low is None or criterion.value > low or (criterion.value == low and not inclusive):
+                    low, low_inclusive = criterion.value, inclusive
+            if criterion.operator in ('=', '<=', '<'):
+                inclusive = criterion.operator != '<'
+                if high is None or criterion.value < high or (criterion.value == high and not inclusive):
+                    high, high_inclusive = criterion.value, inclusive
+            if criterion.operator == 'between':
+                if low is None or criterion.value[0] > low:
+                    low, low_inclusive = criterion.value[0], True
+                if high is None or criterion.value[1] < high:
+                    high, high_inclusive = criterion.value[1], True
+            if criterion.operator == 'startswith':
+                prefix = criterion.value
+                if low is None or criterion.value > low:
+                    low, low_inclusive = criterion.value, True
+        return dict(low=low, high=high, low_inclusive=low_inclusive, high_inclusive=high_inclusive, prefix=prefix)
+
+    def plan_query(self, criteria: List[SelectionCriteria], fields: Optional[List[str]] = None) -> QueryPlan:
+        # fields are the fields the caller reads, None for whole rows
+        table_rows = self.count()
+        criterion = self.key_criterion(criteria)
+        if criterion is not None:
+            return key_plan(table_rows, len(criterion.value) if criterion.operator == 'in' else 1)
+
+        candidates = []
+        for i in range(len(self.fields)):
+            field = self.fields[i].name
             if self.hash_index[i]:
-                if indexes:
-                    break
                 for criterion in criteria:
-                    if self.fields[i].name == criterion.field_name and criterion.operator == "=":
-                        indexes_file = shelve.open(
-                            os.path.join('db_files', self.name + '_' + criterion.field_name + '_hash_index.db'),
-                            writeback=True)
-                        indexes = indexes_file[criterion.value]
-                        indexes_file.close()
-                        if not indexes:
-                            return [], True
+                    if criterion.field_name == field and criterion.operator in ('=', 'in'):
+                        stats = self.hash_index_stats(field)
+                        estimated_rows = stats['entries'] / stats['distinct'] if stats['distinct'] else 0
+                        if criterion.operator == 'in':
+                            estimated_rows *= len(criterion.value)
+                        candidates.append(IndexAccess(field, 'hash', [criterion], estimated_rows))
                         break
-        desired_lines = []
-        if indexes:
-            for index in indexes:
-                for criterion in criteria:
-                    if self.__is_condition_hold(s[self.name][index], criterion) is False:
-                        break
-                else:
-                    result = s[self.name][index]
-                    result[self.key_field_name] = index
-                    desired_lines.append(result)
-            return desired_lines, True
+            if self.ordered_index[i]:
+                field_criteria = self.ordered_criteria(field, criteria)
+                if field_criteria:
+                    estimated_rows = self.ordered_index_of(field).estimate(**self.range_bounds(field_criteria))
+                    candidates.append(IndexAccess(field, 'ordered', field_criteria, estimated_rows))
+        for index in self.composite_indexes.values():
+            candidates.extend(self.composite_access(index, criteria, fields))
+        return choose_plan(table_rows, candidates)
+
+    def composite_access(self, index: CompositeIndex, criteria: List[SelectionCriteria],
+                         fields: Optional[List[str]]) -> List[IndexAccess]:
+        # usable when every field of the index has an equality criterion; covering when the index also has the
+        # fields of the other criteria and every field the caller reads
+        index_criteria = []
+        for field in index.fields:
+            for criterion in criteria:
+                if criterion.field_name == field and criterion.operator in ('=', 'in'):
+                    index_criteria.append(criterion)
+                    break
+            else:
+                return []
+        stats = self.hash_index_stats(index.name)
+        estimated_rows = stats['entries'] / stats['distinct'] if stats['distinct'] else 0
+        for criterion in index_criteria:
+            if criterion.operator == 'in':
+                estimated_rows *= len(criterion.value)
+        covering = fields is not None and index.covers(fields) \
+            and index.covers(criterion.field_name for criterion in criteria)
+        return [IndexAccess(index.name, 'composite', index_criteria, estimated_rows, covering)]
+
+    @staticmethod
+    def composite_values(access: IndexAccess) -> Dict[str, List[Any]]:
+        return {criterion.field_name: criterion.value if criterion.operator == 'in' else [criterion.value]
+                for criterion in access.criteria}
+
+    def explain(self, criteria: List[SelectionCriteria], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        with self.transactions.lock.read():
+            return self.plan_query(criteria, fields).to_dict()
 
-        return desired_lines, False
+    def index_keys(self, access: IndexAccess) -> List[Any]:
+        if access.index_type == 'hash':
+            criterion, indexes_file = access.criteria[0], self.index_file(access.field_name)
+            if criterion.operator == 'in':
+                return [key for value in dict.fromkeys(criterion.value)
+                        for key in postings.decode(indexes_file.get(encode_key(value), []))]
+            return postings.decode(indexes_file.get(encode_key(criterion.value), []))
+        if access.index_type == 'composite':
+            index = self.composite_indexes[access.field_name]
+            return [key for _, (key, _) in index.lookup(self.composite_values(access))]
+        return list(self.ordered_index_of(access.field_name).range(**self.range_bounds(access.criteria)))
 
+    @measured('query_table', returned=len)
     def query_table(self, criteria: List[SelectionCriteria]) \
             -> List[Dict[str, Any]]:
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        try:
-            for criterion in criteria: # if the criterion is on key
-                if criterion.field_name == self.key_field_name and criterion.operator == '=':
-                    return self.query_on_key(s, criterion)
+        with self.transactions.lock.read():
+            return list(self.filtered_rows(criteria))
 
-            desired_lines, is_query_on_index = self.query_on_index(s, criteria)
-            if is_query_on_index:
-                return desired_lines
+    def filtered_rows(self, criteria: List[SelectionCriteria], fields: Optional[List[str]] = None) \
+            -> Iterator[Dict[str, Any]]:
+        # fields is a hint, a columnar scan or a covering index then only gives those fields and the criteria fields
+        self.check_criteria(criteria)
+        matches = self.compile(criteria)
+        plan = self.plan_query(criteria, fields)
+        event = self.instrumentation.current()  # None unless the operation is measured
+        if event is not None:
+            event.access, event.indexes = plan.access, [access.field_name for access in plan.indexes]
+            if plan.access == 'scan' and (self.storage == 'columnar' or self.scanner.enabled_for(plan.table_rows)):
+                event.rows_examined += plan.table_rows
+        if plan.access == 'key':
+            rows = self.query_on_key(self.key_criterion(criteria))
+        elif plan.access == 'covering':  # the table file is not even opened
+            access = plan.indexes[0]
+            rows = self.composite_indexes[access.field_name].rows(self.composite_values(access))
+        elif plan.access == 'scan' and self.storage == 'columnar':
+            criteria_fields = list(dict.fromkeys(criterion.field_name for criterion in criteria))
+            yield from self.table_file().scan(matches, criteria_fields, fields)
+            return
+        elif plan.access == 'scan' and self.scanner.enabled_for(plan.table_rows) \
+                and not self.transactions.has_writes(table_path(self.name)):  # the workers only see the files
+            yield from self.parallel_rows(criteria)  # the workers check the criteria
+            return
+        elif plan.access == 'scan':
+            rows = self.scanned_rows(self.table_file(), event)
+        else:  # the keys of the most selective index, kept only if every other chosen index has them too
+            keys = self.index_keys(plan.indexes[0])
+            for access in plan.indexes[1:]:
+                other_keys = set(self.index_keys(access))
+                keys = [key for key in keys if key in other_keys]
+            rows = (self.read_row(encode_key(key)) for key in keys)
 
-            for row in s[self.name]:
-                for criterion in criteria:
-                    if criterion.field_name == self.key_field_name:  # condition on key
-                        if self.__is_condition_hold({criterion.field_name: row}, criterion) is False:
-                            break
+        for row in rows:
+            if event is not None:
+                event.rows_examined += 1
+            if matches(row):
+                yield row
 
-                    elif s[self.name][row].get(criterion.field_name) is None:  # if this key isn't exist
-                        raise ValueError
+    @staticmethod
+    def scanned_rows(s: shelve.Shelf, event) -> Iterator[Dict[str, Any]]:
+        # the pickled size of the rows is counted when the operation is measured
+        if not isinstance(s, shelve.Shelf):  # a transaction's view of the table
+            return (s[encoded_key] for encoded_key in s)
+        if event is None:
+            return map(pickle.loads, stored_values(s))
+        return (event_counted_row(event, data) for data in stored_values(s))
 
-                    elif self.__is_condition_hold(s[self.name][row], criterion) is False:
-                        break
+    def parallel_rows(self, criteria: List[SelectionCriteria]) -> Iterator[Dict[str, Any]]:
+        # the workers read the places of the values in the data file, so they never parse the key directory
+        s = self.transactions.pool.get(table_path(self.name))
+        places = stored_places(s)
+        if places is None:
+            matches = self.compile(criteria)
+            yield from (row for row in self.scanned_rows(s, None) if matches(row))
+            return
+        yield from self.scanner.scan(s.dict._datfile, places, sorted(criteria, key=self.selectivity))
 
-                else:
-                    result = s[self.name][row]
-                    result[self.key_field_name] = row
-                    desired_lines.append(result)
-        finally:
-            s.close()
-        return desired_lines
+    def iter_query(self, criteria: List[SelectionCriteria], fields: Optional[List[str]] = None,
+                   limit: Optional[int] = None, order_by: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        # rows are read one at a time as the caller consumes them; order_by is a field name, '-field' for descending
+        fields_names = self.fields_names()
+        if fields is not None and any(field not in fields_names for field in fields):
+            raise ValueError
+        if limit is not None and limit < 0:
+            raise ValueError
+        if order_by is not None and order_by.lstrip('-') not in fields_names:
+            raise ValueError
+        self.check_criteria(criteria)
+
+        rows = self.instrumentation.measure_rows(self.name, 'iter_query', self.locked_rows(
+            lambda: self.filtered_rows(criteria, fields) if order_by is None
+            else self.ordered_rows(criteria, order_by, limit)))
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+        if fields is None:
+            return rows
+        return ({field: row[field] for field in fields} for row in rows)
+
+    def locked_rows(self, rows: Callable[[], Iterable[Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+        # like a cursor, the read lock is held from the first row until the rows are consumed or closed
+        with self.transactions.lock.read():
+            yield from rows()
+
+    def ordered_rows(self, criteria: List[SelectionCriteria], order_by: str, limit: Optional[int]) \
+            -> Iterator[Dict[str, Any]]:
+        descending, field = order_by.startswith('-'), order_by.lstrip('-')
+        index = self.fields_names().index(field)
+        if not descending and self.ordered_index[index]:  # already sorted, nothing has to be held in memory
+            field_criteria = self.ordered_criteria(field, criteria)
+            keys = self.ordered_index_of(field).range(**self.range_bounds(field_criteria))
+            rows = (self.read_row(encode_key(key)) for key in keys)
+            without_value = (row for row in self.filtered_rows(criteria) if row[field] is None)
+            matches = self.compile(criteria)
+            return itertools.chain((row for row in rows if matches(row)), without_value)
 
-    def is_field_exist(self, s, field_to_index):
-        for row in s[self.name]:  # if the field_to_index isn't exist(just 1 iteration)
-            if None is s[self.name][row].get(field_to_index):
-                return False
-            break
-        return True
+        key = sort_key(field, descending)
+        if limit is not None:
+            return iter(heapq.nsmallest(limit, self.filtered_rows(criteria), key=key))
+        return (row for _, row in external_sort((key(row), row) for row in self.filtered_rows(criteria)))
 
-    def create_index(self, field_to_index: str) -> None:
-        if field_to_index == self.key_field_name: # no need to index the primary key
+    def join_lookup(self, fields: List[str], criteria: List[SelectionCriteria]) \
+            -> Optional[Callable[[Any], List[Dict[str, Any]]]]:
+        # rows with a given join field value that match the criteria, if an index can find them
+        if len(fields) != 1:
+            return None
+        field = fields[0]
+        index = self.fields_names().index(field)
+        matches = self.compile(criteria)
+        if field == self.key_field_name:
+            def lookup(value):
+                row = self.read_row(encode_key(value))
+                return [row] if row is not None and matches(row) else []
+        elif self.hash_index[index]:
+            def lookup(value):
+                keys = postings.decode(self.index_file(field).get(encode_key(value), []))
+                rows = (self.read_row(encode_key(key)) for key in keys)
+                return [row for row in rows if matches(row)]
+        elif self.ordered_index[index]:
+            def lookup(value):
+                rows = (self.read_row(encode_key(key)) for key in self.ordered_index_of(field).range(value, value))
+                return [row for row in rows if matches(row)]
+        else:
+            return None
+        return lookup
+
+    @measured('create_index')
+    def create_index(self, field_to_index: Union[str, List[str]], index_type: str = 'hash',
+                     include: Optional[List[str]] = None) -> None:
+        # several fields, or included fields, make a composite hash index (composite_index.py)
+        if index_type not in INDEX_TYPES:
+            raise ValueError
+        if not isinstance(field_to_index, str):
+            if len(field_to_index) == 1 and not include:
+                field_to_index = field_to_index[0]
+            elif index_type != 'hash':
+                raise ValueError
+            else:
+                return self.create_composite_index(list(field_to_index), list(include) if include else [])
+        elif include:
+            if index_type != 'hash':
+                raise ValueError
+            return self.create_composite_index([field_to_index], list(include))
+        if field_to_index == self.key_field_name and index_type == 'hash': # no need to hash index the primary key
             return
 
-        fields_names = [field.name for field in self.fields]
+        fields_names = self.fields_names()
+        if field_to_index not in fields_names:
+            raise ValueError
         index = fields_names.index(field_to_index)
 
-        is_index_exist = True if self.hash_index[index] else False
-        if is_index_exist:
-            return
+        with self.transactions.lock.write():  # another process may be building the same index
+            indexed = self.hash_index if index_type == 'hash' else self.ordered_index
+            is_index_exist = True if indexed[index] else False
+            if is_index_exist:
+                return
 
-        s = shelve.open(os.path.join('db_files', self.name + '.db'), writeback=True)
-        indexes_file = shelve.open(os.path.join('db_files', self.name + '_' + field_to_index + '_hash_index.db'), writeback=True)
-        data_file = shelve.open(os.path.join('db_files', 'DataBase' + '.db'), writeback=True)
-        try:
-            if not self.is_field_exist(s, field_to_index):
-                raise ValueError
+            if index_type == 'hash':
+                self.build_hash_index(field_to_index)
+            else:
+                self.build_ordered_index(field_to_index)
+            indexed[index] = True
+            self.save_indexes()
 
-            for row in s[self.name]:
-                if None is s[self.name][row][field_to_index]:
-                    continue
-                if None is indexes_file.get(s[self.name][row][field_to_index]):
-                    indexes_file[s[self.name][row][field_to_index]] = list()
-                indexes_file[s[self.name][row][field_to_index]].append(row)
+    def save_indexes(self) -> None:
+        catalog = self.catalog_file()
+        entry = catalog[self.name]
+        entry["hash_index"] = self.hash_index
+        entry["ordered_index"] = self.ordered_index
+        entry["composite_indexes"] = [index.to_dict() for index in self.composite_indexes.values()]
+        catalog[self.name] = entry
+        self.transactions.checkpoint()  # the indexes are written outside a transaction, and older catalog
+        # entries in the log must not be replayed over this one
+
+    @contextmanager
+    def indexes_deferred(self) -> Iterator[None]:
+        # the indexes are dropped, and built again from the whole table when the block ends, which is much faster
+        # than changing them row by row for a large load; a crash in between leaves the table without the indexes,
+        # never with wrong ones. Readers wait for the write lock until the indexes are back
+        hashed = [field.name for field, indexed in zip(self.fields, self.hash_index) if indexed]
+        ordered = [field.name for field, indexed in zip(self.fields, self.ordered_index) if indexed]
+        composite = [(index.fields, index.include) for index in self.composite_indexes.values()]
+        with self.transactions.lock.write():
+            if not hashed and not ordered and not composite:
+                yield
+                return
+            self.hash_index = [False for field in self.fields]
+            self.ordered_index = [False for field in self.fields]
+            self.composite_indexes = {}
+            self.save_indexes()
+            try:
+                yield
+            finally:
+                for field in hashed:
+                    self.create_index(field)
+                for field in ordered:
+                    self.create_index(field, 'ordered')
+                for fields, include in composite:
+                    self.create_index(fields, include=include)
+
+    def create_composite_index(self, fields: List[str], include: List[str]) -> None:
+        fields_names = self.fields_names()
+        if not fields or any(field not in fields_names for field in fields + include):
+            raise ValueError
+        if len(set(fields + include)) != len(fields + include) or self.key_field_name in include:
+            raise ValueError
 
-            data_file[self.name]["hash_index"][index] = True
-            self.hash_index[index] = True
+        with self.transactions.lock.write():  # another process may be building the same index
+            name = composite_index_name(fields)
+            if name in self.composite_indexes:
+                if self.composite_indexes[name].include != include:  # the same fields with other included fields
+                    raise ValueError
+                return
+
+            index = self.composite_index_of(fields, include)
+            self.clear_index_file(composite_index_path(self.name, name))
+            s = self.table_file()
+            self.index_stats[name] = index.build(s[encoded_key] for encoded_key in s)
+            self.statistics_changed = True
+            self.composite_indexes[name] = index
+            self.save_indexes()
+
+    def build_ordered_index(self, field_to_index: str) -> None:
+        self.clear_index_file(ordered_index_path(self.name, field_to_index))
+        self.ordered_indexes.pop(field_to_index, None)
+        s = self.table_file()
+        pairs = []
+        for encoded_key in s:
+            row = s[encoded_key]
+            if row[field_to_index] is not None:
+                pairs.append((row[field_to_index], row[self.key_field_name]))
+        self.ordered_index_of(field_to_index).build(pairs)
+
+    def build_hash_index(self, field_to_index: str) -> None:
+        self.clear_index_file(hash_index_path(self.name, field_to_index))
+        s = self.table_file()
+        entries = {}
+        for encoded_key in s:
+            row = s[encoded_key]
+            if None is row[field_to_index]:
+                continue
+            entries.setdefault(encode_key(row[field_to_index]), []).append(row[self.key_field_name])
+        indexes_file = self.index_file(field_to_index)
+        for value, keys in entries.items():
+            indexes_file[value] = postings.encode(keys)
+        self.index_stats[field_to_index] = dict(entries=sum(len(keys) for keys in entries.values()),
+                                                distinct=len(entries))
+        self.statistics_changed = True
+
+    def clear_index_file(self, path: str) -> None:
+        # an index is built from scratch, leftovers of an older index on the same field must not survive
+        self.transactions.pool.discard(path)
+        remove_store(path)
+
+    def load_entry(self, entry: Dict[str, Any]) -> None:
+        # the catalog entry may have been changed by another process
+        self.fields = entry["fields"]
+        self.key_field_name = entry["key_field_name"]
+        self.hash_index = list(entry.get("hash_index") or [False for field in self.fields])
+        self.ordered_index = list(entry.get("ordered_index") or [False for field in self.fields])
+        saved = self.saved_statistics(entry)
+        self.index_stats = dict(saved.get("index_stats") or {})
+        self.table_stats = self.saved_table_stats(saved)
+        self.storage = entry.get("storage", 'row')
+        self.ordered_indexes = {}
+        self.composite_indexes = {}
+        for index in entry.get("composite_indexes") or []:
+            index = self.composite_index_of(index["fields"], index["include"])
+            self.composite_indexes[index.name] = index
+        self.statistics_changed = False
+        self.columns.reset()
+
+    def vacuum_stores(self) -> List[Tuple[str, Optional[Keep]]]:
+        # the stores of the table, with what decides which of their entries a vacuum keeps
+        paths = table_stores(self.name, self.fields, self.hash_index, self.ordered_index,
+                             [index.fields for index in self.composite_indexes.values()])
+        return [(path, has_postings if path.endswith(('_hash_index.db', '_composite_index.db')) else None)
+                for path in paths]
+
+    def vacuum_columns(self, min_waste: float) -> Optional[Step]:
+        # deleted rows stay in the column files, so the live rows are written again into new ones; when too few of
+        # them are dead only the shelve store is compacted. Under the write lock
+        path = table_path(self.name)
+        paths = [path] + [column_path(self.name, field.name) for field in self.fields]
+        bytes_before = sum(map(files_size, paths))
+        dead, rows = self.table_file().dead_rows()
+        if dead and dead / rows >= min_waste:
+            self.rewrite_columns()
+        else:
+            share = dead_share(self.transactions.pool.get(path))
+            if share == 0 or share < min_waste:
+                return None
+            self.transactions.pool.discard(path)
+            compact_store(path)
+        return dict(path=path, bytes_before=bytes_before, bytes_after=sum(map(files_size, paths)),
+                    entries_dropped=dead, removed=False)
+
+    def rewrite_columns(self) -> None:
+        path, new_path = table_path(self.name), table_path(self.name) + VACUUM_SUFFIX
+        new_columns = {field.name: column_path(self.name, field.name) + VACUUM_SUFFIX for field in self.fields}
+        for new_store_path in [new_path] + list(new_columns.values()):
+            remove_store(new_store_path)
+        new_file = shelve.open(new_path, 'n')
+        try:
+            new_store = ColumnStore(lambda: new_file, self.fields, self.key_field_name, ColumnState(), encode_key,
+                                    new_columns.__getitem__)
+            for row in self.table_file().scan(lambda row: True, []):
+                new_store[encode_key(row[self.key_field_name])] = row
         finally:
-            s.close()
-            indexes_file.close()
+            new_file.close()
+        for file in store_files(new_path):
+            fsync_file(file)
+        self.columns.reset()  # unmaps the column files
+        self.transactions.pool.discard(path)
+        rename_store(new_path, path)
+        for field, new_column in new_columns.items():
+            remove_store(column_path(self.name, field))
+            if os.path.exists(new_column):  # no sealed segment, no column file
+                os.rename(new_column, column_path(self.name, field))
+
+    def save_statistics(self) -> None:
+        # in a store of their own, a write does not pickle the catalog entry again
+        if not self.statistics_changed or self.name not in self.catalog_file():
+            return
+        self.transactions.store(statistics_path())[self.name] = dict(
+            table_stats=self.table_stats.to_dict() if self.table_stats is not None else None,
+            index_stats=self.index_stats)
+        self.statistics_changed = False
+
+
+def table_stores(table_name: str, fields: List[DBField], hash_index: List[bool], ordered_index: List[bool],
+                 composite_indexes: List[List[str]], storage: str = 'row') -> List[str]:
+    # the paths of every store of a table: its rows, its indexes and its column files
+    return [table_path(table_name)] + \
+        [hash_index_path(table_name, field.name) for field, indexed in zip(fields, hash_index) if indexed] + \
+        [ordered_index_path(table_name, field.name) for field, indexed in zip(fields, ordered_index) if indexed] + \
+        [composite_index_path(table_name, composite_index_name(index_fields)) for index_fields in composite_indexes] + \
+        [column_path(table_name, field.name) for field in fields if storage == 'columnar']
+
+
+def has_postings(data: bytes) -> bool:
+    # an emptied hash or composite index entry is left out by a vacuum
+    return postings.count(pickle.loads(data)) > 0
+
+
+def event_counted_row(event, data: bytes) -> Dict[str, Any]:
+    event.bytes_read += len(data)
+    return pickle.loads(data)
+
+
+def save_tables_statistics() -> None:
+    # statistics counted while reading are kept in memory, a write transaction saves them with its commit
+    tables = [table for table in DataBase.db_tables.values() if table is not None]
+    if not any(table.statistics_changed for table in tables):
+        return
+    with DataBase.transactions.transaction():
+        for table in tables:
+            table.save_statistics()
+
+
+def close_tables() -> None:
+    if DataBase.background_vacuum is not None:  # before the lock, the store being rewritten is finished first
+        DataBase.background_vacuum.stop()
+        DataBase.background_vacuum = None
+    if not os.path.isdir(DB_ROOT):  # nothing to write back
+        return
+    with DataBase.lock.write():
+        save_tables_statistics()
+        DataBase.transactions.checkpoint()
+        DataBase.handle_pool.close()
+        DataBase.record_cache.clear()
+    DataBase.wal.close()
+
+
+def load_tables() -> None:
+    # only the table names are read, a table is loaded by its first get_table (None until then); tables that are
+    # already loaded keep their DBTable object, so references held by the caller stay valid
+    s = DataBase.handle_pool.get(catalog_path())
+    with DataBase.catalog_lock:
+        for table_name in s:
+            entry = s[table_name] if DataBase.db_tables.get(table_name) is not None else None
+            if entry is None or entry.get("version", 1) < STORAGE_VERSION:  # replaced by an older table
+                DataBase.db_tables[table_name] = None
+            else:
+                DataBase.db_tables[table_name].load_entry(entry)
+        for table_name in [table_name for table_name in DataBase.db_tables if table_name not in s]:
+            DataBase.db_tables.pop(table_name)
+
+
+def load_table(table_name: str, migrate: bool = False) -> Optional[DBTable]:
+    # None when the table is older than STORAGE_VERSION and migrate is False, migrating needs the write lock
+    with DataBase.catalog_lock:
+        if table_name not in DataBase.db_tables:
+            raise ValueError
+        if DataBase.db_tables[table_name] is None:
+            s = DataBase.handle_pool.get(catalog_path())
+            entry = s[table_name]
+            if entry.get("version", 1) < STORAGE_VERSION:
+                if not migrate:
+                    return None
+                entry = s[table_name] = migrate_table(table_name, entry, DataBase.transactions)
+                DataBase.handle_pool.sync(catalog_path())
+            table = DBTable(table_name, entry["fields"], entry["key_field_name"], transactions=DataBase.transactions)
+            table.load_entry(entry)
+            DataBase.db_tables[table_name] = table
+        return DataBase.db_tables[table_name]
+
+
+def reload_tables() -> None:
+    # another process wrote since this one last held the lock, so the open handles and cached rows are stale
+    DataBase.handle_pool.forget()
+    DataBase.record_cache.clear()
+    load_tables()
+
+
+def migrate_table(table_name: str, entry: Dict[str, Any], transactions: TransactionManager) -> Dict[str, Any]:
+    if entry.get("version", 1) < 2:
+        return migrate_rows(table_name, entry, transactions)
+    # version 2 hash indexes hold plain lists of keys
+    for field, is_indexed in zip(entry["fields"], entry.get("hash_index") or []):
+        if is_indexed:
+            compact_hash_index(hash_index_path(table_name, field.name), transactions)
+    entry = dict(entry)
+    entry["version"] = STORAGE_VERSION
+    return entry
+
+
+def compact_hash_index(path: str, transactions: TransactionManager) -> None:
+    transactions.pool.discard(path)
+    indexes_file = shelve.open(path)
+    try:
+        for value in list(indexes_file):
+            entry = indexes_file[value]
+            if not postings.is_compact(entry):
+                indexes_file[value] = postings.encode(entry)
+    finally:
+        indexes_file.close()
+
+
+def migrate_rows(table_name: str, entry: Dict[str, Any], transactions: TransactionManager) -> Dict[str, Any]:
+    # version 1 tables keep all the rows in one dict under s[table_name], without the key field
+    old_path, new_path = table_path(table_name), table_path(table_name) + '_migrating'
+    transactions.pool.discard(old_path)
+    transactions.cache.invalidate_store(old_path)
+    old_file = shelve.open(old_path, 'r')
+    new_file = shelve.open(new_path, 'n')
+    try:
+        for key, row in old_file.get(table_name, {}).items():
+            row = dict(row)
+            row[entry["key_field_name"]] = key
+            new_file[encode_key(key)] = row
+    finally:
+        old_file.close()
+        new_file.close()
+    rename_store(new_path, old_path)
+
+    entry = dict(entry)
+    entry["version"] = STORAGE_VERSION
+    entry["hash_index"] = entry.get("hash_index") or [False for field in entry["fields"]]
+    table = DBTable(table_name, entry["fields"], entry["key_field_name"], entry["hash_index"], transactions)
+    for field, is_indexed in zip(entry["fields"], entry["hash_index"]):  # version 1 indexes used the raw values as keys
+        if is_indexed:
+            table.build_hash_index(field.name)
+    return entry
 
 
 @dataclass_json
 @dataclass
 class DataBase(db_api.DataBase):
-    db_tables = {}
+    db_tables = {}  # table name -> DBTable, or None until the table is first used
+    catalog_lock = threading.RLock()  # threads loading tables from the catalog
+    handle_pool = ShelfPool()  # open table and index files, shared by all the tables
+    record_cache = RecordCache()  # rows read by key, shared by all the tables
+    scanner = ParallelScanner()  # off until DataBase(scan_workers=...) turns it on
+    wal = WriteAheadLog(wal_path())
+    lock = DatabaseLock(lock_path(), on_change=lambda: reload_tables())  # readers and writers of all the processes
+    instrumentation = Instrumentation(lambda: DataBase.handle_pool.opened)  # off until a sink is added
+    transactions = TransactionManager(handle_pool, wal, record_cache, lock, instrumentation)
+    background_vacuum = None  # BackgroundVacuum, from start_vacuum until stop_vacuum or close
 
-    def __init__(self):
-        s = shelve.open(os.path.join('db_files', 'DataBase' + '.db'), writeback=True)
-        for table_name in s:
-            DataBase.db_tables[table_name] = DBTable(table_name, s[table_name]["fields"], s[table_name]["key_field_name"])
+    def __init__(self, max_open_handles: Optional[int] = None, wal_mode: Optional[str] = None,
+                 cache_bytes: Optional[int] = None, scan_workers: Optional[int] = None,
+                 scan_threshold: Optional[int] = None):
+        close_tables()  # the files may have changed since the handles were opened
+        DB_ROOT.mkdir(parents=True, exist_ok=True)
+        self.handle_pool.resize(max_open_handles)
+        self.record_cache.resize(cache_bytes)
+        self.scanner.configure(scan_workers, scan_threshold)
+        self.wal.set_mode(wal_mode)
+        with self.lock.write():
+            self.transactions.recover()  # commits that were logged but not written to the table files before a crash
+            load_tables()
 
-    def update_DataBase_file(self, table_name, fields, key_field_name):
-        s = shelve.open(os.path.join('db_files', 'DataBase' + '.db'), writeback=True)
-        try:
-            s[table_name] = {}
-            s[table_name]["fields"] = fields
-            s[table_name]["key_field_name"] = key_field_name
-            s[table_name]['hash_index'] = [False for i in range(len(fields))]
-        finally:
-            s.close()
+    def transaction(self):
+        # every write in the block, on any table, is committed together or rolled back on an exception
+        return self.transactions.transaction()
+
+    def flush(self) -> None:
+        with self.lock.write():
+            save_tables_statistics()
+            self.transactions.checkpoint()
+
+    def close(self) -> None:
+        close_tables()
+
+    def snapshot(self, backup_root: str, name: Optional[str] = None, base: Optional[str] = None) -> Dict[str, Any]:
+        # a consistent backup taken while writes go on, storing only what changed since base (the latest snapshot
+        # by default); the writes only wait while the files written during the copy are read again
+        return take_snapshot(SnapshotStore(backup_root), str(DB_ROOT), self.quiesced, name, base)
+
+    @contextmanager
+    def quiesced(self) -> Iterator[None]:
+        # everything committed is in the table files, and stays there until the block ends
+        with self.lock.write():
+            save_tables_statistics()
+            self.transactions.checkpoint()
+            yield
+
+    def snapshots(self, backup_root: str) -> List[str]:
+        return SnapshotStore(backup_root).names()
+
+    def restore(self, backup_root: str, name: Optional[str] = None) -> Dict[str, Any]:
+        # the files are patched in place, only the chunks that differ from the snapshot are written
+        store = SnapshotStore(backup_root)
+        names = store.names()
+        if name is None and not names:
+            raise ValueError
+        with self.lock.write():
+            self.transactions.checkpoint()  # nothing in the log may be replayed over the restored files
+            self.handle_pool.close()
+            self.record_cache.clear()
+            for table in DataBase.db_tables.values():
+                if table is not None:
+                    table.columns.reset()  # unmaps the column files
+            report = restore_snapshot(store, str(DB_ROOT), name if name else names[-1])
+            reload_tables()
+        return report
+
+    @measured('vacuum')
+    def vacuum(self, table_name: Optional[str] = None, min_waste: float = 0.0) -> Dict[str, Any]:
+        # rewrites the files of the table (of every table and the catalog by default) without the space of deleted
+        # and overwritten values and without emptied index entries, and removes the files of dropped indexes;
+        # files with a smaller share of dead bytes than min_waste are left alone. Each file is rewritten under the
+        # write lock on its own, so readers wait for one file at a time and never see one half written
+        return run_steps(self.vacuum_steps(table_name, min_waste))
+
+    def start_vacuum(self, interval: float = DEFAULT_VACUUM_INTERVAL, min_waste: float = DEFAULT_MIN_WASTE,
+                     pause: float = DEFAULT_VACUUM_PAUSE) -> BackgroundVacuum:
+        # vacuums every table in a background thread every interval seconds, a file at a time with pause seconds
+        # between them; the reclaimed space adds up in the report stop_vacuum returns
+        if DataBase.background_vacuum is not None:
+            raise ValueError
+        self.vacuum_steps(None, min_waste)  # checks the arguments
+        DataBase.background_vacuum = BackgroundVacuum(lambda: self.vacuum_steps(None, min_waste), interval, pause)
+        return DataBase.background_vacuum.start()
 
+    def stop_vacuum(self) -> Dict[str, Any]:
+        if DataBase.background_vacuum is None:
+            raise ValueError
+        background_vacuum, DataBase.background_vacuum = DataBase.background_vacuum, None
+        return background_vacuum.stop()
+
+    def vacuum_steps(self, table_name: Optional[str], min_waste: float) -> Iterator[Step]:
+        # the arguments are checked right away, the files are then rewritten one per step as the steps are taken
+        if not 0 <= min_waste < 1 or self.transactions.active() is not None:
+            raise ValueError
+        names = self.get_tables_names()
+        if table_name is not None and table_name not in names:
+            raise ValueError
+        return self.vacuum_files([table_name] if table_name is not None else names, table_name is None, min_waste)
+
+    def vacuum_files(self, table_names: List[str], everything: bool, min_waste: float) -> Iterator[Step]:
+        for table_name in table_names:
+            try:
+                table = self.get_table(table_name)
+            except ValueError:  # deleted meanwhile
+                continue
+            for path, keep in table.vacuum_stores():
+                step = self.vacuum_store(path, keep, min_waste, table)
+                if step is not None:
+                    yield step
+        if everything:
+            for path in (catalog_path(), statistics_path()):
+                step = self.vacuum_store(path, None, min_waste)
+                if step is not None:
+                    yield step
+            yield from self.remove_stray_stores()
+
+    def vacuum_store(self, path: str, keep: Optional[Keep], min_waste: float,
+                     table: Optional[DBTable] = None) -> Optional[Step]:
+        with self.lock.write():
+            if table is not None and DataBase.db_tables.get(table.name) is not table or not store_files(path):
+                return None  # the table or the index is gone
+            save_tables_statistics()
+            self.transactions.checkpoint()  # every commit is in the files, the log is not replayed over new ones
+            if table is not None and table.storage == 'columnar' and path == table_path(table.name):
+                return table.vacuum_columns(min_waste)
+            share = dead_share(self.handle_pool.get(path))
+            if share < min_waste or share == 0 and keep is None:  # empty index entries may take no extra space
+                return None
+            bytes_before = files_size(path)
+            self.handle_pool.discard(path)
+            entries_dropped = compact_store(path, keep)
+            return dict(path=path, bytes_before=bytes_before, bytes_after=files_size(path),
+                        entries_dropped=entries_dropped, removed=False)
+
+    def remove_stray_stores(self) -> List[Step]:
+        # the index and column files no table of the catalog uses
+        with self.lock.write():
+            catalog = self.transactions.store(catalog_path())
+            expected = set()
+            for table_name in catalog:
+                entry = catalog[table_name]
+                expected.update(table_stores(table_name, entry["fields"], entry.get("hash_index") or [],
+                                             entry.get("ordered_index") or [],
+                                             [index["fields"] for index in entry.get("composite_indexes") or []],
+                                             entry.get("storage", 'row')))
+            steps = []
+            for path in stray_stores(str(DB_ROOT), expected):
+                bytes_before = files_size(path)
+                self.handle_pool.discard(path)
+                remove_store(path)
+                steps.append(dict(path=path, bytes_before=bytes_before, bytes_after=0, entries_dropped=0,
+                                  removed=True))
+            return steps
+
+    def __enter__(self) -> 'DataBase':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def update_DataBase_file(self, table_name, fields, key_field_name, storage='row'):
+        entry = {}
+        entry["fields"] = fields
+        entry["key_field_name"] = key_field_name
+        entry['hash_index'] = [False for i in range(len(fields))]
+        entry['ordered_index'] = [False for i in range(len(fields))]
+        entry['composite_indexes'] = []
+        entry["table_stats"] = TableStats([field.name for field in fields]).to_dict()
+        entry["storage"] = storage
+        entry["version"] = STORAGE_VERSION
+        self.transactions.store(catalog_path())[table_name] = entry
+        saved_stats = self.transactions.store(statistics_path())
+        if table_name in saved_stats:  # of a table deleted before
+            del saved_stats[table_name]
+
+    @measured('create_table')
     def create_table(self,
                      table_name: str,
                      fields: List[DBField],
-                     key_field_name: str) -> DBTable:
+                     key_field_name: str,
+                     storage: str = 'row') -> DBTable:
         is_key_field_name_exist = True if key_field_name in [field.name for field in fields] else False
         if not is_key_field_name_exist:
             raise ValueError
-        is_table_exist = True if DataBase.db_tables.get(table_name) else False
-        if is_table_exist:
+        if storage not in TABLE_STORAGES:
             raise ValueError
+        with self.lock.write():  # another process may be creating the same table
+            is_table_exist = True if table_name in DataBase.db_tables else False
+            if is_table_exist:
+                raise ValueError
 
-        self.update_DataBase_file(table_name, fields, key_field_name)
-        s = shelve.open(os.path.join('db_files', table_name + '.db'), writeback=True)
-        try:
-            s[table_name] = {}
-        finally:
+            self.update_DataBase_file(table_name, fields, key_field_name, storage)
+            self.transactions.checkpoint()  # a replay of the log must not write old records into the new table
+            self.handle_pool.discard(table_path(table_name))
+            self.record_cache.invalidate_store(table_path(table_name))
+            s = shelve.open(table_path(table_name), 'n')
             s.close()
-        new_table = DBTable(table_name, fields, key_field_name)
-        DataBase.db_tables[table_name] = new_table
-        return new_table
+            for field in fields:
+                remove_store(column_path(table_name, field.name))
+            new_table = DBTable(table_name, fields, key_field_name, transactions=self.transactions, storage=storage)
+            DataBase.db_tables[table_name] = new_table
+            return new_table
 
     def num_tables(self) -> int:
-        return len(DataBase.db_tables)
+        with self.lock.read():  # picks up the tables created or deleted by other processes
+            return len(DataBase.db_tables)
 
     def get_table(self, table_name: str) -> DBTable:
-        if DataBase.db_tables.get(table_name):
-            return DataBase.db_tables[table_name]
-        raise ValueError
+        with self.lock.read():
+            table = load_table(table_name)
+        if table is None:  # an old table, migrated by its first get_table
+            with self.lock.write():
+                table = load_table(table_name, migrate=True)
+        return table
 
+    @measured('delete_table')
     def delete_table(self, table_name: str) -> None:
-        if None is DataBase.db_tables.get(table_name):
-            raise ValueError
-        s = shelve.open(os.path.join('db_files', 'DataBase.db'), writeback=True)
-        try:
-            for field in s[table_name]['fields']:
-                if s[table_name]["hash_index"][s[table_name]["fields"].index(field)]:
-
-                    a = (os.path.join('db_files', table_name + '_' + field.name + '_hash_index.db.bak'))
-                    os.remove(a)
-                    a = (os.path.join('db_files', table_name + '_' + field.name + '_hash_index.db.dat'))
-                    os.remove(a)
-                    a = (os.path.join('db_files', table_name + '_' + field.name + '_hash_index.db.dir'))
-                    os.remove(a)
-            s.pop(table_name)
-        finally:
-            s.close()
-        DataBase.db_tables.pop(table_name)
-        s = (os.path.join('db_files', table_name + ".db.bak"))
-        os.remove(s)
-        s = (os.path.join('db_files', table_name + ".db.dat"))
-        os.remove(s)
-        s = (os.path.join('db_files', table_name + ".db.dir"))
-        os.remove(s)
+        with self.lock.write():
+            if table_name not in DataBase.db_tables:
+                raise ValueError
+            self.transactions.checkpoint()  # a replay of the log must not bring back the deleted files
+            if DataBase.db_tables[table_name] is not None:
+                DataBase.db_tables[table_name].columns.reset()  # unmaps the column files
+            catalog = self.transactions.store(catalog_path())
+            paths = [composite_index_path(table_name, composite_index_name(index["fields"]))
+                     for index in catalog[table_name].get('composite_indexes') or []]
+            for field in catalog[table_name]['fields']:
+                paths += [hash_index_path(table_name, field.name), ordered_index_path(table_name, field.name),
+                          column_path(table_name, field.name)]
+            for path in paths:
+                self.handle_pool.discard(path)
+                remove_store(path)
+            del catalog[table_name]
+            self.handle_pool.sync(catalog_path())
+            saved_stats = self.transactions.store(statistics_path())
+            if table_name in saved_stats:
+                del saved_stats[table_name]
+            DataBase.db_tables.pop(table_name)
+            self.handle_pool.discard(table_path(table_name))
+            self.record_cache.invalidate_store(table_path(table_name))
+            remove_store(table_path(table_name))
 
     def get_tables_names(self) -> List[Any]:
-        return [db_table for db_table in DataBase.db_tables.keys()]
+        with self.lock.read():
+            return [db_table for db_table in DataBase.db_tables.keys()]
+
+    @measured('import_table', returned=lambda rows: rows)
+    def import_table(self, table_name: str, path: str, file_format: Optional[str] = None,
+                     fields: Optional[List[DBField]] = None, key_field_name: Optional[str] = None,
+                     batch_size: int = IMPORT_BATCH_SIZE, defer_indexes: bool = True,
+                     progress: Optional[Progress] = None) -> int:
+        # a CSV (with a header) or NDJSON file streamed into the table, batch_size rows per commit; the values are
+        # parsed by the field types. A missing table is created from fields and key_field_name. With defer_indexes
+        # the indexes are built once at the end (a small load into a big table is faster without). progress gets
+        # the rows and the file bytes loaded after every batch; on an error the batches before it stay loaded
+        file_format = format_of(path, file_format)
+        if batch_size < 1:
+            raise ValueError
+        if table_name in self.get_tables_names():
+            table = self.get_table(table_name)
+        elif fields is None or key_field_name is None:
+            raise ValueError
+        else:
+            table = self.create_table(table_name, fields, key_field_name)
+        imported = 0
+        with open(path, 'rb') as file, (table.indexes_deferred() if defer_indexes else nullcontext()):
+            rows = read_rows(file, file_format, {field.name: field.type for field in table.fields})
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    return imported
+                table.insert_batch([row for row, _ in batch])
+                imported += len(batch)
+                if progress is not None:
+                    progress(imported, batch[-1][1])
+
+    @measured('export_table', returned=lambda rows: rows)
+    def export_table(self, table_name: str, path: str, file_format: Optional[str] = None,
+                     criteria: Optional[List[SelectionCriteria]] = None, progress_rows: int = DEFAULT_BATCH_SIZE,
+                     progress: Optional[Progress] = None) -> int:
+        # the rows matching criteria streamed to a CSV or NDJSON file that import_table reads back; dates are ISO
+        # 8601 text, None is an empty CSV cell (read back as None, except for strings) or a JSON null
+        file_format = format_of(path, file_format)
+        table = self.get_table(table_name)
+        with open(path, 'wb', buffering=WRITE_BUFFER_BYTES) as file:
+            return write_rows(file, file_format, table.fields_names(), table.iter_query(criteria if criteria else []),
+                              progress, progress_rows)
+
+    @measured('query_multiple_tables', returned=len)
+    def query_multiple_tables(
+            self,
+            tables: List[str],
+            fields_and_values_list: List[List[SelectionCriteria]],
+            fields_to_join_by: List[str]
+    ) -> List[Dict[str, Any]]:
+        if not tables or len(tables) != len(fields_and_values_list) or len(set(tables)) != len(tables):
+            raise ValueError
+        db_tables = [self.get_table(table_name) for table_name in tables]
+        if any(field not in table.fields_names() for table in db_tables for field in fields_to_join_by):
+            raise ValueError
+        with self.transactions.lock.read():
+            joined = join_tables(db_tables, fields_and_values_list, fields_to_join_by)
+            return list(merge_joined(joined, db_tables, fields_to_join_by))
 
 
+atexit.register(close_tables)
@@ -0,0 +1,207 @@
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_SLOW_QUERY_SECONDS = 0.1
+SLOW_QUERIES_KEPT = 100
+
+logger = logging.getLogger('db')
+
+
+@dataclass
+class OperationEvent:
+    table: Optional[str]  # None for database operations and commits
+    operation: str
+    seconds: float = 0.0
+    rows_examined: int = 0  # rows read and checked against the criteria
+    rows_returned: int = 0
+    access: Optional[str] = None  # the plan: 'key', 'index', 'intersection' or 'scan'
+    indexes: List[str] = field(default_factory=list)  # fields whose index the plan used
+    bytes_read: int = 0  # pickled rows read from the table files, rows found in the record cache are not counted
+    bytes_written: int = 0  # pickled values committed
+    handles_opened: int = 0  # shelve.open calls of the handle pool
+    details: Dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class Measurement:
+    def __init__(self, instrumentation: 'Instrumentation', event: OperationEvent):
+        self.instrumentation = instrumentation
+        self.event = event
+        self.start = 0.0
+        self.handles = 0
+
+    def __enter__(self) -> OperationEvent:
+        self.instrumentation.local.event = self.event
+        self.handles = self.instrumentation.handles_opened()
+        self.start = time.perf_counter()
+        return self.event
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.event.seconds = time.perf_counter() - self.start
+        self.event.handles_opened += self.instrumentation.handles_opened() - self.handles
+        if exc_type is not None:
+            self.event.details['error'] = exc_type.__name__
+        self.instrumentation.local.event = None
+        self.instrumentation.emit(self.event)
+
+
+class NoMeasurement:
+    # instrumentation is off, or the operation is part of another one that is being measured
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+
+NO_MEASUREMENT = NoMeasurement()
+
+
+class Instrumentation:
+    # timings and counters of the operations, sent to every sink; without sinks measure() only checks a list
+    def __init__(self, handles_opened: Optional[Callable[[], int]] = None):
+        self.sinks = []
+        self.local = threading.local()  # the operation measured by each thread, nested operations add to it
+        self.handles_opened = handles_opened if handles_opened else lambda: 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks)
+
+    def add_sink(self, sink: Any) -> Any:
+        # a sink has a record(event) method, a plain callable is wrapped in a CallbackSink
+        if not hasattr(sink, 'record'):
+            sink = CallbackSink(sink)
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink: Any) -> None:
+        self.sinks = [other for other in self.sinks if other is not sink and getattr(other, 'callback', None) != sink]
+
+    def measure(self, table: Optional[str], operation: str, **details: Any):
+        if not self.sinks or self.current() is not None:
+            return NO_MEASUREMENT
+        return Measurement(self, OperationEvent(table, operation, details=details))
+
+    def measure_rows(self, table: Optional[str], operation: str, rows: Iterator[Any]) -> Iterator[Any]:
+        # like measure, for rows made while the caller consumes them: the event is only current while the next row
+        # is made, so what the caller does between two rows is not part of it; sent when the rows end or are closed
+        if not self.sinks or self.current() is not None:
+            yield from rows
+            return
+        event = OperationEvent(table, operation)
+        handles = self.handles_opened()
+        try:
+            while True:
+                self.local.event = event
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    event.seconds += time.perf_counter() - start
+                    self.local.event = None
+                event.rows_returned += 1
+                yield row
+        finally:
+            event.handles_opened = self.handles_opened() - handles
+            self.emit(event)
+
+    def current(self) -> Optional[OperationEvent]:
+        if not self.sinks:
+            return None
+        return getattr(self.local, 'event', None)
+
+    def count(self, **counters: int) -> None:
+        event = self.current()
+        if event is not None:
+            for name, value in counters.items():
+                setattr(event, name, getattr(event, name) + value)
+
+    def emit(self, event: OperationEvent) -> None:
+        for sink in list(self.sinks):
+            sink.record(event)
+
+
+def measured(operation: str, returned: Optional[Callable[[Any], int]] = None):
+    # measures a method of an object with an instrumentation attribute; returned counts the rows of the result
+    def decorate(method):
+        @functools.wraps(method)
+        def measured_method(self, *args, **kwargs):
+            with self.instrumentation.measure(getattr(self, 'name', None), operation) as event:
+                result = method(self, *args, **kwargs)
+                if event is not None and returned is not None:
+                    event.rows_returned = returned(result)
+                return result
+        return measured_method
+    return decorate
+
+
+class CounterSink:
+    # totals per (table, operation), for dashboards and tests
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def record(self, event: OperationEvent) -> None:
+        with self.lock:
+            counters = self.counters.setdefault((event.table, event.operation), dict(
+                calls=0, seconds=0.0, rows_examined=0, rows_returned=0, bytes_read=0, bytes_written=0,
+                handles_opened=0, index_used=0))
+            counters['calls'] += 1
+            counters['index_used'] += bool(event.indexes) or event.access == 'key'
+            for name in ('seconds', 'rows_examined', 'rows_returned', 'bytes_read', 'bytes_written', 'handles_opened'):
+                counters[name] += getattr(event, name)
+
+    def snapshot(self) -> Dict[Tuple[Optional[str], str], Dict[str, Any]]:
+        with self.lock:
+            return {key: dict(counters) for key, counters in self.counters.items()}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {}
+
+
+class LogSink:
+    def __init__(self, log: Optional[logging.Logger] = None, level: int = logging.DEBUG):
+        self.log = log if log else logger
+        self.level = level
+
+    def record(self, event: OperationEvent) -> None:
+        if self.log.isEnabledFor(self.level):
+            self.log.log(self.level, 'db operation %s', event.to_dict())
+
+
+class CallbackSink:
+    def __init__(self, callback: Callable[[OperationEvent], None]):
+        self.callback = callback
+
+    def record(self, event: OperationEvent) -> None:
+        self.callback(event)
+
+
+class SlowQueryLog:
+    # operations that took at least threshold seconds, logged as warnings; the latest ones are kept in entries
+    def __init__(self, threshold: float = DEFAULT_SLOW_QUERY_SECONDS, log: Optional[logging.Logger] = None,
+                 keep: int = SLOW_QUERIES_KEPT):
+        if threshold < 0 or keep < 0:
+            raise ValueError
+        self.threshold = threshold
+        self.log = log if log else logger
+        self.entries = deque(maxlen=keep)
+
+    def record(self, event: OperationEvent) -> None:
+        if event.seconds < self.threshold:
+            return
+        self.entries.append(event)
+        self.log.warning('slow %s on %s: %.3f s, %d rows examined, %d returned, access %s',
+                         event.operation, event.table, event.seconds, event.rows_examined, event.rows_returned,
+                         event.access)
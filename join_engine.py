@@ -0,0 +1,193 @@
+import heapq
+import pickle
+import tempfile
+from collections import defaultdict
+from functools import total_ordering
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from query_planner import INDEX_LOOKUP_COST, ROW_FETCH_COST
+
+MAX_BUILD_ROWS = 100_000  # rows a hash join keeps in memory, larger inputs are joined by sorting runs on disk
+SORT_RUN_ROWS = 50_000  # rows sorted in memory before they are written to a temporary run file
+
+Joined = Dict[str, Dict[str, Any]]  # table name -> row
+
+
+def join_key(row: Dict[str, Any], fields: List[str]) -> Optional[Tuple[Any, ...]]:
+    values = tuple(row[field] for field in fields)
+    return None if any(value is None for value in values) else values  # None never joins
+
+
+def hash_join(left: Iterable[Joined], right_rows: Iterable[Dict[str, Any]], right_name: str,
+              fields: List[str], build_left: bool = False) -> Iterator[Joined]:
+    # builds a hash table on the smaller side and streams the other side through it
+    build = defaultdict(list)
+    if build_left:
+        for joined in left:
+            key = joined_key(joined, fields)
+            if key is not None:
+                build[key].append(joined)
+        for row in right_rows:
+            for joined in build.get(join_key(row, fields), ()):
+                yield {**joined, right_name: row}
+        return
+
+    for row in right_rows:
+        key = join_key(row, fields)
+        if key is not None:
+            build[key].append(row)
+    for joined in left:
+        for row in build.get(joined_key(joined, fields), ()):
+            yield {**joined, right_name: row}
+
+
+def index_nested_loop_join(left: Iterable[Joined], lookup: Callable[[Any], Iterable[Dict[str, Any]]],
+                           right_name: str, fields: List[str]) -> Iterator[Joined]:
+    # looks every left row up in the right table's index, only possible on a single join field
+    for joined in left:
+        key = joined_key(joined, fields)
+        if key is None:
+            continue
+        for row in lookup(key[0]):
+            yield {**joined, right_name: row}
+
+
+@total_ordering
+class Descending:
+    # sort key wrapper that reverses the order of the wrapped value
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __eq__(self, other: 'Descending') -> bool:
+        return self.value == other.value
+
+    def __lt__(self, other: 'Descending') -> bool:
+        return other.value < self.value
+
+    def __getstate__(self):
+        return self.value
+
+    def __setstate__(self, value):
+        self.value = value
+
+
+def sort_key(field: str, descending: bool = False) -> Callable[[Dict[str, Any]], Tuple[bool, Any]]:
+    # rows without a value come last in either direction
+    if descending:
+        return lambda row: (row[field] is None, Descending(row[field]))
+    return lambda row: (row[field] is None, row[field])
+
+
+def external_sort(items: Iterable[Tuple[Any, Any]], run_rows: int = SORT_RUN_ROWS) -> Iterator[Tuple[Any, Any]]:
+    # sorts (key, value) pairs by key holding at most run_rows of them in memory
+    runs, run = [], []
+    for item in items:
+        run.append(item)
+        if len(run) >= run_rows:
+            runs.append(write_run(run))
+            run = []
+    run.sort(key=itemgetter(0))
+    if not runs:
+        yield from run
+        return
+    try:
+        yield from heapq.merge(run, *[read_run(file) for file in runs], key=itemgetter(0))
+    finally:
+        for file in runs:
+            file.close()
+
+
+def write_run(run: List[Tuple[Any, Any]]):
+    run.sort(key=itemgetter(0))
+    file = tempfile.TemporaryFile()
+    for item in run:
+        pickle.dump(item, file, pickle.HIGHEST_PROTOCOL)
+    file.seek(0)
+    return file
+
+
+def read_run(file) -> Iterator[Tuple[Any, Any]]:
+    while True:
+        try:
+            yield pickle.load(file)
+        except EOFError:
+            return
+
+
+def sort_merge_join(left: Iterable[Joined], right_rows: Iterable[Dict[str, Any]], right_name: str,
+                    fields: List[str], run_rows: int = SORT_RUN_ROWS) -> Iterator[Joined]:
+    # both sides are sorted on disk, only the right rows of one join key are held in memory
+    left_sorted = external_sort(((key, joined) for joined in left
+                                 if (key := joined_key(joined, fields)) is not None), run_rows)
+    right_sorted = external_sort(((key, row) for row in right_rows
+                                  if (key := join_key(row, fields)) is not None), run_rows)
+    right_item = next(right_sorted, None)
+    group_key, group = None, []
+    for key, joined in left_sorted:
+        if key != group_key:
+            group_key, group = key, []
+            while right_item is not None and right_item[0] < key:
+                right_item = next(right_sorted, None)
+            while right_item is not None and right_item[0] == key:
+                group.append(right_item[1])
+                right_item = next(right_sorted, None)
+        for row in group:
+            yield {**joined, right_name: row}
+
+
+def joined_key(joined: Joined, fields: List[str]) -> Optional[Tuple[Any, ...]]:
+    # every table joined so far has the same values in the join fields
+    return join_key(next(iter(joined.values())), fields)
+
+
+def choose_join(left_rows: float, right_rows: float, right_cost: float, has_lookup: bool) -> str:
+    lookup_cost = left_rows * (INDEX_LOOKUP_COST + ROW_FETCH_COST * max(1.0, right_rows / max(left_rows, 1.0)))
+    if has_lookup and lookup_cost < right_cost:
+        return 'index'
+    if min(left_rows, right_rows) <= MAX_BUILD_ROWS:
+        return 'hash'
+    if has_lookup:
+        return 'index'
+    return 'merge'
+
+
+def join_tables(tables: List[Any], criteria_lists: List[List[Any]], fields: List[str]) -> Iterator[Joined]:
+    # greedy join order: start from the table with the fewest estimated rows and join the next smallest each time
+    plans = [table.plan_query(criteria) for table, criteria in zip(tables, criteria_lists)]
+    order = sorted(range(len(tables)), key=lambda i: plans[i].estimated_rows)
+    first = order[0]
+    joined = ({tables[first].name: row} for row in tables[first].filtered_rows(criteria_lists[first]))
+    joined_rows = plans[first].estimated_rows
+    for i in order[1:]:
+        table, criteria, plan = tables[i], criteria_lists[i], plans[i]
+        lookup = table.join_lookup(fields, criteria)
+        method = choose_join(joined_rows, plan.estimated_rows, plan.cost, lookup is not None)
+        if method == 'index':
+            joined = index_nested_loop_join(joined, lookup, table.name, fields)
+        elif method == 'hash':
+            joined = hash_join(joined, table.filtered_rows(criteria), table.name, fields,
+                               build_left=joined_rows <= plan.estimated_rows)
+        else:
+            joined = sort_merge_join(joined, table.filtered_rows(criteria), table.name, fields)
+        joined_rows = min(joined_rows, plan.estimated_rows)  # assumes the join fields are a key of one side
+    return joined
+
+
+def merge_joined(joined_rows: Iterable[Joined], tables: List[Any], fields: List[str]) -> Iterator[Dict[str, Any]]:
+    # flat rows; a field name used by more than one table (other than the join fields) becomes table.field
+    names = defaultdict(int)
+    for table in tables:
+        for field in table.fields:
+            names[field.name] += 1
+    for joined in joined_rows:
+        result = {}
+        for table in tables:
+            for field, value in joined[table.name].items():
+                if field in fields or names[field] == 1:
+                    result[field] = value
+                else:
+                    result[f'{table.name}.{field}'] = value
+        yield result
@@ -0,0 +1,127 @@
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows, the lock only coordinates the threads of one process there
+    fcntl = None
+
+GENERATION = struct.Struct('<Q')  # the lock file holds a counter that every writer increments
+
+
+class DatabaseLock:
+    # many readers or one writer, across the threads of this process (a condition variable) and across processes
+    # (flock on the lock file). Nested calls in a thread that already holds the lock do not lock again; a read lock
+    # cannot be upgraded to a write lock. on_change runs when the lock is taken after another process wrote.
+    def __init__(self, path: str, on_change: Optional[Callable[[], None]] = None):
+        self.path = path
+        self.on_change = on_change
+        self.condition = threading.Condition()
+        self.readers = 0  # threads of this process holding the read lock
+        self.writer = None  # thread holding the write lock
+        self.waiting_writers = 0  # waiting writers stop new readers, so a writer is not starved
+        self.local = threading.local()
+        self.fd = None
+        self.generation = None  # the counter when this process last held the lock
+
+    def depth(self, mode: str) -> int:
+        return getattr(self.local, mode, 0)
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        # every exit counts down, the lock is released by the last one: cursors of a thread may be closed in any
+        # order. A read nested in a write holds no read lock of its own
+        if not self.depth('reads') and not self.depth('writes'):
+            with self.condition:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+                if self.readers == 0:
+                    self.lock_file(shared=True)
+                self.readers += 1
+            self.local.shared = True
+        self.local.reads = self.depth('reads') + 1
+        try:
+            yield
+        finally:
+            self.local.reads -= 1
+            if not self.local.reads and getattr(self.local, 'shared', False):
+                self.local.shared = False
+                with self.condition:
+                    self.readers -= 1
+                    if self.readers == 0:
+                        self.unlock_file()
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        if self.depth('writes'):
+            self.local.writes += 1
+            try:
+                yield
+            finally:
+                self.local.writes -= 1
+            return
+        if self.depth('reads'):
+            raise RuntimeError('cannot write while holding the read lock')
+
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = threading.get_ident()
+        try:
+            self.lock_file(shared=False)
+        except BaseException:
+            self.release_writer()
+            raise
+        self.local.writes = 1
+        try:
+            yield
+        finally:
+            self.local.writes = 0
+            try:
+                self.set_generation(self.generation + 1)
+                self.unlock_file()
+            finally:
+                self.release_writer()
+
+    def release_writer(self) -> None:
+        with self.condition:
+            self.writer = None
+            self.condition.notify_all()
+
+    def lock_file(self, shared: bool) -> None:
+        # the file is opened for every lock, so a lock file that was removed is simply created again
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            generation = self.read_generation()
+            if self.generation is not None and generation != self.generation and self.on_change is not None:
+                self.on_change()
+            self.generation = generation
+        except BaseException:
+            self.unlock_file()
+            raise
+
+    def unlock_file(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def read_generation(self) -> int:
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        data = os.read(self.fd, GENERATION.size)
+        return GENERATION.unpack(data)[0] if len(data) == GENERATION.size else 0
+
+    def set_generation(self, generation: int) -> None:
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, GENERATION.pack(generation))
+        self.generation = generation
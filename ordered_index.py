@@ -0,0 +1,194 @@
+import shelve
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+PAGE_SIZE = 256
+AVERAGE_PAGE_FILL = 0.7  # pages are split when full, so they are between half and fully used
+DIRECTORY_KEY = 'directory'
+DIRECTORY_CHANGES_KEY = 'directory_changes'
+MAX_DIRECTORY_CHANGES = 64  # changes logged after the saved directory before the whole directory is saved again
+NEXT_PAGE_KEY = 'next_page'
+
+
+def first_value(pair: Tuple[Any, Any]) -> Any:
+    return pair[0]
+
+
+class OrderedIndex:
+    # a two level B+ tree over a shelve store: sorted pages of (value, key) pairs and a directory of
+    # [first pair, page id] entries, so a lookup is a bisect on the directory, one page read and a bisect on the page
+    def __init__(self, store: Callable[[], shelve.Shelf]):
+        self.store = store  # the handle may be closed by the pool between calls, so it is fetched every time
+        self.directory = None  # cached [first pair, page id] entries
+        self.first_pairs = None  # the first pairs of the directory, what a lookup bisects
+        self.changes = None  # the directory changes since it was saved whole
+
+    def load_directory(self) -> List[List[Any]]:
+        if self.directory is None:
+            s = self.store()
+            self.directory = s.get(DIRECTORY_KEY, [])
+            self.first_pairs = [first for first, _ in self.directory]
+            self.changes = s.get(DIRECTORY_CHANGES_KEY, [])
+            for change in self.changes:
+                self.apply_change(change)
+        return self.directory
+
+    def save_directory(self) -> None:
+        s = self.store()
+        s[DIRECTORY_KEY] = self.directory
+        self.first_pairs = [first for first, _ in self.directory]
+        self.changes = []
+        if DIRECTORY_CHANGES_KEY in s:
+            del s[DIRECTORY_CHANGES_KEY]
+
+    def apply_change(self, change: Tuple[Any, ...]) -> None:
+        operation, position, *entry = change
+        if operation == 'insert':
+            self.directory.insert(position, list(entry))
+            self.first_pairs.insert(position, entry[0])
+        elif operation == 'first':
+            self.directory[position][0] = self.first_pairs[position] = entry[0]
+        else:
+            self.directory.pop(position)
+            self.first_pairs.pop(position)
+
+    def change_directory(self, *change: Any) -> None:
+        # a split or a new first pair only writes the small list of changes, which is folded into the directory
+        # once it is long enough
+        self.apply_change(change)
+        self.changes.append(change)
+        if len(self.changes) >= MAX_DIRECTORY_CHANGES:
+            self.save_directory()
+        else:
+            self.store()[DIRECTORY_CHANGES_KEY] = self.changes
+
+    def new_page_id(self) -> int:
+        s = self.store()
+        page_id = s.get(NEXT_PAGE_KEY, 0)
+        s[NEXT_PAGE_KEY] = page_id + 1
+        return page_id
+
+    def read_page(self, page_id: int) -> List[Tuple[Any, Any]]:
+        return self.store()[f'page:{page_id}']
+
+    def write_page(self, page_id: int, page: List[Tuple[Any, Any]]) -> None:
+        self.store()[f'page:{page_id}'] = page
+
+    def find_page(self, item: Tuple[Any, ...]) -> int:
+        # position in the directory of the page that should hold item
+        return max(0, bisect_right(self.first_pairs, item) - 1)
+
+    def build(self, pairs: Iterable[Tuple[Any, Any]]) -> None:
+        pairs = sorted(pairs)
+        self.directory = []
+        for start in range(0, len(pairs), PAGE_SIZE // 2):  # half full pages leave room for inserts
+            page = pairs[start:start + PAGE_SIZE // 2]
+            page_id = self.new_page_id()
+            self.write_page(page_id, page)
+            self.directory.append([page[0], page_id])
+        self.save_directory()
+
+    def insert(self, value: Any, key: Any) -> None:
+        self.update([], [(value, key)])
+
+    def remove(self, value: Any, key: Any) -> None:
+        self.update([(value, key)], [])
+
+    def update(self, removed: Iterable[Tuple[Any, Any]], added: Iterable[Tuple[Any, Any]]) -> None:
+        # the pairs are grouped by page, so each page touched is read and written once however many pairs it gets;
+        # the pages are changed from the last one, the directory positions of the others stay valid meanwhile
+        self.load_directory()
+        for position, items in sorted(self.pages_of(removed).items(), reverse=True):
+            page_id = self.directory[position][1]
+            page = self.read_page(page_id)
+            size = len(page)
+            for item in items:
+                i = bisect_left(page, item)
+                if i < len(page) and page[i] == item:
+                    page.pop(i)
+            if len(page) < size:
+                self.rewrite_page(position, page_id, page)
+        added = sorted(added)
+        if added and not self.directory:
+            page_id = self.new_page_id()
+            self.change_directory('insert', 0, added[0], page_id)
+            self.rewrite_page(0, page_id, added)
+            return
+        for position, items in sorted(self.pages_of(added).items(), reverse=True):
+            page_id = self.directory[position][1]
+            page = self.read_page(page_id)
+            for item in items:
+                insort(page, item)
+            self.rewrite_page(position, page_id, page)
+
+    def pages_of(self, items: Iterable[Tuple[Any, Any]]) -> Dict[int, List[Tuple[Any, Any]]]:
+        # directory position -> the items that belong on its page
+        pages = {}
+        if self.directory:
+            for item in items:
+                pages.setdefault(self.find_page(item), []).append(item)
+        return pages
+
+    def rewrite_page(self, position: int, page_id: int, page: List[Tuple[Any, Any]]) -> None:
+        # an empty page is dropped and a page over PAGE_SIZE is split into pages at least half full
+        if not page:
+            del self.store()[f'page:{page_id}']
+            self.change_directory('pop', position)
+            return
+        parts = len(page) // (PAGE_SIZE // 2) if len(page) > PAGE_SIZE else 1
+        starts = [len(page) * part // parts for part in range(parts + 1)]
+        self.write_page(page_id, page[:starts[1]])
+        if page[0] != self.directory[position][0]:
+            self.change_directory('first', position, page[0])
+        for part in range(1, parts):
+            new_page_id = self.new_page_id()
+            self.write_page(new_page_id, page[starts[part]:starts[part + 1]])
+            self.change_directory('insert', position + part, page[starts[part]], new_page_id)
+
+    def range(self, low: Any = None, high: Any = None, low_inclusive: bool = True, high_inclusive: bool = True,
+              prefix: Optional[str] = None) -> Iterator[Any]:
+        # keys whose value is in the range, in value order; None bounds are open
+        self.load_directory()
+        if not self.directory:
+            return
+        if prefix is not None and (low is None or prefix > low):
+            low, low_inclusive = prefix, True
+        position = 0 if low is None else max(0, bisect_left(self.first_pairs, (low,)) - 1)
+        for _, page_id in self.directory[position:]:
+            page = self.read_page(page_id)
+            start = 0 if low is None else bisect_left(page, (low,))
+            for value, key in page[start:]:
+                if low is not None and not low_inclusive and value == low:
+                    continue
+                if high is not None and (value > high or (not high_inclusive and value == high)):
+                    return
+                if prefix is not None and not value.startswith(prefix):
+                    return
+                yield key
+
+    def estimate(self, low: Any = None, high: Any = None, low_inclusive: bool = True, high_inclusive: bool = True,
+                 prefix: Optional[str] = None) -> float:
+        # number of keys in the range: exact when it spans at most two pages, otherwise from the directory alone
+        self.load_directory()
+        if not self.directory:
+            return 0
+        if prefix is not None:
+            if low is None or prefix > low:
+                low, low_inclusive = prefix, True
+            high, high_inclusive = prefix + chr(0x10ffff), True
+        start = 0 if low is None else max(0, bisect_left(self.first_pairs, low, key=first_value) - 1)
+        end = len(self.directory) - 1 if high is None else \
+            max(0, bisect_right(self.first_pairs, high, key=first_value) - 1)
+        if end - start <= 1:
+            return sum(1 for _ in self.range(low, high, low_inclusive, high_inclusive, prefix))
+        return (end - start) * PAGE_SIZE * AVERAGE_PAGE_FILL
+
+    def bounds(self) -> Optional[Tuple[Any, Any]]:
+        # the smallest and largest indexed values, from the directory and the last page
+        self.load_directory()
+        if not self.directory:
+            return None
+        return self.directory[0][0][0], self.read_page(self.directory[-1][1])[-1][0]
+
+    def __len__(self) -> int:
+        return sum(len(self.read_page(page_id)) for _, page_id in self.load_directory())
@@ -0,0 +1,75 @@
+import pickle
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from predicates import compile_criteria
+
+PARALLEL_SCAN_ROWS = 100_000  # smaller tables are scanned in the calling process
+SEGMENTS_PER_WORKER = 4  # more segments than workers, so a worker that finds many rows does not hold up the rest
+
+# the criteria are sent to the workers as plain tuples, so a worker never imports (and never closes) the database
+Criterion = namedtuple('Criterion', ['field_name', 'operator', 'value'])
+
+
+def scan_segment(data_path: str, places: List[Tuple[int, int]], criteria: List[Tuple[str, str, Any]]) \
+        -> List[Dict[str, Any]]:
+    # runs in a worker process; the values of the segment are one stretch of the data file, read at once. The parent
+    # holds the read lock meanwhile, and sent the criteria most selective first: a constant key keeps that order
+    matches = compile_criteria([Criterion(*criterion) for criterion in criteria], lambda criterion: 0)
+    start, end = places[0][0], places[-1][0] + places[-1][1]
+    with open(data_path, 'rb') as file:
+        file.seek(start)
+        data = memoryview(file.read(end - start))
+    rows = []
+    for position, size in places:
+        row = pickle.loads(data[position - start:position - start + size])
+        if matches(row):
+            rows.append(row)
+    return rows
+
+
+class ParallelScanner:
+    # full scans of large tables split into segments of keys that are filtered by a pool of worker processes
+    def __init__(self, workers: int = 0, threshold: int = PARALLEL_SCAN_ROWS):
+        self.workers = 0
+        self.threshold = threshold
+        self.executor = None
+        self.configure(workers, threshold)
+
+    def configure(self, workers: Optional[int] = None, threshold: Optional[int] = None) -> None:
+        # workers=0 turns parallel scans off
+        if workers is not None:
+            if workers < 0:
+                raise ValueError
+            if workers != self.workers:
+                self.shutdown()
+            self.workers = workers
+        if threshold is not None:
+            if threshold < 0:
+                raise ValueError
+            self.threshold = threshold
+
+    def enabled_for(self, table_rows: int) -> bool:
+        return self.workers > 1 and table_rows > self.threshold
+
+    def scan(self, data_path: str, places: List[Tuple[int, int]], criteria: List[Any]) -> Iterator[Dict[str, Any]]:
+        # places are the (position, size) of the values in the dbm.dumb data file, in file order; the segments are
+        # merged in that order, so the rows come out as a serial scan would return them
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        criteria = [(criterion.field_name, criterion.operator, criterion.value) for criterion in criteria]
+        size = max(1, -(-len(places) // (self.workers * SEGMENTS_PER_WORKER)))
+        futures = [self.executor.submit(scan_segment, data_path, places[start:start + size], criteria)
+                   for start in range(0, len(places), size)]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,96 @@
+import itertools
+import operator
+from array import array
+from bisect import bisect_left, insort
+from typing import Any, Collection, List, Optional
+
+# a hash index entry (posting list) is either a plain list of keys, or for integer keys a compact
+# (COMPACT, first key, last key, typecode, gaps, exceptions) tuple: the keys sorted and stored as the gaps between them in an
+# array of the narrowest unsigned type that holds the largest gap, so dense keys take a byte each instead of a pickled
+# int. A few gaps too large for a byte are kept as (position, gap) exceptions, 0 in the array, instead of widening it
+COMPACT = 'gaps'
+TYPECODES = ('B', 'H', 'I', 'Q')
+EXCEPTIONS_SHARE = 16  # at most one gap in this many is an exception
+BISECT_CHANGES = 8  # more keys than this are removed with one pass over the list, or added with one merge
+
+
+def is_compact(entry: Any) -> bool:
+    return isinstance(entry, tuple)
+
+
+def encode(keys: List[Any], sorted_integers: bool = False) -> Any:
+    if not keys:
+        return []
+    if not sorted_integers:
+        if not all(type(key) is int for key in keys):  # bool is an int subclass, but not a key to compact
+            return list(keys)
+        keys = sorted(keys)
+    gaps = list(map(operator.sub, itertools.islice(keys, 1, None), keys))
+    largest = max(gaps, default=0)
+    if largest > 0xff:
+        positions = list(itertools.compress(itertools.count(), map(operator.gt, gaps, itertools.repeat(0xff))))
+        if len(positions) <= len(gaps) // EXCEPTIONS_SHARE:
+            exceptions = tuple((position, gaps[position]) for position in positions)
+            for position in positions:  # 0 is never a real gap, the keys are distinct
+                gaps[position] = 0
+            return COMPACT, keys[0], keys[-1], 'B', array('B', gaps).tobytes(), exceptions
+    for typecode in TYPECODES:
+        if largest >> (8 * array(typecode).itemsize) == 0:
+            return COMPACT, keys[0], keys[-1], typecode, array(typecode, gaps).tobytes(), ()
+    return list(keys)  # keys further apart than 64 bits
+
+
+def decode(entry: Any) -> List[Any]:
+    if not is_compact(entry):
+        return list(entry)
+    _, first, _, typecode, data, exceptions = entry
+    gaps = array(typecode)
+    gaps.frombytes(data)
+    if exceptions:
+        gaps = gaps.tolist()
+        for position, gap in exceptions:
+            gaps[position] = gap
+    return list(itertools.accumulate(gaps, initial=first))
+
+
+def count(entry: Any) -> int:
+    # without decoding the keys
+    if not is_compact(entry):
+        return len(entry)
+    return len(entry[4]) // array(entry[3]).itemsize + 1
+
+
+def appended(entry: Any, key: int) -> Optional[Any]:
+    # a key after the last one, the common insert, only adds a gap to the bytes; None if the gap does not fit
+    _, first, last, typecode, data, exceptions = entry
+    gap = key - last
+    if gap >> (8 * array(typecode).itemsize) == 0:
+        return COMPACT, first, key, typecode, data + array(typecode, [gap]).tobytes(), exceptions
+    if typecode == 'B' and len(exceptions) < (count(entry) - 1) // EXCEPTIONS_SHARE:
+        return COMPACT, first, key, typecode, data + b'\0', exceptions + ((count(entry) - 1, gap),)
+    return None
+
+
+def update(entry: Any, removed: Collection[Any], added: List[Any]) -> Any:
+    # the entry without the removed keys and with the added ones; a compact entry stays sorted, so a few keys are
+    # found and placed by bisection
+    if is_compact(entry) and all(type(key) is int for key in added):
+        if not removed and len(added) == 1 and added[0] > entry[2]:
+            compact = appended(entry, added[0])
+            if compact is not None:
+                return compact
+        keys = decode(entry)
+        if len(removed) > BISECT_CHANGES:
+            keys = [key for key in keys if key not in removed]
+        else:
+            for key in removed:
+                i = bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    del keys[i]
+        if len(added) > BISECT_CHANGES:
+            keys = sorted(keys + added)
+        else:
+            for key in added:
+                insort(keys, key)
+        return encode(keys, sorted_integers=True)
+    return encode([key for key in decode(entry) if key not in removed] + list(added))
@@ -0,0 +1,91 @@
+import operator
+from collections.abc import Collection, Sequence
+from typing import Any, Callable, Dict, List, Optional
+
+Row = Dict[str, Any]
+
+COMPARISONS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+OPERATORS = tuple(COMPARISONS) + ('in', 'between', 'startswith', 'is null', 'is not null')
+
+# fraction of the rows a criterion is expected to keep when there are no statistics for it
+DEFAULT_SELECTIVITY = {
+    '=': 0.05,
+    'in': 0.05,  # per value
+    'startswith': 0.1,
+    'between': 0.25,
+    '<': 0.33,
+    '>': 0.33,
+    '<=': 0.33,
+    '>=': 0.33,
+    'is null': 0.1,
+    'is not null': 0.9,
+    '!=': 0.95,
+}
+
+
+def default_selectivity(criterion: Any) -> float:
+    if criterion.operator == 'in':
+        return min(1.0, DEFAULT_SELECTIVITY['in'] * len(criterion.value))
+    return DEFAULT_SELECTIVITY[criterion.operator]
+
+
+def check_criterion(criterion: Any) -> None:
+    # 'in' takes a collection of values and 'between' a (low, high) pair; a str is neither
+    if criterion.operator not in OPERATORS:
+        raise ValueError
+    if criterion.operator in ('in', 'between') and isinstance(criterion.value, (str, bytes)):
+        raise ValueError
+    if criterion.operator == 'in' and not isinstance(criterion.value, Collection):
+        raise ValueError
+    if criterion.operator == 'between' and (not isinstance(criterion.value, Sequence) or len(criterion.value) != 2):
+        raise ValueError
+
+
+def compile_criterion(criterion: Any) -> Callable[[Row], bool]:
+    # like the old condition check, a row without a value only matches the null operators
+    check_criterion(criterion)
+    field, value, op = criterion.field_name, criterion.value, criterion.operator
+    if op in COMPARISONS:
+        compare = COMPARISONS[op]
+        return lambda row: row[field] is not None and compare(row[field], value)
+    if op == 'in':
+        try:
+            values = frozenset(value)
+        except TypeError:  # unhashable values are compared one by one
+            values = list(value)
+        return lambda row: row[field] is not None and row[field] in values
+    if op == 'between':
+        low, high = value
+        return lambda row: row[field] is not None and low <= row[field] <= high
+    if op == 'startswith':
+        return lambda row: isinstance(row[field], str) and row[field].startswith(value)
+    if op == 'is null':
+        return lambda row: row[field] is None
+    return lambda row: row[field] is not None
+
+
+def compile_criteria(criteria: List[Any],
+                     selectivity: Optional[Callable[[Any], float]] = None) -> Callable[[Row], bool]:
+    # one callable for the whole list, the most selective criteria are checked first so most rows fail fast
+    selectivity = selectivity if selectivity else default_selectivity
+    for criterion in criteria:  # before the selectivities, which take the length of the values
+        check_criterion(criterion)
+    tests = [compile_criterion(criterion) for criterion in sorted(criteria, key=selectivity)]
+    if not tests:
+        return lambda row: True
+    if len(tests) == 1:
+        return tests[0]
+    if len(tests) == 2:
+        first, second = tests
+        return lambda row: first(row) and second(row)
+    if len(tests) == 3:
+        first, second, third = tests
+        return lambda row: first(row) and second(row) and third(row)
+    return lambda row: all(test(row) for test in tests)
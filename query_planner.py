@@ -0,0 +1,66 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+# relative costs, a full scan of n rows costs n * ROW_SCAN_COST
+ROW_SCAN_COST = 1.0  # reading and unpickling one row while walking the table
+ROW_FETCH_COST = 1.5  # reading one row by key, a random read
+POSTING_COST = 0.02  # one key of an index posting list
+INDEX_LOOKUP_COST = 2.0  # reading one index entry or ordered index page
+
+
+@dataclass
+class IndexAccess:
+    field_name: str
+    index_type: str  # 'hash', 'ordered' or 'composite' (field_name is then the name of the composite index)
+    criteria: List[Any]
+    estimated_rows: float
+    covering: bool = False  # the index has every field the query reads, the rows are made from its entries
+
+    def cost(self) -> float:
+        return INDEX_LOOKUP_COST + self.estimated_rows * POSTING_COST
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(field=self.field_name, index_type=self.index_type,
+                    criteria=[(c.field_name, c.operator, c.value) for c in self.criteria],
+                    estimated_rows=self.estimated_rows, covering=self.covering)
+
+
+@dataclass
+class QueryPlan:
+    access: str  # 'key', 'index', 'intersection', 'covering' or 'scan'
+    estimated_rows: float
+    cost: float
+    table_rows: int
+    indexes: List[IndexAccess] = field(default_factory=list)
+    candidates: List[IndexAccess] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(access=self.access, estimated_rows=self.estimated_rows, cost=self.cost,
+                    table_rows=self.table_rows, indexes=[access.to_dict() for access in self.indexes],
+                    candidates=[access.to_dict() for access in self.candidates])
+
+
+def key_plan(table_rows: int, keys: int = 1) -> QueryPlan:
+    return QueryPlan('key', min(keys, table_rows), keys * ROW_FETCH_COST, table_rows)
+
+
+def choose_plan(table_rows: int, candidates: List[IndexAccess]) -> QueryPlan:
+    # the cheapest of a full scan, a covering index, the most selective index, or an intersection of the most
+    # selective indexes (rows assumed independent across fields, so the intersection keeps the product of the
+    # selectivities)
+    best = QueryPlan('scan', table_rows, table_rows * ROW_SCAN_COST, table_rows, candidates=candidates)
+    for access in candidates:  # no row is fetched at all
+        if access.covering and access.cost() < best.cost:
+            best = QueryPlan('covering', access.estimated_rows, access.cost(), table_rows, [access], candidates)
+    chosen, selectivity, lookup_cost = [], 1.0, 0.0
+    for access in sorted(candidates, key=lambda access: access.estimated_rows):
+        chosen.append(access)
+        selectivity *= access.estimated_rows / table_rows if table_rows else 0
+        lookup_cost += access.cost()
+        estimated_rows = table_rows * selectivity
+        cost = lookup_cost + estimated_rows * ROW_FETCH_COST
+        if cost >= best.cost:
+            break
+        best = QueryPlan('index' if len(chosen) == 1 else 'intersection', estimated_rows, cost, table_rows,
+                         list(chosen), candidates)
+    return best
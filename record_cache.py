@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+
+Row = Dict[str, Any]
+
+
+class RecordCache:
+    # rows read by key, shared by all the tables; the least recently used rows are dropped when the
+    # pickled size of the cached rows goes over max_bytes
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        if max_bytes < 0:
+            raise ValueError
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (store path, encoded key) -> (row, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()  # reader threads share the cache
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, item: Tuple[str, str]) -> bool:
+        return item in self.entries
+
+    def get(self, path: str, key: str) -> Optional[Row]:
+        with self.lock:
+            entry = self.entries.get((path, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end((path, key))
+            return dict(entry[0])  # the caller may change the row it gets
+
+    def put(self, path: str, key: str, row: Row, size: int) -> None:
+        with self.lock:
+            if size > self.max_bytes:
+                return
+            self.invalidate(path, key)
+            self.entries[(path, key)] = (dict(row), size)
+            self.bytes += size
+            self.evict(self.max_bytes)
+
+    def evict(self, keep_bytes: int) -> None:
+        with self.lock:
+            while self.bytes > keep_bytes:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def invalidate(self, path: str, key: str) -> None:
+        with self.lock:
+            entry = self.entries.pop((path, key), None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def invalidate_store(self, path: str) -> None:
+        # the store file was replaced or removed
+        with self.lock:
+            for item in [item for item in self.entries if item[0] == path]:
+                self.invalidate(*item)
+
+    def resize(self, max_bytes: Optional[int]) -> None:
+        if max_bytes is None:
+            return
+        if max_bytes < 0:
+            raise ValueError
+        self.max_bytes = max_bytes
+        self.evict(max_bytes)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self.entries), bytes=self.bytes, max_bytes=self.max_bytes)
+
+    def reset_stats(self) -> None:
+        self.hits = self.misses = self.evictions = 0
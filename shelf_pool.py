@@ -0,0 +1,201 @@
+import os
+import shelve
+import threading
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_MAX_HANDLES = 64
+DELETED = (-1, 0)  # the place appended to a dbm.dumb key directory for a deleted key
+
+
+def store_files(path: str) -> List[str]:
+    # all the files dbm created for the store at path (.dat/.dir/.bak for dbm.dumb, a single file for gdbm)
+    folder, base = os.path.split(path)
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in os.listdir(folder) if name == base or name.startswith(base + '.')]
+
+
+def remove_store(path: str) -> None:
+    for file in store_files(path):
+        os.remove(file)
+
+
+def rename_store(src: str, dst: str) -> None:
+    remove_store(dst)
+    for file in store_files(src):
+        os.rename(file, dst + file[len(src):])
+
+
+def fsync_file(file: str) -> None:
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_shelf(handle: shelve.Shelf) -> None:
+    handle.sync()
+    if getattr(handle.dict, '_modified', False):  # dbm.dumb never clears it, so every close would write the index again
+        handle.dict._modified = False
+
+
+def append_keys(handle: shelve.Shelf, keys: Iterable[str]) -> bool:
+    # dbm.dumb writes its whole key directory on every sync, a commit appends the places of the keys it changed
+    # instead: a later line replaces an earlier one, and DELETED is dropped again when the store is opened. False
+    # for the dbm modules without a key directory
+    index = getattr(handle.dict, '_index', None)
+    if index is None:
+        return False
+    lines = []
+    for key in keys:
+        encoded_key = key.encode(handle.keyencoding)
+        lines.append('%r, %r\n' % (encoded_key.decode('Latin-1'), index.get(encoded_key, DELETED)))
+    with open(handle.dict._dirfile, 'a', encoding='Latin-1') as file:
+        file.write(''.join(lines))
+    handle.dict._modified = False  # the directory file is complete again
+    return True
+
+
+def drop_deleted(handle: shelve.Shelf) -> None:
+    index = getattr(handle.dict, '_index', None)
+    if index is not None:
+        for key in [key for key, place in index.items() if place == DELETED]:
+            del index[key]
+
+
+def delete_key(handle: shelve.Shelf, key: str) -> None:
+    # dbm.dumb writes its whole index file on every delete, here the index is written by the next sync instead
+    index = getattr(handle.dict, '_index', None)
+    if index is None:
+        del handle[key]
+        return
+    del index[key.encode(handle.keyencoding)]
+    handle.dict._modified = True
+
+
+def stored_places(handle: shelve.Shelf) -> Optional[List[Tuple[int, int]]]:
+    # the (position, size) of every value in the dbm.dumb data file, in file order; None for the other dbm modules
+    index = getattr(handle.dict, '_index', None)
+    return None if index is None else sorted(index.values())
+
+
+def stored_values(handle: shelve.Shelf) -> Iterator[bytes]:
+    # every pickled value of the store; dbm.dumb opens its data file again for every read, here the values are read
+    # through one file handle in the order they are in the file
+    places = stored_places(handle)
+    if places is None:
+        yield from (handle.dict[key.encode(handle.keyencoding)] for key in handle)
+        return
+    with open(handle.dict._datfile, 'rb') as file:
+        for position, size in places:
+            file.seek(position)
+            yield file.read(size)
+
+
+class ShelfPool:
+    # keeps shelve handles open between operations, the least recently used handle is closed when the pool is full
+    def __init__(self, max_handles: int = DEFAULT_MAX_HANDLES):
+        if max_handles < 1:
+            raise ValueError
+        self.max_handles = max_handles
+        self.handles = OrderedDict()  # path -> shelve.Shelf, least recently used first
+        self.lock = threading.RLock()  # reader threads share the pool
+        self.opened = 0  # handles opened so far
+        self.appended = set()  # paths whose key directory has lines appended since it was last written whole
+
+    def __len__(self) -> int:
+        return len(self.handles)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.handles
+
+    def get(self, path: str) -> shelve.Shelf:
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is None:
+                self.evict(self.max_handles - 1)
+                handle = shelve.open(path)
+                drop_deleted(handle)
+                self.handles[path] = handle
+                self.opened += 1
+            else:
+                self.handles.move_to_end(path)
+            return handle
+
+    def evict(self, keep: int) -> None:
+        with self.lock:
+            while len(self.handles) > keep:
+                path, handle = self.handles.popitem(last=False)
+                self.close_handle(path, handle)
+
+    def discard(self, path: str) -> None:
+        # close the handle before the store files are removed or replaced
+        with self.lock:
+            handle = self.handles.pop(path, None)
+            if handle is not None:
+                self.close_handle(path, handle)
+
+    def close_handle(self, path: str, handle: shelve.Shelf) -> None:
+        if path in self.appended:  # closing writes the directory without the appended lines
+            self.appended.discard(path)
+            handle.dict._modified = True
+        handle.close()
+
+    def write_keys(self, path: str, keys: Iterable[str]) -> None:
+        # after a commit changed the keys of the store, so other processes read them from the files
+        with self.lock:
+            handle = self.get(path)
+            if append_keys(handle, keys):
+                self.appended.add(path)
+            else:
+                sync_shelf(handle)
+
+    def write_directory(self, path: str) -> None:
+        if path in self.appended:
+            self.appended.discard(path)
+            self.handles[path].dict._modified = True
+        sync_shelf(self.handles[path])
+
+    def resize(self, max_handles: Optional[int]) -> None:
+        if max_handles is None:
+            return
+        if max_handles < 1:
+            raise ValueError
+        self.max_handles = max_handles
+        self.evict(max_handles)
+
+    def flush(self, durable: bool = False, stores: Iterable[str] = ()) -> None:
+        # durable also fsyncs stores, the paths of other stores written since their last fsync; their handles may
+        # have been closed since, or never opened in this process
+        with self.lock:
+            for path in self.handles:
+                self.write_directory(path)
+            if durable:  # dbm does not fsync its files itself, nor does closing a handle
+                for path in set(self.handles).union(stores):
+                    for file in store_files(path):
+                        fsync_file(file)
+
+    def sync(self, path: str) -> None:
+        with self.lock:
+            if path in self.handles:
+                self.write_directory(path)
+
+    def close(self) -> None:
+        self.evict(0)
+
+    def forget(self) -> None:
+        # another process changed the files since the handles were opened, closing them must not write their key
+        # directories back; the appended ones are complete as they are
+        with self.lock:
+            for path in self.appended:
+                self.handles[path].dict._modified = False
+            self.appended.clear()
+            self.evict(0)
+
+    def __enter__(self) -> 'ShelfPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
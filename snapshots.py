@@ -0,0 +1,169 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import time
+from contextlib import AbstractContextManager
+from typing import Any, Callable, Dict, List, Optional
+
+CHUNK_BYTES = 64 * 1024  # files are stored as chunks named by their hash, so a chunk that did not change is kept once
+RACY_NS = 1_000_000_000  # a file written this close to the time it was read may change without its mtime changing
+# (coarse file system timestamps), it is read again under the lock
+SKIPPED_FILES = ('DataBase.lock', 'DataBase.wal')  # empty after the checkpoint of every snapshot
+
+FileEntry = Dict[str, Any]  # size, mtime_ns, checked_ns (when the content was read) and the chunk hashes
+
+
+class SnapshotStore:
+    # a backup folder: chunks/<hash prefix>/<hash> holds the chunks of every snapshot, snapshots/<name>.json the
+    # files of each snapshot. Every manifest lists whole files, so any snapshot is restored without the others
+    def __init__(self, root: str):
+        self.root = root
+
+    def chunk_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def manifest_path(self, name: str) -> str:
+        return os.path.join(self.root, 'snapshots', name + '.json')
+
+    def put_chunk(self, data: bytes, report: Dict[str, int]) -> str:
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomically(path, data)
+            report['chunks_written'] += 1
+            report['bytes_written'] += len(data)
+        return digest
+
+    def get_chunk(self, digest: str) -> bytes:
+        with open(self.chunk_path(digest), 'rb') as file:
+            return file.read()
+
+    def put_file(self, path: str, report: Dict[str, int]) -> FileEntry:
+        # the file is stat'ed before it is read, a write during the read leaves a newer mtime behind
+        checked_ns = time.time_ns()
+        stat = os.stat(path)
+        chunks = []
+        with open(path, 'rb') as file:
+            while True:
+                data = file.read(CHUNK_BYTES)
+                if not data:
+                    break
+                chunks.append(self.put_chunk(data, report))
+        report['files_read'] += 1
+        report['bytes_read'] += stat.st_size
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, checked_ns=checked_ns, chunks=chunks)
+
+    def save_manifest(self, manifest: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self.manifest_path(manifest['name'])), exist_ok=True)
+        write_atomically(self.manifest_path(manifest['name']), json.dumps(manifest, indent=1).encode())
+
+    def load_manifest(self, name: str) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path(name)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise ValueError from None
+
+    def names(self) -> List[str]:
+        # oldest first
+        folder = os.path.join(self.root, 'snapshots')
+        if not os.path.isdir(folder):
+            return []
+        manifests = [self.load_manifest(name[:-len('.json')]) for name in os.listdir(folder) if name.endswith('.json')]
+        return [manifest['name'] for manifest in sorted(manifests, key=lambda manifest: manifest['created_ns'])]
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def database_files(folder: str) -> List[str]:
+    return sorted(name for name in os.listdir(folder)
+                  if name not in SKIPPED_FILES and os.path.isfile(os.path.join(folder, name)))
+
+
+def is_current(entry: Optional[FileEntry], path: str) -> bool:
+    # same size and mtime, and the mtime was old enough when the content was read to trust it
+    if entry is None:
+        return False
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns'] \
+        and entry['mtime_ns'] < entry['checked_ns'] - RACY_NS
+
+
+def take_snapshot(store: SnapshotStore, folder: str, quiesce: Callable[[], AbstractContextManager],
+                  name: Optional[str] = None, base: Optional[str] = None) -> Dict[str, Any]:
+    # first every file that changed since the base snapshot is copied while writes go on; then, under quiesce (the
+    # write lock and a checkpoint), only the files written since they were copied are read again. The files the
+    # base snapshot already has are not read at all
+    started = time.perf_counter()
+    name = name if name else dt.datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    if os.path.exists(store.manifest_path(name)):
+        raise ValueError
+    names = store.names()
+    base = base if base else (names[-1] if names else None)
+    previous = store.load_manifest(base)['files'] if base else {}
+    report = dict(files_read=0, bytes_read=0, chunks_written=0, bytes_written=0)
+
+    files = {}
+    for file_name in database_files(folder):
+        path = os.path.join(folder, file_name)
+        if is_current(previous.get(file_name), path):
+            files[file_name] = previous[file_name]
+            continue
+        try:
+            files[file_name] = store.put_file(path, report)
+        except FileNotFoundError:  # replaced or removed meanwhile, read again under the lock
+            pass
+
+    with quiesce():
+        locked = time.perf_counter()
+        current = database_files(folder)
+        files = {file_name: files.get(file_name) for file_name in current}
+        for file_name in current:
+            path = os.path.join(folder, file_name)
+            if not is_current(files[file_name], path):
+                files[file_name] = store.put_file(path, report)
+        manifest = dict(name=name, base=base, created_ns=time.time_ns(), files=files)
+        store.save_manifest(manifest)
+        locked_seconds = time.perf_counter() - locked
+
+    return dict(report, name=name, base=base, files=len(files), bytes=sum(entry['size'] for entry in files.values()),
+                seconds=time.perf_counter() - started, locked_seconds=locked_seconds)
+
+
+def restore_snapshot(store: SnapshotStore, folder: str, name: str) -> Dict[str, Any]:
+    # the database must be closed; only the chunks that differ from the files in folder are written
+    manifest = store.load_manifest(name)
+    report = dict(files=len(manifest['files']), chunks_written=0, bytes_written=0, files_removed=0)
+    os.makedirs(folder, exist_ok=True)
+    for file_name in database_files(folder):
+        if file_name not in manifest['files']:
+            os.remove(os.path.join(folder, file_name))
+            report['files_removed'] += 1
+    for file_name, entry in manifest['files'].items():
+        path = os.path.join(folder, file_name)
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as file:
+            for i, digest in enumerate(entry['chunks']):
+                file.seek(i * CHUNK_BYTES)
+                existing = file.read(CHUNK_BYTES)
+                if hashlib.blake2b(existing, digest_size=20).hexdigest() == digest:
+                    continue
+                data = store.get_chunk(digest)
+                file.seek(i * CHUNK_BYTES)
+                file.write(data)
+                report['chunks_written'] += 1
+                report['bytes_written'] += len(data)
+            file.truncate(entry['size'])
+            file.flush()
+            os.fsync(file.fileno())
+    return report
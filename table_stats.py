@@ -0,0 +1,129 @@
+import datetime as dt
+import hashlib
+import math
+from typing import Any, Dict, Iterable, List, Optional
+
+SKETCH_BITS = 8  # a HyperLogLog sketch of 2 ** SKETCH_BITS registers, about 6.5% standard error
+SKETCH_REGISTERS = 1 << SKETCH_BITS
+HASH_BITS = 64
+RANGE_TYPES = (int, float, dt.datetime)  # the types a range criterion is estimated for by interpolating min and max
+
+Row = Dict[str, Any]
+
+
+def value_hash(value: Any) -> int:
+    # python's hash of a string changes from process to process, the sketches are shared through the catalog
+    return int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=HASH_BITS // 8).digest(), 'big')
+
+
+def sketch_add(sketch: bytearray, value: Any) -> None:
+    hashed = value_hash(value)
+    register = hashed >> (HASH_BITS - SKETCH_BITS)
+    rest = hashed & ((1 << (HASH_BITS - SKETCH_BITS)) - 1)
+    sketch[register] = max(sketch[register], HASH_BITS - SKETCH_BITS - rest.bit_length() + 1)
+
+
+def sketch_estimate(sketch: bytearray) -> int:
+    alpha = 0.7213 / (1 + 1.079 / SKETCH_REGISTERS)
+    estimate = alpha * SKETCH_REGISTERS ** 2 / sum(2.0 ** -rank for rank in sketch)
+    zeros = sketch.count(0)
+    if estimate <= 2.5 * SKETCH_REGISTERS and zeros:  # small cardinalities are counted from the empty registers
+        estimate = SKETCH_REGISTERS * math.log(SKETCH_REGISTERS / zeros)
+    return round(estimate)
+
+
+class TableStats:
+    # statistics kept up to date by every insert, update and delete: the row count and, per field, the null count,
+    # a HyperLogLog sketch of the distinct values and the min and max. Neither the sketch nor the bounds can take
+    # a value out again, after deletes they describe every value the field had since the last analyze
+    def __init__(self, fields: List[str], rows: int = 0, columns: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.rows = rows
+        self.columns = {field: dict(nulls=0, min=None, max=None, unordered=False, sketch=bytearray(SKETCH_REGISTERS))
+                        for field in fields}
+        for field, column in (columns or {}).items():
+            if field in self.columns:
+                self.columns[field] = dict(self.columns[field], **column)  # saved before unordered was kept
+                self.columns[field]['sketch'] = bytearray(column['sketch'])
+
+    @classmethod
+    def from_rows(cls, fields: List[str], rows: Iterable[Row]) -> 'TableStats':
+        stats = cls(fields)
+        for row in rows:
+            stats.add(row)
+        return stats
+
+    @classmethod
+    def from_dict(cls, fields: List[str], data: Dict[str, Any]) -> 'TableStats':
+        return cls(fields, data['rows'], data['columns'])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(rows=self.rows, columns={field: dict(column, sketch=bytes(column['sketch']))
+                                             for field, column in self.columns.items()})
+
+    def add(self, row: Row) -> None:
+        self.rows += 1
+        for field, column in self.columns.items():
+            value = row.get(field)
+            if value is None:
+                column['nulls'] += 1
+                continue
+            sketch_add(column['sketch'], value)
+            if column['unordered']:
+                continue
+            try:
+                if column['min'] is None or value < column['min']:
+                    column['min'] = value
+                if column['max'] is None or value > column['max']:
+                    column['max'] = value
+            except TypeError:  # values that cannot be ordered leave the field without bounds for good
+                column['min'] = column['max'] = None
+                column['unordered'] = True
+
+    def remove(self, row: Row) -> None:
+        self.rows -= 1
+        for field, column in self.columns.items():
+            if row.get(field) is None:
+                column['nulls'] -= 1
+
+    def distinct(self, field: str) -> int:
+        column = self.columns[field]
+        return min(sketch_estimate(column['sketch']), self.rows - column['nulls'])
+
+    def summary(self) -> Dict[str, Any]:
+        return dict(rows=self.rows, fields={field: dict(nulls=column['nulls'], distinct=self.distinct(field),
+                                                        min=column['min'], max=column['max'])
+                                            for field, column in self.columns.items()})
+
+    def selectivity(self, criterion: Any) -> Optional[float]:
+        # fraction of the rows expected to match, None when the statistics cannot tell
+        if not self.rows:
+            return None
+        column = self.columns[criterion.field_name]
+        values = self.rows - column['nulls']
+        if criterion.operator == 'is null':
+            return column['nulls'] / self.rows
+        if criterion.operator == 'is not null':
+            return values / self.rows
+        if criterion.operator in ('=', 'in', '!='):
+            distinct = self.distinct(criterion.field_name)
+            if not distinct:
+                return 0.0 if criterion.operator != '!=' else values / self.rows
+            matching = values / distinct * (len(criterion.value) if criterion.operator == 'in' else 1)
+            return min(1.0, (values - matching if criterion.operator == '!=' else matching) / self.rows)
+        if criterion.operator in ('<', '<=', '>', '>=', 'between'):
+            low, high = column['min'], column['max']
+            if not isinstance(low, RANGE_TYPES) or type(low) is not type(high):
+                return None
+            if criterion.operator == 'between':
+                start, end = criterion.value
+            elif criterion.operator in ('<', '<='):
+                start, end = low, criterion.value
+            else:
+                start, end = criterion.value, high
+            if type(start) is not type(low) or type(end) is not type(low):
+                return None
+            if high == low:
+                return values / self.rows if start <= low <= end else 0.0
+            covered = (min(end, high) - max(start, low)) / (high - low)
+            return max(0.0, min(1.0, covered)) * values / self.rows
+        return None
@@ -1,4 +1,11 @@
+import asyncio
 import datetime as dt
+import dbm.dumb
+import json
+import multiprocessing
+import os
+import shelve
+import threading
 import time
 from functools import partial
 from pathlib import Path
@@ -6,8 +13,20 @@ from typing import Generator
 
 import pytest
 
-from db import DataBase
+import benchmark
+from async_db import AsyncDataBase
+import columnar
+import join_engine
+import postings
+from db import DataBase, catalog_path, hash_index_path, statistics_path, table_path
+from instrumentation import CounterSink, LogSink, SlowQueryLog
+from ordered_index import DIRECTORY_CHANGES_KEY, MAX_DIRECTORY_CHANGES, PAGE_SIZE, OrderedIndex
+from predicates import compile_criteria
+from record_cache import DEFAULT_CACHE_BYTES
 from db_api import DBField, SelectionCriteria, DB_ROOT, DBTable
+import shelf_pool
+from shelf_pool import DEFAULT_MAX_HANDLES, ShelfPool, store_files
+from table_stats import TableStats
 
 DB_BACKUP_ROOT = DB_ROOT.parent / (DB_ROOT.name + '_backup')
 STUDENT_FIELDS = [DBField('ID', int), DBField('First', str),
@@ -59,6 +78,7 @@ def new_db() -> Generator[DataBase, None, None]:
 
 @pytest.fixture(scope='session')
 def backup_db() -> Generator[Path, None, None]:
+    DB_ROOT.mkdir(parents=True, exist_ok=True)  # the database files are not in the repository
     yield DB_BACKUP_ROOT
 
 
@@ -74,6 +94,18 @@ def test_reload_from_backup(backup_db: Path) -> None:
     assert students.count() == 100
 
 
+def test_reload_keeps_records(backup_db: Path) -> None:
+    delete_files(DB_ROOT)
+    for path in backup_db.iterdir():
+        (DB_ROOT / path.name).write_bytes(path.read_bytes())
+    students = DataBase().get_table('Students')
+    assert students.get_record(1_000_005)['First'] == 'John5'
+    assert students.get_record(1_000_005)['ID'] == 1_000_005
+    assert len(students.query_table([SelectionCriteria('ID', '<', 1_000_010)])) == 10
+    students.update_record(1_000_005, dict(First='Jane'))
+    assert DataBase().get_table('Students').get_record(1_000_005)['First'] == 'Jane'
+
+
 def test_create(new_db: DataBase) -> None:
     db = new_db
     assert db.num_tables() == 0
@@ -142,6 +174,1020 @@ def test_performance(new_db: DataBase) -> None:
     assert delete_stop - delete_start < 20
 
 
+def test_insert_records(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+    students.create_index('Last')
+    rows = (dict(ID=1_000_000 + i, First=f'John{i}', Last=f'Doe{i % 3}') for i in range(25))
+    assert students.insert_records(rows, batch_size=10) == 25
+    assert students.count() == 25
+    assert students.get_record(1_000_007)['Birthday'] is None
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Doe1')])) == 8
+    with pytest.raises(ValueError):  # the second row already exists, so the batch is rejected as a whole
+        students.insert_records([dict(ID=2_000_000), dict(ID=1_000_000)])
+    with pytest.raises(ValueError):
+        students.insert_records([dict(ID=2_000_000, Middle='Bob')])
+    assert students.count() == 25
+
+
+def test_ordered_index(new_db: DataBase, monkeypatch) -> None:
+    students = create_students_table(new_db)
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i}', Last=f'Doe{i}',
+                                 Birthday=dt.datetime(2000, 2, 1) + dt.timedelta(days=i)) for i in range(600))
+    students.create_index('ID', 'ordered')
+    students.create_index('Birthday', 'ordered')
+    students.create_index('First', 'ordered')
+    with pytest.raises(ValueError):
+        students.create_index('Last', 'bitmap')
+
+    results = students.query_table([SelectionCriteria('ID', '>=', 1_000_100), SelectionCriteria('ID', '<', 1_000_110)])
+    assert [row['ID'] for row in results] == list(range(1_000_100, 1_000_110))
+    add_student(students, 1000, Birthday=dt.datetime(1990, 1, 1))
+    students.update_record(1_000_003, dict(Birthday=dt.datetime(1990, 1, 2)))
+    students.delete_record(1_000_000)
+    results = students.query_table([SelectionCriteria('Birthday', '<', dt.datetime(2000, 2, 3))])
+    assert [row['ID'] for row in results] == [1_001_000, 1_000_003, 1_000_001]
+    assert len(students.query_table([SelectionCriteria('First', 'startswith', 'John59')])) == 11
+    assert students.query_table([SelectionCriteria('Birthday', 'startswith', '2000')]) == []  # not a str field
+    assert students.count([SelectionCriteria('Birthday', 'startswith', '2000')]) == 0
+    students.delete_records([SelectionCriteria('ID', '>', 1_000_500)])
+    assert students.count() == 500
+
+    index = students.ordered_index_of('ID')
+    students.insert_records(dict(ID=2_000_000 + i) for i in range(3000))  # the last page is split again and again
+    students.delete_records([SelectionCriteria('ID', '<', 1_000_400)])  # drops pages
+    assert len(index.store().get(DIRECTORY_CHANGES_KEY, [])) < MAX_DIRECTORY_CHANGES  # saved whole once in a while
+    reloaded = OrderedIndex(index.store)
+    assert reloaded.load_directory() == index.directory
+    assert reloaded.first_pairs == index.first_pairs == [first for first, _ in index.directory]
+    assert list(reloaded.range(1_000_495, 2_000_002)) == list(range(1_000_495, 1_000_501)) + [2_000_000, 2_000_001,
+                                                                                              2_000_002]
+
+    writes = []
+    write_page = OrderedIndex.write_page
+    monkeypatch.setattr(OrderedIndex, 'write_page', lambda self, page_id, page:
+                        writes.append((self.store, page_id)) or write_page(self, page_id, page))
+    students.update_records([SelectionCriteria('ID', '>=', 2_000_000)], dict(Birthday=dt.datetime(1980, 1, 1)))
+    assert len(writes) == len(set(writes)) < 40  # one page of Birthday split into the pages of 3000 pairs
+    birthdays = students.ordered_index_of('Birthday')
+    assert max(len(birthdays.read_page(page_id)) for _, page_id in birthdays.directory) <= PAGE_SIZE
+    writes.clear()
+    students.delete_records([SelectionCriteria('ID', '<', 2_001_000)])
+    assert len(writes) == len(set(writes))  # each page touched is written once
+    rows = students.query_table([])
+    assert list(students.ordered_index_of('ID').range()) == sorted(row['ID'] for row in rows)
+    assert list(students.ordered_index_of('Birthday').range()) == \
+        [row['ID'] for row in sorted(rows, key=lambda row: (row['Birthday'], row['ID']))]
+
+
+def test_query_planner(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i % 10}', Last=f'Doe{i % 15}') for i in range(300))
+    assert students.explain([SelectionCriteria('First', '=', 'John3')])['access'] == 'scan'
+    students.create_index('First')
+    students.create_index('Last')
+    students.create_index('ID', 'ordered')
+
+    assert students.explain([SelectionCriteria('ID', '=', 1_000_003)])['access'] == 'key'
+    plan = students.explain([SelectionCriteria('First', '=', 'John3')])
+    assert plan['access'] == 'index'
+    assert plan['estimated_rows'] == 30
+    criteria = [SelectionCriteria('First', '=', 'John3'), SelectionCriteria('Last', '=', 'Doe3')]
+    plan = students.explain(criteria)
+    assert plan['access'] == 'intersection'
+    assert [index['field'] for index in plan['indexes']] == ['Last', 'First']  # the most selective first
+    assert [row['ID'] for row in students.query_table(criteria)] == list(range(1_000_003, 1_000_300, 30))
+    criteria = [SelectionCriteria('First', '=', 'John3'), SelectionCriteria('ID', '<', 1_000_005)]
+    plan = students.explain(criteria)
+    assert plan['indexes'][0]['index_type'] == 'ordered'
+    assert [row['ID'] for row in students.query_table(criteria)] == [1_000_003]
+
+
+def create_grades_table(db: DataBase, num_students: int) -> DBTable:
+    table = db.create_table('Grades', [DBField('GradeID', int), DBField('ID', int), DBField('Course', str),
+                                       DBField('Grade', int)], 'GradeID')
+    table.insert_records(dict(GradeID=i, ID=1_000_000 + i % num_students, Course=f'Course{i % 4}', Grade=i % 100)
+                         for i in range(3 * num_students))
+    return table
+
+
+def test_query_multiple_tables(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 20)
+    create_grades_table(new_db, 20)
+    results = new_db.query_multiple_tables(
+        ['Students', 'Grades'],
+        [[SelectionCriteria('ID', '<', 1_000_005)], [SelectionCriteria('Course', '=', 'Course1')]],
+        ['ID'])
+    expected = sorted((1_000_000 + i % 20, i) for i in range(60) if i % 20 < 5 and i % 4 == 1)
+    assert sorted((row['ID'], row['GradeID']) for row in results) == expected
+    assert all(row['First'] == f"John{row['ID'] - 1_000_000}" for row in results)
+
+    students.create_index('First')  # the Students side is found through its key, one lookup per grade
+    results = new_db.query_multiple_tables(['Grades', 'Students'], [[], [SelectionCriteria('First', '=', 'John3')]],
+                                           ['ID'])
+    assert sorted(row['GradeID'] for row in results) == [3, 23, 43]
+    with pytest.raises(ValueError):
+        new_db.query_multiple_tables(['Students', 'Grades'], [[], []], ['Course'])
+
+
+def test_join_algorithms() -> None:
+    left = [{'L': dict(ID=i % 7, Name=f'n{i}')} for i in range(30)]
+    right = [dict(ID=i % 5, Value=i) for i in range(20)] + [dict(ID=None, Value=-1)]
+    expected = sorted((joined['L']['Name'], row['Value']) for joined in left for row in right
+                      if joined['L']['ID'] == row['ID'])
+    for joined_rows in (join_engine.hash_join(left, right, 'R', ['ID']),
+                        join_engine.hash_join(left, right, 'R', ['ID'], build_left=True),
+                        join_engine.sort_merge_join(left, right, 'R', ['ID'], run_rows=4)):
+        assert sorted((joined['L']['Name'], joined['R']['Value']) for joined in joined_rows) == expected
+
+
+def test_iter_query(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 30)
+    add_student(students, 100, Birthday=None)
+    rows = students.iter_query([SelectionCriteria('ID', '>=', 1_000_010)], fields=['ID', 'First'], limit=3)
+    assert not isinstance(rows, list)
+    assert [sorted(row) for row in rows] == [['First', 'ID']] * 3
+
+    criteria = [SelectionCriteria('ID', '<', 1_000_100)]
+    ids = [row['ID'] for row in students.iter_query(criteria, order_by='-Birthday', limit=4)]
+    assert ids == [1_000_029, 1_000_028, 1_000_027, 1_000_026]
+    for index_type in (None, 'ordered'):
+        if index_type:
+            students.create_index('Birthday', index_type)
+        rows = list(students.iter_query([SelectionCriteria('ID', '>', 1_000_020)], order_by='Birthday'))
+        assert [row['ID'] for row in rows] == list(range(1_000_021, 1_000_030)) + [1_000_100]
+        rows = students.iter_query([], fields=['ID'], order_by='-Birthday')
+        assert [row['ID'] for row in rows][:2] == [1_000_029, 1_000_028]
+    with pytest.raises(ValueError):
+        students.iter_query([], fields=['Middle'])
+
+    first, second = students.iter_query([]), students.iter_query([])
+    next(first), next(second)
+    first.close()  # the cursors of a thread closed in any order
+    assert new_db.lock.readers == 1
+    second.close()
+    assert new_db.lock.readers == 0 and new_db.lock.depth('reads') == 0
+    add_student(students, 500)
+
+
+def test_operators(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 20)
+    add_student(students, 100, Last=None)
+    students.create_index('Last')
+
+    def ids(*criteria):
+        return sorted(row['ID'] - 1_000_000 for row in students.query_table(list(criteria)))
+
+    assert ids(SelectionCriteria('ID', 'in', [1_000_003, 1_000_005, 2_000_000])) == [3, 5]
+    assert ids(SelectionCriteria('Last', 'in', ['Doe4', 'Doe7'])) == [4, 7]
+    assert students.explain([SelectionCriteria('Last', 'in', ['Doe4', 'Doe7'])])['access'] == 'index'
+    assert ids(SelectionCriteria('ID', 'between', (1_000_010, 1_000_012))) == [10, 11, 12]
+    assert ids(SelectionCriteria('First', 'startswith', 'John1')) == [1] + list(range(10, 20)) + [100]
+    assert ids(SelectionCriteria('Last', 'is null', None)) == [100]
+    assert len(ids(SelectionCriteria('Last', 'is not null', None))) == 20
+    assert ids(SelectionCriteria('Last', '!=', 'Doe1'), SelectionCriteria('ID', '<', 1_000_003)) == [0, 2]
+    with pytest.raises(ValueError):
+        students.query_table([SelectionCriteria('ID', '+0==', 1)])
+    for operator, value in [('in', 'Doe4'), ('in', 4), ('in', (doe for doe in ['Doe4'])), ('between', 'ab'),
+                            ('between', (1, 2, 3)), ('between', {1, 2}), ('between', 5)]:
+        with pytest.raises(ValueError):
+            students.query_table([SelectionCriteria('Last', operator, value)])
+        with pytest.raises(ValueError):
+            compile_criteria([SelectionCriteria('Last', operator, value)])
+    assert ids(SelectionCriteria('Last', 'in', {'Doe4'})) == [4]
+
+
+def test_compiled_criteria_order() -> None:
+    criteria = [SelectionCriteria('B', '<', 5), SelectionCriteria('A', '=', 2)]
+    matches = compile_criteria(criteria)
+    assert matches({'A': 1, 'B': 'x'}) is False  # 'A' = 2 is checked first, so 'x' < 5 is never evaluated
+    assert matches({'A': 2, 'B': 3}) is True
+    assert compile_criteria([])({'A': 1}) is True
+
+
+def test_handle_pool(new_db: DataBase, monkeypatch) -> None:
+    new_db.handle_pool.resize(2)
+    try:
+        students = create_students_table(new_db, 10)
+        students.create_index('First')
+        students.create_index('Last')
+        new_db.transactions.checkpoint()
+        synced = []
+        monkeypatch.setattr(shelf_pool, 'fsync_file', synced.append)
+        add_student(students, 111)
+        assert len(new_db.handle_pool) == 2
+        new_db.transactions.checkpoint()  # the stores closed by the pool since the commit are fsynced too
+        assert {str(DB_ROOT / 'Students.db.dat'), str(hash_index_path('Students', 'First')) + '.dir'} <= set(synced)
+        monkeypatch.undo()
+        results = students.query_table([SelectionCriteria('Last', '=', 'Doe111')])
+        assert [row['ID'] for row in results] == [1_000_111]
+        new_db.flush()
+        with DataBase() as db:
+            assert db.get_table('Students').count() == 11
+        assert len(new_db.handle_pool) == 0
+    finally:
+        new_db.handle_pool.resize(DEFAULT_MAX_HANDLES)
+
+
+def test_transactions(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 5)
+    students.create_index('Last')
+    students.create_index('Birthday', 'ordered')
+    with new_db.transaction():
+        add_student(students, 111)
+        students.delete_record(1_000_001)
+        students.update_record(1_000_002, dict(Last='Smith'))
+        assert students.count() == 5  # the transaction reads its own writes
+    assert students.count() == 5
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('Last', '=', 'Smith')])] == [1_000_002]
+
+    with pytest.raises(ValueError):
+        with new_db.transaction():
+            add_student(students, 222)
+            students.update_record(1_000_003, dict(Last='Smith'))
+            add_student(students, 0)  # duplicate key, the whole transaction is rolled back
+    assert students.count() == 5
+    assert students.query_table([SelectionCriteria('ID', '=', 1_000_222)]) == []
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Smith')])) == 1
+    birthdays = students.query_table([SelectionCriteria('Birthday', '>=', dt.datetime(2000, 2, 1))])
+    assert len(birthdays) == 5
+
+
+def test_wal_recovery(new_db: DataBase, monkeypatch) -> None:
+    students = create_students_table(new_db, 5)
+    students.create_index('Last')
+    new_db.flush()
+
+    def crash(records):
+        raise KeyboardInterrupt  # the commit is in the log but was never written to the table files
+    monkeypatch.setattr(new_db.transactions, 'apply', crash)
+    with pytest.raises(KeyboardInterrupt):
+        add_student(students, 111)
+    monkeypatch.undo()
+    new_db.wal.close()
+    with open(DB_ROOT / 'DataBase.wal', 'ab') as wal:
+        wal.write(b'\x10\x00\x00\x00torn')  # a frame that was only partly written is ignored
+    new_db.handle_pool.close()
+    assert new_db.transactions.recover() == 1
+
+    db = DataBase()
+    students = db.get_table('Students')
+    assert students.count() == 6
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('Last', '=', 'Doe111')])] == [1_000_111]
+    assert (DB_ROOT / 'DataBase.wal').stat().st_size == 0
+
+
+def test_group_commit(new_db: DataBase) -> None:
+    db = DataBase(wal_mode='group')
+    try:
+        students = create_students_table(db, 50)
+        assert students.count() == 50
+        db.flush()
+        assert DataBase().get_table('Students').count() == 50
+    finally:
+        db.wal.set_mode('sync')
+    with pytest.raises(ValueError):
+        DataBase(wal_mode='async')
+
+
+def test_point_writes(new_db: DataBase, monkeypatch) -> None:
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=i, First=f'John{i}') for i in range(20_000))
+    new_db.flush()
+    written = []  # whole key directories written
+    commit = dbm.dumb._Database._commit
+
+    def counted_commit(self):
+        if self._modified:
+            written.append(self._dirfile)
+        commit(self)
+    monkeypatch.setattr(dbm.dumb._Database, '_commit', counted_commit)
+    monkeypatch.setattr(dbm.dumb._Database, 'sync', counted_commit)
+    directory = table_path('Students') + '.dir'
+    sizes = [os.path.getsize(directory)]
+    writes = [lambda i=i: add_student(students, i) for i in range(1000, 1100)] + \
+        [lambda: students.update_record(5, dict(First='Jane')), lambda: students.delete_record(6)]
+    for write in writes:
+        write()
+        sizes.append(os.path.getsize(directory))
+    appended = [after - before for before, after in zip(sizes, sizes[1:])]
+    assert written == [] and 0 < min(appended) and max(appended) < 100  # a commit costs the keys it changes, not the table size
+    assert sizes[0] > 100_000
+
+    other = ShelfPool()  # another process, reading the files
+    rows = other.get(table_path('Students'))
+    assert len(rows) == 20_099 and rows['5']['First'] == 'Jane' and '6' not in rows
+    other.forget()
+    new_db.flush()
+    assert written
+
+
+def test_record_cache(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 20)
+    cache = new_db.record_cache
+    cache.reset_stats()
+    for _ in range(3):
+        assert students.get_record(1_000_005)['First'] == 'John5'
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    students.get_record(1_000_005)['First'] = 'Changed'  # rows handed out are copies
+    students.update_record(1_000_005, dict(First='Jane'))
+    assert students.get_record(1_000_005)['First'] == 'Jane'
+    students.delete_record(1_000_005)
+    with pytest.raises(ValueError):
+        students.get_record(1_000_005)
+
+    cache.clear()
+    students.get_record(1_000_000)
+    size = cache.bytes
+    cache.resize(size * 3)
+    for i in range(1, 10):
+        students.get_record(1_000_000 + i if i != 5 else 1_000_010)
+    assert len(cache) == 3 and cache.evictions == 7
+    assert 1_000_009 in [row['ID'] for row, _ in cache.entries.values()]
+    cache.resize(0)
+    assert len(cache) == 0
+    cache.resize(DEFAULT_CACHE_BYTES)
+
+
+def test_parallel_scan(new_db: DataBase, monkeypatch) -> None:
+    students = create_students_table(new_db)
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i % 7}', Last=f'Doe{i}') for i in range(300))
+    criteria = [SelectionCriteria('First', 'in', ['John3', 'John5']), SelectionCriteria('ID', '>', 1_000_010)]
+    for i in (12, 17):  # the grown rows move to the end of the data file
+        students.update_record(1_000_000 + i, dict(Last='Doe' * 200))
+    serial = students.query_table(criteria)
+    assert [row['ID'] for row in serial[-2:]] == [1_000_012, 1_000_017]
+    db = DataBase(scan_workers=2, scan_threshold=100)
+    try:
+        assert students.query_table(criteria) == serial  # same rows in the same order
+        assert db.scanner.executor is not None
+        assert list(students.iter_query(criteria, fields=['ID'], limit=3)) == [dict(ID=row['ID']) for row in serial[:3]]
+        scans = []
+        scan = db.scanner.scan
+        monkeypatch.setattr(db.scanner, 'scan', lambda *args: scans.append(args) or scan(*args))
+        students.delete_records([SelectionCriteria('First', '=', 'John3')])  # found by the workers too
+        assert len(scans) == 1
+        assert students.count() == 300 - len([i for i in range(300) if i % 7 == 3])
+        db.scanner.configure(threshold=1_000)
+        assert not db.scanner.enabled_for(students.count())
+        with pytest.raises(ValueError):
+            db.scanner.configure(workers=-1)
+    finally:
+        db.scanner.configure(workers=0)
+
+
+def test_columnar_storage(new_db: DataBase, monkeypatch) -> None:
+    monkeypatch.setattr(columnar, 'SEGMENT_ROWS', 16)
+    with pytest.raises(ValueError):
+        new_db.create_table('Students', STUDENT_FIELDS, 'ID', 'parquet')
+    students = new_db.create_table('Students', STUDENT_FIELDS, 'ID', 'columnar')
+    for i in range(50):
+        add_student(students, i, First=None if i == 7 else f'John{i % 5}')
+    students.update_record(1_000_003, dict(Last='Smith', Birthday=None))  # a sealed row moves to the tail
+    students.update_record(1_000_049, dict(Last='Smith'))
+    students.delete_record(1_000_004)
+    students.delete_record(1_000_048)
+    students.create_index('Last')
+
+    assert students.count() == 48
+    assert students.get_record(1_000_003) == dict(ID=1_000_003, First='John3', Last='Smith', Birthday=None)
+    assert students.get_record(1_000_020)['Birthday'] == dt.datetime(2000, 2, 21)
+    assert students.get_record(1_000_007)['First'] is None
+    with pytest.raises(ValueError):
+        students.get_record(1_000_004)
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('Last', '=', 'Smith')])] == \
+        [1_000_003, 1_000_049]
+    results = students.iter_query([SelectionCriteria('First', '=', 'John2')], fields=['ID'])
+    assert [row['ID'] for row in results] == [1_000_000 + i for i in range(2, 48, 5) if i != 7]
+
+    with pytest.raises(ValueError):
+        with new_db.transaction():  # seals a segment, then rolls back
+            students.insert_records(dict(ID=2_000_000 + i) for i in range(20))
+            students.delete_record(1_000_004)
+    assert students.count() == 48
+    assert DataBase().get_table('Students').get_record(1_000_020)['Last'] == 'Doe20'
+    assert len(DataBase().get_table('Students').query_table([SelectionCriteria('ID', '>=', 1_000_040)])) == 9
+
+
+def test_columnar_size(new_db: DataBase) -> None:
+    sizes = {}
+    for storage in ('row', 'columnar'):
+        students = new_db.create_table('Students', STUDENT_FIELDS, 'ID', storage)
+        for i in range(200):
+            add_student(students, i)
+        new_db.flush()
+        sizes[storage] = get_folder_size(DB_ROOT) - (DB_ROOT / 'DataBase.db.dat').stat().st_size
+        new_db.delete_table('Students')
+    assert sizes['columnar'] * 3 < sizes['row']
+
+
+def test_aggregates(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 0)
+    for i in range(400):
+        add_student(students, i, First=['John', 'Paul', 'George', None][i % 4])
+    students.create_index('First')
+    students.create_index('Birthday', 'ordered')
+
+    new_db.record_cache.reset_stats()
+    assert students.count([SelectionCriteria('First', '=', 'Paul')]) == 100
+    assert new_db.record_cache.stats()['misses'] == 0  # counted from the posting list, no row was read
+    assert students.count([SelectionCriteria('First', 'in', ['Paul', 'Ringo', 'John'])]) == 200
+    assert students.count([SelectionCriteria('ID', 'in', [1_000_001, 1_000_002, 5])]) == 2
+    assert students.count([SelectionCriteria('Birthday', '<', dt.datetime(2000, 2, 11))]) == 10
+    assert students.count([SelectionCriteria('First', '=', 'Paul'), SelectionCriteria('ID', '<', 1_000_010)]) == 3
+    assert students.count([SelectionCriteria('First', 'is null', None)]) == 100
+    assert students.aggregate('count', 'First') == 300
+
+    assert students.min('ID', [SelectionCriteria('First', '=', 'George')]) == 1_000_002
+    assert students.max('ID') == 1_000_399
+    assert students.sum('ID', [SelectionCriteria('ID', '<', 1_000_003)]) == 3_000_003
+    assert students.avg('ID', [SelectionCriteria('ID', '<', 1_000_004)]) == 1_000_001.5
+    assert students.max('Birthday') == dt.datetime(2000, 2, 1) + dt.timedelta(days=399)
+    assert students.min('Birthday', [SelectionCriteria('First', '=', 'Paul')]) == dt.datetime(2000, 2, 2)
+    assert students.avg('ID', [SelectionCriteria('First', '=', 'Ringo')]) is None
+
+    assert students.aggregate('count', group_by='Birthday', group_key=lambda birthday: birthday.year) == \
+        {2000: 335, 2001: 65}
+    assert students.aggregate('max', 'ID', [SelectionCriteria('ID', '<', 1_000_008)], group_by='First') == \
+        {'John': 1_000_004, 'Paul': 1_000_005, 'George': 1_000_006, None: 1_000_007}
+    grouped = students.aggregate('count', criteria=[SelectionCriteria('ID', '<', 1_000_010)], group_by='First')
+    assert grouped == {'John': 3, 'Paul': 3, 'George': 2, None: 2}
+
+    with new_db.transaction():
+        students.delete_record(1_000_001)
+        assert students.count([SelectionCriteria('First', '=', 'Paul')]) == 99
+    with pytest.raises(ValueError):
+        students.aggregate('median', 'ID')
+    with pytest.raises(ValueError):
+        students.aggregate('sum')
+    with pytest.raises(ValueError):
+        students.count([SelectionCriteria('Age', '=', 1)])
+
+
+def test_table_statistics(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i % 50}', Last=None if i % 4 else 'Doe',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i)) for i in range(1000))
+    students.update_record(1_000_001, dict(Last='Smith'))
+    students.delete_record(1_000_999)
+    with pytest.raises(ValueError):
+        with new_db.transaction():
+            students.insert_record(dict(ID=5))
+            assert students.count() == 1000
+            raise ValueError
+    assert students.count() == 999
+
+    stats = students.statistics()
+    assert stats['rows'] == 999
+    assert stats['fields']['Last']['nulls'] == 748
+    assert stats['fields']['Last']['distinct'] == 2
+    assert 45 <= stats['fields']['First']['distinct'] <= 55
+    assert 900 <= stats['fields']['ID']['distinct'] <= 999
+    assert stats['fields']['Birthday']['min'] == dt.datetime(2000, 1, 1)
+    assert stats['fields']['Birthday']['max'] == dt.datetime(2000, 1, 1) + dt.timedelta(days=999)  # deleted since
+    assert students.analyze()['fields']['Birthday']['max'] == dt.datetime(2000, 1, 1) + dt.timedelta(days=998)
+    assert 0.015 < students.selectivity(SelectionCriteria('First', '=', 'John3')) < 0.025
+    assert 0.45 < students.selectivity(SelectionCriteria('ID', '<', 1_000_500)) < 0.55
+    assert students.selectivity(SelectionCriteria('Last', 'is null', None)) == 748 / 999
+
+    db = DataBase()  # the count is read from the catalog, without opening the table
+    assert db.get_table('Students').count() == 999
+    assert str(DB_ROOT / 'Students.db') not in db.handle_pool
+    assert db.get_table('Students').statistics() == students.analyze()
+
+    students = db.get_table('Students')
+    db.flush()
+    catalog_size = (DB_ROOT / 'DataBase.db.dat').stat().st_size
+    for i in range(10):
+        students.insert_record(dict(ID=i, Birthday=dt.datetime(1990, 1, 1)))
+    students.delete_record(0)
+    assert (DB_ROOT / 'DataBase.db.dat').stat().st_size == catalog_size  # the statistics are not saved by a write
+    assert ShelfPool().get(statistics_path())['Students']['table_stats']['rows'] == 1008  # for the other processes
+    assert DataBase().get_table('Students').statistics()['fields']['Birthday']['min'] == dt.datetime(1990, 1, 1)
+
+    stats = TableStats(['Value'])
+    for value in (2, 'two', 1):
+        stats.add(dict(Value=value))
+    assert stats.columns['Value']['min'] is None and stats.columns['Value']['max'] is None
+    assert TableStats.from_dict(['Value'], stats.to_dict()).columns['Value']['unordered']
+
+
+def test_lazy_catalog(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 20)
+    students.create_index('First')
+    students.create_index('Birthday', 'ordered')
+    for i in range(2000):  # a large catalog, written directly instead of through create_table
+        new_db.update_DataBase_file(f'Table{i}', STUDENT_FIELDS, 'ID')
+    new_db.flush()
+    new_db.handle_pool.close()
+
+    opened = new_db.handle_pool.opened
+    db = DataBase()
+    assert db.num_tables() == 2001
+    assert set(db.handle_pool.handles) <= {catalog_path(), statistics_path()}  # no table store or index is opened
+    assert db.handle_pool.opened - opened == len(db.handle_pool)
+    loaded = [table_name for table_name, table in DataBase.db_tables.items() if table is not None]
+    assert loaded == ['Students']  # a table is only loaded when it is used, and then stays loaded
+
+    assert db.get_table('Table1999').count() == 0
+    assert sum(table is not None for table in DataBase.db_tables.values()) == 2
+    students = db.get_table('Students')
+    assert students.explain([SelectionCriteria('First', '=', 'John5')])['indexes'][0]['field'] == 'First'
+    assert students.explain([SelectionCriteria('Birthday', '<', dt.datetime(2000, 2, 3))])['access'] == 'index'
+    assert table_path('Students') not in db.handle_pool
+    assert students.get_record(1_000_005)['First'] == 'John5'
+    assert table_path('Students') in db.handle_pool  # opened by the first use
+    with pytest.raises(ValueError):
+        db.get_table('Table2000')
+    db.delete_table('Table5')
+    assert db.num_tables() == 2000
+
+    with db.transaction():  # the tables have no files, dropping them one by one would only slow the next tests
+        catalog = students.catalog_file()
+        for i in range(6, 2000):
+            del catalog[f'Table{i}']
+    assert DataBase().num_tables() == 6
+
+
+def test_benchmark(new_db: DataBase, tmp_path: Path) -> None:
+    output = tmp_path / 'results.json'
+    assert benchmark.main(['--sizes', '300', '--samples', '10', '--output', str(output)]) == 0
+    results = json.loads(output.read_text())
+    operations = results['sizes']['300']
+    assert operations['query_key']['calls'] == 10
+    assert operations['bulk_insert']['throughput'] > 0
+    assert operations['join']['p99_ms'] >= operations['join']['p50_ms'] > 0
+    assert operations['bytes_on_disk'] > 0
+    assert new_db.get_tables_names() == []  # the benchmark tables are dropped
+
+    assert benchmark.compare(results, results) == []
+    slower = json.loads(output.read_text())
+    slower['sizes']['300']['get_record']['p50_ms'] *= 2
+    assert [regression.split()[0] for regression in benchmark.compare(results, slower)] == ['get_record']
+
+
+def test_set_based_writes(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=i, First=f'John{i % 10}', Last=f'Doe{i % 7}',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i)) for i in range(2000))
+    students.create_index('First')
+    students.create_index('Last')
+    students.create_index('Birthday', 'ordered')
+    events = []
+    new_db.instrumentation.add_sink(events.append)
+    try:
+        assert students.update_records([SelectionCriteria('First', '=', 'John3')], dict(Last='Smith')) == 200
+        start = time.time()
+        cutoff = dt.datetime(2000, 1, 1) + dt.timedelta(days=1000)
+        assert students.delete_records([SelectionCriteria('Birthday', '<', cutoff)]) == 1000
+        assert time.time() - start < 5
+    finally:
+        new_db.instrumentation.remove_sink(events.append)
+    assert [event.operation for event in events] == ['update_records', 'delete_records']  # nothing nested
+    assert events[1].rows_examined == 1000 and events[1].access == 'index'
+
+    assert students.count() == 1000
+    assert students.count([SelectionCriteria('Last', '=', 'Smith')]) == 100
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Doe3')])) == \
+        students.count([SelectionCriteria('Last', '=', 'Doe3')]) == 129
+    assert students.count([SelectionCriteria('Birthday', '>=', cutoff)]) == 1000
+    assert students.get_record(1003)['Last'] == 'Smith'
+    assert students.delete_records([SelectionCriteria('ID', '<', 0)]) == 0
+    with pytest.raises(ValueError):
+        students.update_records([], dict(ID=1))
+    with pytest.raises(ValueError):
+        students.update_records([], dict(Age=1))
+    assert students.update_records([SelectionCriteria('ID', 'in', [1000, 1001])], dict(First=None)) == 2
+    assert students.count([SelectionCriteria('First', '=', 'John0')]) == 99
+
+
+def test_snapshots(new_db: DataBase, tmp_path: Path) -> None:
+    backup = str(tmp_path / 'backup')
+    students = create_students_table(new_db, 300)
+    students.create_index('First')
+    base = new_db.snapshot(backup, 'base')
+    assert base['base'] is None and base['files_read'] >= base['files'] and base['bytes_written'] > 0
+
+    add_student(students, 300)
+    second = new_db.snapshot(backup, 'second')
+    assert second['base'] == 'base' and second['bytes_written'] < base['bytes_written'] / 2
+
+    writer = threading.Thread(target=lambda: [add_student(students, i) for i in range(301, 501)])
+    writer.start()
+    online = new_db.snapshot(backup, 'online')  # taken while the rows are inserted
+    writer.join()
+    assert online['locked_seconds'] <= online['seconds']
+    assert new_db.snapshots(backup) == ['base', 'second', 'online']
+    with pytest.raises(ValueError):
+        new_db.snapshot(backup, 'base')
+
+    assert new_db.restore(backup, 'base')['chunks_written'] > 0
+    assert students.count() == 300
+    with pytest.raises(ValueError):
+        students.get_record(1_000_300)
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John7')])) == 1
+
+    new_db.restore(backup, 'online')
+    online_count = students.count()
+    assert 301 <= online_count <= 501
+    assert len(students.query_table([])) == online_count
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John300')])) == 1
+    assert new_db.restore(backup, 'online')['chunks_written'] == 0  # nothing differs anymore
+    assert DataBase().get_table('Students').count() == online_count
+    with pytest.raises(ValueError):
+        new_db.restore(backup, 'missing')
+
+
+def test_composite_indexes(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=i, First=f'John{i % 10}', Last=f'Doe{i % 7}',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i)) for i in range(700))
+    students.create_index(['First', 'Last'], include=['Birthday'])
+    students.create_index(['First', 'Last'], include=['Birthday'])  # already there
+    with pytest.raises(ValueError):
+        students.create_index(['First', 'Last'])
+    with pytest.raises(ValueError):
+        students.create_index(['First', 'Age'])
+    with pytest.raises(ValueError):
+        students.create_index(['First', 'Last'], 'ordered')
+
+    criteria = [SelectionCriteria('First', '=', 'John3'), SelectionCriteria('Last', 'in', ['Doe3', 'Doe4'])]
+    assert students.explain(criteria)['access'] == 'index'  # whole rows are read from the table
+    assert students.explain(criteria, ['ID', 'Birthday'])['access'] == 'covering'
+    assert len(students.query_table(criteria)) == 20
+    students.table_file = None  # a covering query never opens the table file
+    try:
+        rows = list(students.iter_query(criteria + [SelectionCriteria('Birthday', '>', dt.datetime(2001, 1, 1))],
+                                        ['ID', 'Birthday']))
+        assert sorted(row['ID'] for row in rows) == [i for i in range(700) if i % 10 == 3 and i % 7 in (3, 4)
+                                                     and i > 366]
+        assert students.count(criteria) == 20
+    finally:
+        del students.table_file
+
+    students.update_record(3, dict(Last='Doe4', Birthday=dt.datetime(1999, 1, 1)))
+    students.delete_records([SelectionCriteria('ID', '<', 100)])
+    students.insert_record(dict(ID=1003, First='John3', Last='Doe3', Birthday=dt.datetime(2010, 1, 1)))
+    expected = sorted((row['ID'], row['Birthday']) for row in students.query_table([]) if row['First'] == 'John3'
+                      and row['Last'] in ('Doe3', 'Doe4'))
+    assert sorted((row['ID'], row['Birthday']) for row in students.iter_query(criteria, ['ID', 'Birthday'])) == \
+        expected
+    reloaded = DataBase().get_table('Students')
+    assert reloaded.explain(criteria, ['Birthday'])['access'] == 'covering'
+    assert sorted(row['ID'] for row in reloaded.iter_query(criteria, ['ID'])) == [key for key, _ in expected]
+    new_db.delete_table('Students')
+    assert not list(DB_ROOT.glob('Students_*composite_index*'))
+
+
+def test_compact_postings(new_db: DataBase) -> None:
+    keys = list(range(0, 3000, 3))
+    entry = postings.encode(keys[::-1])
+    assert postings.is_compact(entry) and entry[3] == 'B' and postings.count(entry) == 1000
+    assert postings.decode(postings.update(entry, {3, 9}, [4, 70_000])) == sorted(set(keys) - {3, 9} | {4, 70_000})
+    assert postings.decode(postings.update(entry, set(keys[:500]), list(range(1, 40, 3)))) == \
+        sorted(keys[500:] + list(range(1, 40, 3)))
+    assert postings.update(entry, set(keys), []) == []
+    for key in (3000, 3003, 4000, 70_000):  # appended, the last two as exceptions
+        entry = postings.update(entry, (), [key])
+    assert postings.decode(entry) == keys + [3000, 3003, 4000, 70_000] and len(entry[5]) == 2
+    assert postings.encode(['b', 'a']) == ['b', 'a'] and postings.update(['b', 'a'], {'b'}, ['c']) == ['a', 'c']
+
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=i, First=f'John{i % 10}', Last=f'Doe{i % 3}',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i % 2)) for i in range(3000))
+    students.create_index('Last')
+    students.create_index('Birthday')
+    students.delete_record(3)
+    students.update_record(6, dict(Last='Doe1'))
+    students.delete_records([SelectionCriteria('First', '=', 'John9')])
+    students.insert_record(dict(ID=5000, First='Jane', Last='Doe0', Birthday=dt.datetime(2000, 1, 1)))
+    new_db.close()
+
+    with shelve.open(hash_index_path('Students', 'Last'), 'r') as index:
+        entry = index[repr('Doe0')]
+        assert postings.is_compact(entry) and len(entry[4]) < 1000
+        doe0 = [i for i in range(3000) if i % 3 == 0 and i % 10 != 9 and i not in (3, 6)] + [5000]
+        assert postings.decode(entry) == doe0
+        plain = {value: postings.decode(index[value]) for value in index}
+    with shelve.open(hash_index_path('Students', 'Last')) as index:  # the version 2 format
+        for value, keys in plain.items():
+            index[value] = keys
+    with shelve.open(catalog_path()) as catalog:
+        entry = catalog['Students']
+        entry['version'] = 2
+        catalog['Students'] = entry
+
+    students = DataBase().get_table('Students')  # migrated
+    with shelve.open(hash_index_path('Students', 'Last'), 'r') as index:
+        assert all(postings.is_compact(index[value]) for value in index)
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('Last', '=', 'Doe0')])] == doe0
+    assert students.count([SelectionCriteria('Last', 'in', ['Doe0', 'Doe1'])]) == students.count() - \
+        students.count([SelectionCriteria('Last', '=', 'Doe2')])
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Doe1'),
+                                     SelectionCriteria('Birthday', '=', dt.datetime(2000, 1, 2))])) == \
+        sum(1 for i in range(3000) if (i % 3 == 1 or i == 6) and i % 2 == 1 and i % 10 != 9)
+
+
+def test_async_api(new_db: DataBase) -> None:
+    counters = CounterSink()
+
+    async def scenario():
+        async with AsyncDataBase(new_db, max_workers=2) as db:
+            students = await db.create_table('Students', STUDENT_FIELDS, 'ID')
+            new_db.instrumentation.add_sink(counters)
+            results = await asyncio.gather(*(students.insert_record(dict(ID=i, First=f'John{i % 5}'))
+                                             for i in list(range(300)) + [7]), return_exceptions=True)
+            assert [type(result) for result in results[-2:]] == [type(None), ValueError]
+            assert results[:-1] == [None] * 300
+            rows = await asyncio.gather(*(students.get_record(5) for _ in range(50)))
+            assert all(row == rows[0] for row in rows) and rows[0]['First'] == 'John0'
+            rows[0]['First'] = 'changed'
+            assert rows[1]['First'] == 'John0'
+            with pytest.raises(ValueError):
+                await students.get_record(1000)
+            new_db.instrumentation.remove_sink(counters)
+
+            await students.update_record(5, dict(First='Jane'))
+            assert (await students.get_record(5))['First'] == 'Jane'
+            await students.create_index('First')
+            assert len(await students.query_table([SelectionCriteria('First', '=', 'John1')])) == 60
+            assert [row['ID'] async for row in students.iter_query([], ['ID'], order_by='ID')] == list(range(300))
+            async for row in students.iter_query([]):
+                break  # the worker stops and releases the read lock
+            await asyncio.wait_for(students.delete_record(0), 5)
+            async with asyncio.timeout(5):  # no read lock is held between two chunks of an iteration
+                rows = students.iter_query([], ['ID'], order_by='ID')
+                ids = []
+                async for row in rows:
+                    if row['ID'] == 1:  # a writer waits for the lock while a cursor is open
+                        writer = asyncio.ensure_future(students.insert_record(dict(ID=1000)))
+                        await asyncio.sleep(0.05)
+                        assert (await students.get_record(2))['ID'] == 2
+                        await writer
+                        await students.update_record(250, dict(First='John0'))  # the iterating task writes too
+                    ids.append(row['ID'])
+                assert ids == list(range(1, 300))
+                await rows.aclose()
+                await students.delete_record(1000)
+            with pytest.raises(ValueError):
+                async for row in students.iter_query([SelectionCriteria('Age', '=', 1)]):
+                    pass
+
+            groups = await db.create_table('Groups', [DBField('First', str), DBField('Room', int)], 'First')
+            await groups.insert_records([dict(First='Jane', Room=1), dict(First='John1', Room=2)])
+            joined = await db.query_multiple_tables(['Students', 'Groups'], [[], []], ['First'])
+            assert len(joined) == 61 and await db.num_tables() == 2
+            assert (await db.get_table('Students')) is students
+            await db.delete_table('Groups')
+            assert await db.get_tables_names() == ['Students']
+
+    asyncio.run(scenario())
+    snapshot = counters.snapshot()
+    assert snapshot[('Students', 'get_record')]['calls'] <= 3  # coalesced
+    assert snapshot[('Students', 'insert_records')]['calls'] <= 3  # batched
+    assert ('Students', 'insert_record') in snapshot  # the batch with the duplicate key, one record at a time
+    assert DataBase().get_table('Students').count() == 299
+
+
+def test_import_export(new_db: DataBase, tmp_path: Path) -> None:
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=i, First=f'John{i % 10}' if i % 11 else None, Last=f'Doe "{i}", jr\n',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i) if i % 13 else None)
+                            for i in range(2500))
+    students.create_index('First')
+    students.create_index('Birthday', 'ordered')
+    expected = sorted(students.query_table([]), key=lambda row: row['ID'])
+    progress = []
+    assert new_db.export_table('Students', str(tmp_path / 'students.ndjson'), progress_rows=1000,
+                               progress=lambda rows, size: progress.append(rows)) == 2500
+    assert progress == [1000, 2000, 2500]
+    assert new_db.export_table('Students', str(tmp_path / 'students.csv'),
+                               criteria=[SelectionCriteria('ID', '<', 100)]) == 100
+    with pytest.raises(ValueError):
+        new_db.export_table('Students', str(tmp_path / 'students.txt'))
+    new_db.delete_table('Students')
+
+    progress = []
+    assert new_db.import_table('Students', str(tmp_path / 'students.ndjson'), fields=STUDENT_FIELDS,
+                               key_field_name='ID', batch_size=1000,
+                               progress=lambda rows, size: progress.append((rows, size))) == 2500
+    assert progress[-1] == (2500, (tmp_path / 'students.ndjson').stat().st_size) and len(progress) == 3
+    students = new_db.get_table('Students')
+    assert sorted(students.query_table([]), key=lambda row: row['ID']) == expected
+    new_db.import_table('Small', str(tmp_path / 'students.csv'), fields=STUDENT_FIELDS, key_field_name='ID')
+    assert sorted(new_db.get_table('Small').query_table([]), key=lambda row: row['ID']) == \
+        [dict(row, First=row['First'] if row['First'] is not None else '') for row in expected[:100]]
+
+    students.create_index('First')
+    students.create_index('Birthday', 'ordered')
+    students.create_index(['First', 'Last'], include=['Birthday'])
+    (tmp_path / 'more.csv').write_text('ID,First,Birthday\n' + ''.join(f'{5000 + i},Jane,2030-01-0{i + 1}\n'
+                                                                      for i in range(5)))
+    assert new_db.import_table('Students', str(tmp_path / 'more.csv')) == 5  # the indexes are built again
+    assert students.explain([SelectionCriteria('First', '=', 'Jane')])['access'] == 'index'
+    assert len(students.query_table([SelectionCriteria('First', '=', 'Jane')])) == 5
+    assert len(students.query_table([SelectionCriteria('Birthday', '>', dt.datetime(2029, 1, 1))])) == 5
+    assert students.max('Birthday') == dt.datetime(2030, 1, 5)
+    with pytest.raises(ValueError):  # a key that is already there
+        new_db.import_table('Students', str(tmp_path / 'more.csv'))
+    reloaded = DataBase().get_table('Students')  # the indexes are back in the catalog after the failed import
+    assert reloaded.hash_index == [False, True, False, False] and list(reloaded.composite_indexes) == ['First+Last']
+    (tmp_path / 'bad.csv').write_text('ID,Age\n1,2\n')
+    with pytest.raises(ValueError):
+        new_db.import_table('Students', str(tmp_path / 'bad.csv'))
+    (tmp_path / 'bad.ndjson').write_text('{"ID": 9000, "Birthday": 5}\n')
+    with pytest.raises(ValueError):
+        new_db.import_table('Students', str(tmp_path / 'bad.ndjson'))
+    assert students.count() == 2505
+
+
+def test_vacuum(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 0)
+    students.insert_records(dict(ID=i, First=f'John{i % 10}', Last=f'Doe{i}',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i)) for i in range(3000))
+    students.create_index('First')
+    students.create_index('Birthday', 'ordered')
+    students.create_index(['First', 'Last'], include=['Birthday'])
+    students.delete_records([SelectionCriteria('ID', '>=', 500)])
+    for i in range(0, 500, 5):
+        students.update_record(i, dict(Last='Doe' * 50))
+    new_db.close()
+    with shelve.open(hash_index_path('Students', 'First')) as index:  # emptied by an older version
+        index[repr('Nobody')] = []
+    with shelve.open(hash_index_path('Students', 'Last')) as index:  # a dropped index
+        index[repr('Doe1')] = [1]
+    new_db = DataBase()
+    students = new_db.get_table('Students')
+    expected = sorted(students.query_table([]), key=lambda row: row['ID'])
+    size = db_size()
+
+    errors = []
+
+    def read():
+        try:
+            for _ in range(20):
+                assert len(students.query_table([SelectionCriteria('First', '=', 'John3')])) == 50
+                assert students.get_record(499)['Last'] == 'Doe499'
+        except Exception as error:
+            errors.append(error)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    report = new_db.vacuum()
+    for reader in readers:
+        reader.join()
+    assert not errors
+    assert report['files_removed'] == 1 and report['entries_dropped'] == 1
+    assert report['bytes_reclaimed'] == report['bytes_before'] - report['bytes_after'] > 0
+    assert db_size() < size / 2
+    assert not store_files(hash_index_path('Students', 'Last'))
+    assert sorted(students.query_table([]), key=lambda row: row['ID']) == expected
+    assert students.count([SelectionCriteria('First', '=', 'Nobody')]) == 0
+    assert len(students.query_table([SelectionCriteria('Birthday', '<', dt.datetime(2000, 1, 11))])) == 10
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John1'),
+                                     SelectionCriteria('Last', '=', 'Doe11')])) == 1
+    assert new_db.vacuum('Students', min_waste=0.5)['files'] == 0  # nothing left to reclaim
+
+    columns = new_db.create_table('Columns', STUDENT_FIELDS, 'ID', storage='columnar')
+    columns.insert_records(dict(ID=i, First=f'John{i % 10}') for i in range(3 * columnar.SEGMENT_ROWS))
+    columns.delete_records([SelectionCriteria('ID', '<', 2 * columnar.SEGMENT_ROWS)])
+    report = new_db.vacuum('Columns')
+    assert report['entries_dropped'] == 2 * columnar.SEGMENT_ROWS and report['bytes_reclaimed'] > 0
+    assert sorted(row['ID'] for row in DataBase().get_table('Columns').query_table([])) == \
+        list(range(2 * columnar.SEGMENT_ROWS, 3 * columnar.SEGMENT_ROWS))
+
+    with pytest.raises(ValueError):
+        new_db.vacuum('Nothing')
+    with pytest.raises(ValueError):
+        new_db.stop_vacuum()
+    new_db = DataBase()
+    students = new_db.get_table('Students')
+    new_db.start_vacuum(interval=0.01, min_waste=0.1, pause=0)
+    with pytest.raises(ValueError):
+        new_db.start_vacuum()
+    students.delete_records([SelectionCriteria('ID', '>=', 100)])
+    while DataBase.background_vacuum.passes < 2:
+        time.sleep(0.01)
+    report = new_db.stop_vacuum()
+    assert report['bytes_reclaimed'] > 0 and DataBase.background_vacuum is None
+    assert students.count() == 100 and len(students.query_table([SelectionCriteria('First', '=', 'John3')])) == 10
+
+
+def test_instrumentation(new_db: DataBase, caplog) -> None:
+    students = create_students_table(new_db, 50)
+    students.create_index('First')
+    events, counters, slow = [], CounterSink(), SlowQueryLog(threshold=0)
+    sinks = [new_db.instrumentation.add_sink(events.append), new_db.instrumentation.add_sink(counters),
+             new_db.instrumentation.add_sink(slow), new_db.instrumentation.add_sink(LogSink())]
+    try:
+        students.query_table([SelectionCriteria('First', '=', 'John7')])
+        students.query_table([SelectionCriteria('Last', '=', 'Doe7')])
+        students.insert_record(dict(ID=5, First='Jane'))
+        with new_db.transaction():
+            students.update_record(5, dict(Last='Roe'))
+            students.delete_record(1_000_001)
+        assert [row['ID'] for row in students.iter_query([SelectionCriteria('ID', '<', 1_000_004)])] == \
+            [1_000_000, 1_000_002, 1_000_003, 5]
+        with pytest.raises(ValueError):
+            students.get_record(1_000_001)
+    finally:
+        for sink in sinks:
+            new_db.instrumentation.remove_sink(sink)
+
+    by_index, scan, insert, update, delete, commit, cursor, get = events
+    assert (by_index.operation, by_index.access, by_index.indexes) == ('query_table', 'index', ['First'])
+    assert by_index.rows_examined == by_index.rows_returned == 1 and by_index.bytes_read > 0
+    assert (scan.access, scan.rows_examined, scan.rows_returned) == ('scan', 50, 1)
+    assert scan.bytes_read > 50 * 50
+    assert insert.operation == 'insert_record' and insert.bytes_written > 0  # the commit is part of the insert
+    assert (update.operation, update.bytes_written, delete.operation) == ('update_record', 0, 'delete_record')
+    assert (commit.table, commit.operation) == (None, 'commit') and commit.bytes_written > 0
+    assert (cursor.operation, cursor.rows_returned, cursor.rows_examined) == ('iter_query', 4, 50)
+    assert (get.operation, get.details) == ('get_record', {'error': 'ValueError'})
+    assert all(event.seconds > 0 for event in events)
+
+    assert counters.snapshot()[('Students', 'query_table')]['calls'] == 2
+    assert counters.snapshot()[('Students', 'query_table')]['index_used'] == 1
+    assert len(slow.entries) == len(events)
+    assert 'slow query_table on Students' in caplog.text
+    students.query_table([])
+    assert len(events) == 8  # the sinks are gone, nothing is measured
+
+
+COUNTER_FIELDS = [DBField('ID', int), DBField('Value', int)]
+
+
+def increment_counter(db: DataBase, worker: int, rounds: int) -> None:
+    counters = db.get_table('Counters')
+    for i in range(rounds):
+        with db.transaction():  # read-modify-write, lost if another writer gets in between
+            counters.update_record(0, dict(Value=counters.get_record(0)['Value'] + 1))
+        counters.insert_record(dict(ID=1 + worker * rounds + i, Value=worker))
+
+
+def increment_in_process(worker: int, rounds: int) -> None:
+    with DataBase() as db:
+        increment_counter(db, worker, rounds)
+
+
+def test_concurrent_writers(new_db: DataBase) -> None:
+    rounds, num_processes, num_threads = 20, 3, 3
+    new_db.create_table('Counters', COUNTER_FIELDS, 'ID').insert_record(dict(ID=0, Value=0))
+    new_db.flush()
+    processes = [multiprocessing.Process(target=increment_in_process, args=(worker, rounds))
+                 for worker in range(num_processes)]
+    threads = [threading.Thread(target=increment_counter, args=(new_db, worker, rounds))
+               for worker in range(num_processes, num_processes + num_threads)]
+    counts = []
+    reader = threading.Thread(target=lambda: counts.extend(new_db.get_table('Counters').count() for _ in range(50)))
+    for worker in processes + threads + [reader]:
+        worker.start()
+    for worker in processes + threads + [reader]:
+        worker.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert counts == sorted(counts)  # readers never see a write half done
+
+    counters = new_db.get_table('Counters')
+    workers = num_processes + num_threads
+    assert counters.get_record(0)['Value'] == workers * rounds
+    assert counters.count() == workers * rounds + 1
+    assert DataBase().get_table('Counters').count() == workers * rounds + 1
+
+
+def insert_and_exit(key: int) -> None:
+    DataBase().get_table('Students').insert_record(dict(ID=key, Birthday=dt.datetime(1980, 1, 1)))
+    os._exit(0)  # gone before any flush: the stores were written, never fsynced
+
+
+def test_checkpoint_across_processes(new_db: DataBase, monkeypatch) -> None:
+    create_students_table(new_db, 5)
+    new_db.transactions.checkpoint()
+    process = multiprocessing.Process(target=insert_and_exit, args=(2_000_000,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    new_db.handle_pool.close()
+    synced = []
+    monkeypatch.setattr(shelf_pool, 'fsync_file', synced.append)
+    new_db.transactions.checkpoint()  # empties the log the other process committed to
+    assert str(DB_ROOT / 'Students.db.dat') in synced and str(DB_ROOT / 'Students.db.dir') in synced
+    monkeypatch.undo()
+    assert new_db.get_table('Students').get_record(2_000_000)['ID'] == 2_000_000
+
+
+def test_statistics_across_processes(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 5)
+    assert students.statistics()['rows'] == 5
+    process = multiprocessing.Process(target=insert_and_exit, args=(2_000_000,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    students = new_db.get_table('Students')  # reloaded, the catalog generation changed
+    assert students.count() == 6
+    assert students.statistics()['fields']['Birthday']['min'] == dt.datetime(1980, 1, 1)
+
+
 def test_bad_key(new_db: DataBase) -> None:
     with pytest.raises(ValueError):
         _ = new_db.create_table('Students', STUDENT_FIELDS, 'BAD_KEY')
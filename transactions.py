@@ -0,0 +1,287 @@
+import os
+import pickle
+import shelve
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from instrumentation import Instrumentation
+from locks import DatabaseLock
+from record_cache import RecordCache
+from shelf_pool import ShelfPool, delete_key
+
+FRAME_HEADER = struct.Struct('<II')  # payload length, crc32 of the payload
+WAL_MODES = ('sync', 'group')  # group mode only survives a crash of the process, not of the machine
+GROUP_COMMIT_SIZE = 32  # commits written before the log is fsynced in group mode
+GROUP_COMMIT_INTERVAL = 0.01  # seconds a group mode commit may wait for its fsync
+CHECKPOINT_BYTES = 16 * 1024 * 1024  # log size that triggers writing the stores to disk and emptying the log
+
+Record = Tuple[str, str, Optional[bytes]]  # store file name, encoded key, pickled value or None for a delete
+
+
+class WriteAheadLog:
+    # every commit is appended as one frame [length, crc32, pickled records], a torn or corrupt frame ends the log.
+    # In group mode a commit is applied to the stores before its frame is fsynced: the frame is in the page cache,
+    # so a crash of the process loses nothing, but a power loss may lose the last commits of the log while parts of
+    # them already reached the stores
+    def __init__(self, path: str, mode: str = 'sync'):
+        self.path = path
+        self.mode = mode
+        self.file = None
+        self.pending = 0  # group mode commits that were written but not fsynced yet
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def set_mode(self, mode: Optional[str]) -> None:
+        if mode is None:
+            return
+        if mode not in WAL_MODES:
+            raise ValueError
+        self.sync()
+        self.mode = mode
+
+    def append(self, records: List[Record]) -> None:
+        payload = pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'ab')
+            self.file.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.file.flush()
+            if self.mode == 'sync':
+                os.fsync(self.file.fileno())
+                return
+            self.pending += 1
+            if self.pending >= GROUP_COMMIT_SIZE:
+                self.sync_locked()
+            elif self.timer is None:  # the last commits of a burst are fsynced after the interval
+                self.timer = threading.Timer(GROUP_COMMIT_INTERVAL, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def sync(self) -> None:
+        with self.lock:
+            self.sync_locked()
+
+    def sync_locked(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending and self.file is not None:
+            os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def size(self) -> int:
+        with self.lock:
+            return self.file.tell() if self.file is not None else 0
+
+    def frames(self) -> Iterator[List[Record]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as file:
+            while True:
+                header = file.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return
+                length, crc = FRAME_HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:  # the commit never finished
+                    return
+                yield pickle.loads(payload)
+
+    def stores(self) -> Set[str]:
+        # the file names of the stores the commits in the log wrote, whichever process made them
+        return {name for records in self.frames() for name, _, _ in records}
+
+    def truncate(self) -> None:
+        # the file is reopened by the next append, so the log follows the file if it is replaced
+        with self.lock:
+            self.sync_locked()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if os.path.isdir(os.path.dirname(self.path) or '.'):
+                with open(self.path, 'wb') as file:
+                    os.fsync(file.fileno())
+
+    def close(self) -> None:
+        with self.lock:
+            self.sync_locked()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Transaction:
+    def __init__(self):
+        self.writes = {}  # store path -> {encoded key: pickled value, or None when the key is deleted}
+        self.rollback_hooks = []
+        self.commit_hooks = []  # run inside the transaction just before it commits, their writes commit with it
+
+    def on_rollback(self, hook: Callable[[], None]) -> None:
+        if hook not in self.rollback_hooks:
+            self.rollback_hooks.append(hook)
+
+    def before_commit(self, hook: Callable[[], None]) -> None:
+        if hook not in self.commit_hooks:
+            self.commit_hooks.append(hook)
+
+    def records(self) -> List[Record]:
+        return [(os.path.basename(path), key, value)
+                for path, writes in self.writes.items() for key, value in writes.items()]
+
+
+class StoreView:
+    # a shelf with the pending writes of a transaction on top of it, so the transaction reads its own writes
+    def __init__(self, shelf: Callable[[], shelve.Shelf], writes: Dict[str, Optional[bytes]]):
+        self.shelf = shelf  # the pool may close the handle while the transaction runs
+        self.writes = writes
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.writes:
+            if self.writes[key] is None:
+                raise KeyError(key)
+            return pickle.loads(self.writes[key])
+        return self.shelf()[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.writes[key] = pickle.dumps(value)  # pickled right away, like shelve, so later changes to value are not seen
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.writes[key] = None
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.writes:
+            return self.writes[key] is not None
+        return key in self.shelf()
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.shelf():
+            if key not in self.writes:
+                yield key
+        for key, value in list(self.writes.items()):
+            if value is not None:
+                yield key
+
+    def __len__(self) -> int:
+        shelf = self.shelf()
+        return len(shelf) + sum((value is not None) - (key in shelf) for key, value in self.writes.items())
+
+
+class TransactionManager:
+    # writes made inside a transaction are kept in memory, logged as one frame on commit and only then applied
+    def __init__(self, pool: ShelfPool, wal: WriteAheadLog, cache: Optional[RecordCache] = None,
+                 lock: Optional[DatabaseLock] = None, instrumentation: Optional[Instrumentation] = None):
+        self.pool = pool
+        self.instrumentation = instrumentation if instrumentation else Instrumentation()
+        self.wal = wal
+        self.cache = cache  # rows cached by key, dropped when a commit changes them
+        self.lock = lock if lock else DatabaseLock(os.path.splitext(wal.path)[0] + '.lock')
+        self.folder = os.path.dirname(wal.path)
+        self.local = threading.local()
+        self.replay_pending = False  # a logged commit failed to apply, the log must be replayed before it is emptied
+
+    def active(self) -> Optional[Transaction]:
+        return getattr(self.local, 'transaction', None)
+
+    def has_writes(self, path: str) -> bool:
+        # whether the store at path differs from its files for the current thread
+        transaction = self.active()
+        return transaction is not None and bool(transaction.writes.get(path))
+
+    def store(self, path: str):
+        transaction = self.active()
+        if transaction is None:
+            return self.pool.get(path)
+        return StoreView(lambda: self.pool.get(path), transaction.writes.setdefault(path, {}))
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        if self.active() is not None:  # a nested block is part of the outer transaction
+            yield self.active()
+            return
+        with self.lock.write():  # the reads of the transaction must not change under it
+            transaction = Transaction()
+            self.local.transaction = transaction
+            try:
+                yield transaction
+                for hook in transaction.commit_hooks:
+                    hook()
+            except BaseException:
+                self.local.transaction = None
+                if any(transaction.writes.values()):  # nothing cached can be ahead of the files otherwise
+                    for hook in transaction.rollback_hooks:
+                        hook()
+                raise
+            self.local.transaction = None
+            self.commit(transaction)
+
+    def commit(self, transaction: Transaction) -> None:
+        records = transaction.records()
+        if not records:
+            return
+        with self.instrumentation.measure(None, 'commit'):  # part of the operation that wrote, if it is measured
+            self.instrumentation.count(bytes_written=sum(len(value) for _, _, value in records if value is not None))
+            self.wal.append(records)
+            try:
+                self.apply(records)
+            except BaseException:
+                self.replay_pending = True
+                raise
+        if self.wal.size() > CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def apply(self, records: List[Record]) -> None:
+        # store by store; only the keys changed are written to the key directories (not the whole directories),
+        # which other processes read when they reopen the files after the lock generation changed
+        stores = {}
+        for name, key, value in records:
+            stores.setdefault(name, []).append((key, value))
+        for name, writes in stores.items():
+            path = os.path.join(self.folder, name)
+            with self.pool.lock:  # not closed by another thread before its keys are written
+                shelf = self.pool.get(path)
+                for key, value in writes:
+                    if self.cache is not None:
+                        self.cache.invalidate(path, key)
+                    if value is None:
+                        if key in shelf:
+                            delete_key(shelf, key)
+                    else:
+                        shelf.dict[key.encode(shelf.keyencoding)] = value
+                self.pool.write_keys(path, dict.fromkeys(key for key, _ in writes))
+
+    def checkpoint(self) -> None:
+        # once the stores are on disk the log is not needed for recovery anymore; the log is shared by the processes,
+        # so every store it names is fsynced, also those another process wrote and did not fsync yet
+        with self.lock.write():
+            self.wal.sync()
+            if self.replay_pending:
+                self.replay()
+            self.pool.flush(durable=True, stores=[os.path.join(self.folder, name) for name in self.wal.stores()])
+            self.wal.truncate()
+
+    def replay(self) -> int:
+        # applies every complete frame; frames that were already applied are simply written again
+        replayed = 0
+        for records in self.wal.frames():
+            self.apply(records)
+            replayed += 1
+        self.replay_pending = False
+        return replayed
+
+    def recover(self) -> int:
+        with self.lock.write():
+            recovered = self.replay()
+            if recovered:
+                self.checkpoint()
+            return recovered
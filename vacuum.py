@@ -0,0 +1,143 @@
+import os
+import shelve
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+from shelf_pool import fsync_file, remove_store, rename_store, store_files
+
+BLOCK_SIZE = 512  # dbm.dumb starts every value on a block boundary of its data file
+DEFAULT_MIN_WASTE = 0.25  # share of dead bytes that makes the background vacuum rewrite a store
+DEFAULT_VACUUM_INTERVAL = 600.0  # seconds between two passes of the background vacuum
+DEFAULT_VACUUM_PAUSE = 0.1  # seconds the background vacuum leaves the lock free between two stores
+VACUUM_SUFFIX = '_vacuum'  # the new files of a store being rewritten, removed if a crash left them behind
+INDEX_SUFFIXES = ('_hash_index.db', '_ordered_index.db', '_composite_index.db', '.col')
+
+Keep = Callable[[bytes], bool]  # whether a pickled value is copied to the compacted store
+Step = Dict[str, Any]  # path, bytes_before, bytes_after, entries_dropped and removed of one store
+
+
+def files_size(path: str) -> int:
+    return sum(os.path.getsize(file) for file in store_files(path))
+
+
+def dead_share(handle: shelve.Shelf) -> float:
+    # the share of the data file that no live value uses, from the key directory alone; dbm.dumb never reuses the
+    # space of a deleted value, nor of a value that grew out of its blocks. 0 for the dbm modules that reuse it
+    index = getattr(handle.dict, '_index', None)
+    if index is None or not os.path.exists(handle.dict._datfile):
+        return 0.0
+    size = os.path.getsize(handle.dict._datfile)
+    live = sum(-(-length // BLOCK_SIZE) * BLOCK_SIZE for _, length in index.values())
+    return max(0.0, 1 - live / size) if size else 0.0
+
+
+def compact_store(path: str, keep: Optional[Keep] = None) -> int:
+    # the live values copied in file order into new files that replace the store's, without the values keep
+    # rejects; returns the entries dropped. The store must not be open anywhere else
+    s = shelve.open(path)
+    try:
+        index = getattr(s.dict, '_index', None)
+        if index is None:  # gdbm and the like reorganize their own file
+            dropped = [key for key in s.dict.keys() if keep is not None and not keep(s.dict[key])]
+            for key in dropped:
+                del s.dict[key]
+            if hasattr(s.dict, 'reorganize'):
+                s.dict.reorganize()
+            return len(dropped)
+        entries = sorted(index.items(), key=lambda item: item[1])
+        data_path = s.dict._datfile
+    finally:
+        s.close()
+
+    new_path = path + VACUUM_SUFFIX
+    remove_store(new_path)
+    directory = []
+    dropped = 0
+    with open(data_path, 'rb') as old_file, open(new_path + '.dat', 'wb') as new_file:
+        for key, (position, length) in entries:
+            old_file.seek(position)
+            data = old_file.read(length)
+            if keep is not None and not keep(data):
+                dropped += 1
+                continue
+            new_file.write(b'\0' * (-new_file.tell() % BLOCK_SIZE))
+            directory.append('%r, %r\n' % (key.decode('Latin-1'), (new_file.tell(), length)))
+            new_file.write(data)
+    with open(new_path + '.dir', 'w', encoding='Latin-1') as file:  # the key directory as dbm.dumb writes it
+        file.writelines(directory)
+    for file in store_files(new_path):
+        fsync_file(file)
+    rename_store(new_path, path)
+    return dropped
+
+
+def stray_stores(folder: str, expected: Set[str]) -> List[str]:
+    # index and column stores no table uses anymore (the files of a dropped index) and the leftovers of a vacuum
+    # that did not finish
+    stores = set()
+    for name in os.listdir(folder):
+        base = name[:-len('.dat')] if name.endswith(('.dat', '.dir', '.bak')) else name
+        if base.endswith(VACUUM_SUFFIX) or base.endswith(INDEX_SUFFIXES):
+            stores.add(os.path.join(folder, base))
+    return sorted(store for store in stores if store not in expected)
+
+
+def new_report() -> Dict[str, Any]:
+    return dict(files=0, files_removed=0, bytes_before=0, bytes_after=0, bytes_reclaimed=0, entries_dropped=0)
+
+
+def add_step(report: Dict[str, Any], step: Step) -> None:
+    report['files_removed' if step['removed'] else 'files'] += 1
+    report['bytes_before'] += step['bytes_before']
+    report['bytes_after'] += step['bytes_after']
+    report['bytes_reclaimed'] += step['bytes_before'] - step['bytes_after']
+    report['entries_dropped'] += step['entries_dropped']
+
+
+class BackgroundVacuum:
+    # passes over the stores in a daemon thread, one every interval seconds; each store is rewritten under the
+    # write lock on its own and the lock is left free for pause seconds after it, so readers and writers only ever
+    # wait for one store. stop() waits for the store being rewritten
+    def __init__(self, steps: Callable[[], Iterable[Step]], interval: float = DEFAULT_VACUUM_INTERVAL,
+                 pause: float = DEFAULT_VACUUM_PAUSE):
+        if interval <= 0 or pause < 0:
+            raise ValueError
+        self.steps = steps
+        self.interval = interval
+        self.pause = pause
+        self.report = new_report()  # everything reclaimed since start
+        self.passes = 0
+        self.error = None  # the exception that stopped the thread
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='vacuum', daemon=True)
+
+    def run(self) -> None:
+        try:
+            while not self.stopped.is_set():
+                for step in self.steps():
+                    add_step(self.report, step)
+                    if self.stopped.wait(self.pause):
+                        return
+                self.passes += 1
+                self.stopped.wait(self.interval)
+        except Exception as error:
+            self.error = error
+
+    def start(self) -> 'BackgroundVacuum':
+        self.thread.start()
+        return self
+
+    def stop(self) -> Dict[str, Any]:
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        return dict(self.report, passes=self.passes)
+
+
+def run_steps(steps: Iterator[Step]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    report = new_report()
+    for step in steps:
+        add_step(report, step)
+    return dict(report, seconds=time.perf_counter() - started)